@@ -0,0 +1,277 @@
+import asyncio
+
+from pop_lib import (CRLF, LF, POP3_PORT, _MAXLINE, _PIPELINE_BATCH, HAVE_SSL,
+                     error_proto, _apopdigest, _checkresp, _islongcmd,
+                     _parsecapa, _parsestat, _stripline, _unstuff)
+
+if HAVE_SSL:
+    import ssl
+
+__all__ = ["AsyncPOP3", "poll_many"]
+
+
+class AsyncPOP3:
+    """asyncio flavour of pop_lib.POP3.
+
+    Offers the same commands as coroutines and shares the response
+    parsing with the blocking class.  'timeout' bounds every command
+    (and the connect); a timed out or cancelled command closes the
+    connection because the response stream can no longer be trusted.
+
+        pop = AsyncPOP3(host)
+        await pop.connect()
+        await pop.user(name); await pop.pass_(password)
+        count, size = await pop.stat()
+        await pop.quit()
+    """
+
+    encoding = 'UTF-8'
+
+    def __init__(self, host, port=POP3_PORT, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.welcome = None
+        self._tls_established = False
+        self._pipelining = None
+
+    async def connect(self, ssl_context=None):
+        """Open the connection and return the server greeting."""
+        self.reader, self.writer = await self._run(asyncio.open_connection(
+            self.host, self.port, ssl=ssl_context, limit=_MAXLINE + 1,
+            server_hostname=self.host if ssl_context else None))
+        self._tls_established = ssl_context is not None
+        self.welcome = await self._run(self._getresp())
+        return self.welcome
+
+    async def __aenter__(self):
+        if self.writer is None:
+            await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+
+    # Internal: run a coroutine under the command timeout, dropping the
+    # connection if it does not complete.
+
+    async def _run(self, coro):
+        try:
+            return await asyncio.wait_for(coro, self.timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            self.close()
+            raise
+
+
+    async def _getline(self):
+        try:
+            line = await self.reader.readuntil(LF)
+        except asyncio.LimitOverrunError:
+            raise error_proto('line too long')
+        except asyncio.IncompleteReadError as err:
+            if not err.partial:
+                raise error_proto('-ERR EOF')
+            line = err.partial
+        if len(line) > _MAXLINE:
+            raise error_proto('line too long')
+        return _stripline(line)
+
+    async def _getresp(self):
+        resp, o = await self._getline()
+        return _checkresp(resp)
+
+    async def _getlongresp(self):
+        resp = await self._getresp()
+        list = []; octets = 0
+        line, o = await self._getline()
+        while line != b'.':
+            line, o = _unstuff(line, o)
+            octets = octets + o
+            list.append(line)
+            line, o = await self._getline()
+        return resp, list, octets
+
+    def _putcmd(self, line):
+        self.writer.write(bytes(line, self.encoding) + CRLF)
+
+    async def _shortcmd(self, line):
+        async def cmd():
+            self._putcmd(line)
+            await self.writer.drain()
+            return await self._getresp()
+        return await self._run(cmd())
+
+    async def _longcmd(self, line):
+        async def cmd():
+            self._putcmd(line)
+            await self.writer.drain()
+            return await self._getlongresp()
+        return await self._run(cmd())
+
+
+    def getwelcome(self):
+        return self.welcome
+
+
+    # Here are all the POP commands, see pop_lib.POP3 for details:
+
+    async def user(self, user):
+        return await self._shortcmd('USER %s' % user)
+
+    async def pass_(self, pswd):
+        return await self._shortcmd('PASS %s' % pswd)
+
+    async def apop(self, user, password):
+        digest = _apopdigest(self.welcome, password, self.encoding)
+        return await self._shortcmd('APOP %s %s' % (user, digest))
+
+    async def stat(self):
+        return _parsestat(await self._shortcmd('STAT'))
+
+    async def list(self, which=None):
+        if which is not None:
+            return await self._shortcmd('LIST %s' % which)
+        return await self._longcmd('LIST')
+
+    async def retr(self, which):
+        return await self._longcmd('RETR %s' % which)
+
+    async def top(self, which, howmuch):
+        return await self._longcmd('TOP %s %s' % (which, howmuch))
+
+    async def uidl(self, which=None):
+        if which is not None:
+            return await self._shortcmd('UIDL %s' % which)
+        return await self._longcmd('UIDL')
+
+    async def dele(self, which):
+        return await self._shortcmd('DELE %s' % which)
+
+    async def noop(self):
+        return await self._shortcmd('NOOP')
+
+    async def rset(self):
+        return await self._shortcmd('RSET')
+
+    async def capa(self):
+        try:
+            resp = await self._longcmd('CAPA')
+        except error_proto as _err:
+            raise error_proto('-ERR CAPA not supported by server')
+        return _parsecapa(resp[1])
+
+    async def has_pipelining(self):
+        if self._pipelining is None:
+            try:
+                self._pipelining = 'PIPELINING' in await self.capa()
+            except error_proto:
+                self._pipelining = False
+        return self._pipelining
+
+    async def pipeline(self, cmds, batch=_PIPELINE_BATCH):
+        """Same contract as pop_lib.POP3.pipeline()."""
+        cmds = list(cmds)
+        if not await self.has_pipelining():
+            batch = 1
+
+        async def getcmdresp(line):
+            try:
+                if _islongcmd(line):
+                    return await self._getlongresp()
+                return await self._getresp()
+            except error_proto as err:
+                if not isinstance(err.args[0], bytes):
+                    raise
+                return err
+
+        async def run(chunk):
+            for line in chunk:
+                self._putcmd(line)
+            await self.writer.drain()
+            return [await getcmdresp(line) for line in chunk]
+
+        results = []
+        for start in range(0, len(cmds), batch):
+            results.extend(await self._run(run(cmds[start:start + batch])))
+        return results
+
+    async def top_many(self, whichs, howmuch):
+        return await self.pipeline(['TOP %s %s' % (which, howmuch) for which in whichs])
+
+    async def retr_many(self, whichs):
+        return await self.pipeline(['RETR %s' % which for which in whichs])
+
+    async def stls(self, context=None):
+        """Start a TLS session on the active connection (RFC 2595)."""
+        if not HAVE_SSL:
+            raise error_proto('-ERR TLS support missing')
+        if self._tls_established:
+            raise error_proto('-ERR TLS session already established')
+        caps = await self.capa()
+        if not 'STLS' in caps:
+            raise error_proto('-ERR STLS not supported by server')
+        if context is None:
+            context = ssl._create_stdlib_context()
+        resp = await self._shortcmd('STLS')
+        if hasattr(self.writer, 'start_tls'):
+            await self._run(self.writer.start_tls(context, server_hostname=self.host))
+        else:
+            # Python < 3.11: upgrade the transport by hand
+            loop = asyncio.get_running_loop()
+            transport = self.writer.transport
+            transport = await self._run(loop.start_tls(
+                transport, transport.get_protocol(), context,
+                server_hostname=self.host))
+            self.writer._transport = transport
+            self.reader._transport = transport
+        self._tls_established = True
+        self._pipelining = None
+        return resp
+
+    async def quit(self):
+        resp = await self._shortcmd('QUIT')
+        self.close()
+        return resp
+
+    def close(self):
+        """Close the connection without assuming anything about it."""
+        writer = self.writer
+        self.writer = None
+        if writer is not None:
+            writer.close()
+
+
+async def _check_one(host, port, user, password, timeout):
+    pop_conn = AsyncPOP3(host, port, timeout)
+    try:
+        await pop_conn.connect()
+        await pop_conn.user(user)
+        await pop_conn.pass_(password)
+        result = await pop_conn.stat()
+        await pop_conn.quit()
+        return result
+    finally:
+        pop_conn.close()
+
+
+async def poll_many(accounts, concurrency=100, timeout=30):
+    """Run STAT on many mailboxes from one event loop.
+
+    'accounts' is an iterable of (host, port, user, password).  At most
+    'concurrency' connections are open at once.  Result is a list in the
+    same order holding (message count, mailbox size) or the exception
+    raised for that mailbox.
+    """
+    limit = asyncio.Semaphore(concurrency)
+
+    async def check(account):
+        async with limit:
+            try:
+                return await _check_one(*account, timeout)
+            except (OSError, error_proto, asyncio.TimeoutError) as err:
+                return err
+
+    return await asyncio.gather(*(check(account) for account in accounts))
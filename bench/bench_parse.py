@@ -0,0 +1,53 @@
+"""
+邮件头解析吞吐量：当前线程解析与 mime_parse.ParserPool 多进程解析对比
+
+    python -m bench.bench_parse [--messages 20000] [--workers 4]
+"""
+import argparse
+import base64
+import os
+import time
+
+from mime_parse import ParserPool, parse_headers
+
+
+def make_header(i):
+    """生成第 i 封测试邮件的邮件头，混合编码字主题、GBK 原始字节和多个收件人"""
+    subject = base64.b64encode(f'测试邮件 {i} 的主题'.encode('utf-8')).decode()
+    return (f'Message-ID: <parse-{i}@example.com>\r\n'
+            f'From: =?gb2312?b?{base64.b64encode("发件人".encode("gb2312")).decode()}?= <sender{i % 31}@example.com>\r\n'
+            f'To: user@example.com, other{i % 7}@example.com\r\n'
+            f'Subject: =?utf-8?b?{subject}?=\r\n'
+            f'Date: Mon, 01 Jan 2024 00:{i % 60:02d}:00 +0000\r\n'
+            f'Received: from mx{i % 5}.example.com by mail.example.com; Mon, 01 Jan 2024 00:00:00 +0000\r\n'
+            f'X-Mailer: bench\r\n\r\n').encode('ascii') + b'X-Raw: ' + '原始'.encode('gbk') + b'\r\n'
+
+
+def run(raws, pool, batch):
+    start = time.perf_counter()
+    futures = [pool.submit(raws[i:i + batch]) for i in range(0, len(raws), batch)]
+    records = [record for future in futures for record in future.result()]
+    assert len(records) == len(raws)
+    return len(raws) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch', type=int, default=64)
+    args = parser.parse_args()
+
+    raws = [make_header(i) for i in range(args.messages)]
+    print(parse_headers(raws[1]))
+    print(f'{"inline":>12}: {run(raws, ParserPool(workers=1), args.batch):10.0f} msgs/s')
+    pool = ParserPool(workers=args.workers, min_batch=1)
+    try:
+        pool.submit(raws[:1]).result()   # 进程启动不计入
+        print(f'{f"{args.workers} procs":>12}: {run(raws, pool, args.batch):10.0f} msgs/s')
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
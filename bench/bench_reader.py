@@ -0,0 +1,46 @@
+"""
+对比 pop_lib.POP3 的快速读取器与 makefile() 读取器的 RETR 吞吐量
+
+    python -m bench.bench_reader [--messages 20] [--size 2000000]
+"""
+import argparse
+import time
+
+import pop_lib
+from bench.fake_pop3 import FakePOP3Server, make_message
+
+
+def run(port, count, fast):
+    pop_lib.POP3.fast_reader = fast
+    pop_conn = pop_lib.POP3('127.0.0.1', port)
+    pop_conn.user('bench')
+    pop_conn.pass_('bench')
+    total = 0
+    start = time.perf_counter()
+    for i in range(1, count + 1):
+        _, _, octets = pop_conn.retr(i)
+        total += octets
+    elapsed = time.perf_counter() - start
+    pop_conn.quit()
+    return total / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--size', type=int, default=2_000_000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    server = FakePOP3Server([make_message(i, args.size) for i in range(1, args.messages + 1)]).start()
+    try:
+        for fast in (False, True):
+            best = max(run(server.port, args.messages, fast) for _ in range(args.rounds))
+            print(f"{'fast reader' if fast else 'makefile':>12}: {best:8.1f} MB/s")
+    finally:
+        pop_lib.POP3.fast_reader = True
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+SMTP 发送吞吐量：每封邮件新建连接、复用 SMTPSession，以及 PIPELINING / CHUNKING 的效果
+
+    python -m bench.bench_smtp [--messages 200] [--size 2000] [--latency 0.005]
+"""
+import argparse
+import time
+
+import smtp_lib
+from bench.fake_smtp import FakeSMTPServer
+
+
+MODES = [
+    ('connection per message, HELO', dict(esmtp=False), False),
+    ('persistent session, HELO', dict(esmtp=False), True),
+    ('persistent session, PIPELINING', dict(capabilities=('AUTH LOGIN', 'PIPELINING')), True),
+    ('persistent session, PIPELINING+CHUNKING', dict(capabilities=('AUTH LOGIN', 'PIPELINING', 'CHUNKING')), True),
+]
+
+
+def run(options, persistent, count, body, latency):
+    server = FakeSMTPServer(latency=latency, **options).start()
+    message = smtp_lib.build_message('me@example.com', ['you@example.com'], 'bench', body)
+    try:
+        start = time.perf_counter()
+        if persistent:
+            with smtp_lib.SMTPSession('127.0.0.1', server.port, 'user', 'secret') as session:
+                session.send_many([('me@example.com', ['you@example.com', 'cc@example.com'], message)] * count)
+        else:
+            for i in range(count):
+                smtp_lib.send_email_via_smtp('127.0.0.1', server.port, 'user', 'secret', 'me@example.com',
+                                             ['you@example.com', 'cc@example.com'], 'bench', body)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+    assert server.received == count, server.received
+    return count / elapsed, server.round_trips / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--size', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.005, help='模拟的单次往返时延（秒）')
+    args = parser.parse_args()
+
+    body = ('x' * 74 + '\n') * (args.size // 75)
+    for name, options, persistent in MODES:
+        rate, rtts = run(options, persistent, args.messages, body, args.latency)
+        print(f"{name:>42}: {rate:8.1f} msg/s, {rtts:5.2f} round trips/msg")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+存储层基准：批量写入、去重查询、分页读取邮件头、全文搜索
+
+    python -m bench.bench_storage [--sizes 10000 100000 1000000]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+import storage
+
+
+def make_rows(start, count):
+    return [(f'<bench-{i}@example.com>', f'sender{i % 97}@example.com', 'user@example.com',
+             f'bench message {i}', 'x' * 200, f'Mon, 01 Jan 2024 00:{i % 60:02d}:00 +0000')
+            for i in range(start, start + count)]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_size(size, batch):
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = storage.connect(os.path.join(tmp, 'bench.db'))
+        store = storage.MailStore(conn)
+        start = time.perf_counter()
+        for offset in range(0, size, batch):
+            store.insert_emails(make_rows(offset, min(batch, size - offset)))
+        insert = time.perf_counter() - start
+
+        probe = [row[0] for row in make_rows(size - 500, 1000)]
+        dedupe, found = timed(store.existing_ids, probe)
+        assert len(found) == 500
+
+        page, _ = timed(lambda: conn.execute('SELECT email_id, sender, subject, date FROM emails ORDER BY rowid DESC LIMIT 200 OFFSET ?', (size // 2,)).fetchall())
+        sender, _ = timed(lambda: conn.execute('SELECT COUNT(*) FROM emails WHERE sender = ?', ('sender3@example.com',)).fetchone())
+        rare, hits = timed(store.search, str(size // 3))
+        assert hits
+        common, _ = timed(store.search, 'sender3')
+        conn.close()
+    print(f"{size:>9} rows: insert {size / insert:10.0f} rows/s | dedupe 1000 ids {dedupe * 1e3:7.2f} ms"
+          f" | page at middle {page * 1e3:7.2f} ms | sender lookup {sender * 1e3:7.2f} ms"
+          f" | search rare {rare * 1e3:7.2f} ms, common {common * 1e3:7.2f} ms")
+
+
+def bench_legacy(size):
+    """旧实现：逐行 execute、把所有 id 读进列表再做线性查找"""
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'legacy.db'))
+        conn.executescript(storage.MIGRATIONS[0])
+        start = time.perf_counter()
+        for row in make_rows(0, size):
+            saved = conn.execute('SELECT email_id FROM emails').fetchall()
+            if (row[0],) in saved:
+                continue
+            conn.execute('INSERT INTO emails (email_id, sender, recipient, subject, body, date) VALUES (?, ?, ?, ?, ?, ?)', row)
+        conn.commit()
+        elapsed = time.perf_counter() - start
+        conn.close()
+    print(f"{size:>9} rows: legacy insert {size / elapsed:10.0f} rows/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--batch', type=int, default=5000)
+    parser.add_argument('--legacy', type=int, default=2000, help='旧实现是 O(n^2)，只测较小规模')
+    args = parser.parse_args()
+    bench_legacy(args.legacy)
+    for size in args.sizes:
+        bench_size(size, args.batch)
+
+
+if __name__ == '__main__':
+    main()
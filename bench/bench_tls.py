@@ -0,0 +1,68 @@
+"""
+测量 POP3 建立连接（TCP + TLS 握手 + 欢迎信息）的耗时，对比完整握手与 TLS 会话恢复
+
+    python -m bench.bench_tls [--connections 50]
+"""
+import argparse
+import ssl
+import statistics
+import tempfile
+import time
+
+import pop_lib
+from bench.fake_pop3 import FakePOP3Server, make_message, self_signed_cert, server_context
+
+
+def run(connect, count, resume):
+    times = []
+    resumed = 0
+    for _ in range(count):
+        if not resume:
+            # 忘掉上次的会话，强制完整握手
+            pop_lib._tls_sessions.clear()
+        start = time.perf_counter()
+        pop_conn = connect()
+        times.append(time.perf_counter() - start)
+        resumed += pop_conn.tls_resumed()
+        pop_conn.quit()
+    return statistics.median(times) * 1000, resumed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = self_signed_cert(directory)
+        tls = server_context(certfile, keyfile)
+        messages = [make_message(1)]
+        implicit = FakePOP3Server(messages, tls_context=tls, implicit_tls=True).start()
+        explicit = FakePOP3Server(messages, capabilities=('UIDL', 'TOP', 'PIPELINING', 'STLS'), tls_context=tls).start()
+
+        context = ssl.create_default_context(cafile=certfile)
+
+        def starttls(context):
+            pop_conn = pop_lib.POP3('127.0.0.1', explicit.port)
+            pop_conn.stls(context)
+            return pop_conn
+
+        modes = [
+            ('plain', lambda: pop_lib.POP3('127.0.0.1', explicit.port), False),
+            ('ssl full handshake', lambda: pop_lib.POP3_SSL('127.0.0.1', implicit.port, context=context), False),
+            ('ssl resumed', lambda: pop_lib.POP3_SSL('127.0.0.1', implicit.port, context=context), True),
+            ('stls full handshake', lambda: starttls(context), False),
+            ('stls resumed', lambda: starttls(context), True),
+        ]
+        try:
+            for name, connect, resume in modes:
+                connect().quit()
+                median, resumed = run(connect, args.connections, resume)
+                print(f'{name:>20}: {median:7.2f} ms median, resumed {resumed}/{args.connections}')
+        finally:
+            implicit.stop()
+            explicit.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+本地 POP3 模拟服务器，用于基准测试，不依赖任何真实邮箱
+"""
+import os
+import select
+import socket
+import socketserver
+import ssl
+import subprocess
+import threading
+import time
+
+
+def make_message(i, size=1024):
+    """
+    生成第 i 封测试邮件，正文约 size 字节，每行 76 字节，并带一行需要点填充的正文
+    """
+    header = (f'Message-ID: <bench-{i}@example.com>\r\n'
+              f'From: sender{i % 17}@example.com\r\n'
+              f'To: user@example.com\r\n'
+              f'Subject: bench message {i}\r\n'
+              f'Date: Mon, 01 Jan 2024 00:00:00 +0000\r\n\r\n').encode()
+    line = b'x' * 74 + b'\r\n'
+    body = b'.dot stuffed line\r\n' + line * (size // len(line))
+    return header + body
+
+
+def self_signed_cert(directory, host='127.0.0.1'):
+    """
+    用 openssl 命令行在 directory 下生成自签名证书，返回 (certfile, keyfile)
+    证书同时对 host 和 localhost 有效，客户端把 certfile 当作 CA 即可验证
+    """
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-keyout', keyfile, '-out', certfile, '-subj', '/CN=localhost',
+                    '-addext', f'subjectAltName=IP:{host},DNS:localhost'],
+                   check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def server_context(certfile, keyfile):
+    """模拟服务器使用的 TLS 上下文"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+def _stuff(message):
+    lines = message.splitlines(True)
+    return b''.join(b'.' + line if line.startswith(b'.') else line for line in lines)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """
+    与 fake_smtp 相同的往返模型：应答先缓存，客户端的数据处理完、需要再次等待客户端时才一起发出，
+    发出前先睡眠 server.latency 秒；客户端流水线发来的多条命令只算一次往返
+    """
+
+    def setup(self):
+        self.inbuf = bytearray()
+        self.outbuf = []
+        if self.server.implicit_tls:
+            self.request.do_handshake()
+
+    def _send(self, data):
+        self.outbuf.append(data)
+
+    def _has_input(self):
+        if isinstance(self.request, ssl.SSLSocket) and self.request.pending():
+            return True
+        return bool(select.select([self.request], [], [], 0.001)[0])
+
+    def _flush(self):
+        if not self.outbuf:
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        # 大邮件不拼接，避免复制
+        for data in self.outbuf:
+            self.request.sendall(data)
+        self.server.count_round_trip(sum(map(len, self.outbuf)))
+        self.outbuf = []
+
+    def _readline(self):
+        while True:
+            end = self.inbuf.find(b'\n')
+            if end >= 0:
+                line = bytes(self.inbuf[:end + 1])
+                del self.inbuf[:end + 1]
+                return line
+            # 客户端还有数据在路上（流水线）时先不回复
+            if not self._has_input():
+                self._flush()
+            data = self.request.recv(65536)
+            if not data:
+                return b''
+            self.inbuf += data
+
+    def handle(self):
+        server = self.server
+        self._send(b'+OK fake POP3 ready\r\n')
+        while True:
+            raw = self._readline()
+            if not raw:
+                return
+            words = raw.decode('ascii', 'replace').split()
+            if not words:
+                continue
+            cmd, args = words[0].upper(), words[1:]
+            handler = getattr(self, 'cmd_' + cmd, None)
+            if handler is None:
+                self._send(b'-ERR unknown command\r\n')
+                continue
+            try:
+                handler(server, args)
+            except (IndexError, ValueError):
+                self._send(b'-ERR no such message\r\n')
+            if cmd == 'QUIT':
+                self._flush()
+                return
+
+    def cmd_USER(self, server, args):
+        self._send(b'+OK\r\n')
+
+    def cmd_PASS(self, server, args):
+        self._send(b'+OK logged in\r\n')
+
+    cmd_NOOP = cmd_RSET = cmd_USER
+
+    def cmd_DELE(self, server, args):
+        server.messages[int(args[0]) - 1]
+        self._send(b'+OK deleted\r\n')
+
+    def cmd_STAT(self, server, args):
+        self._send(b'+OK %d %d\r\n' % (len(server.messages), sum(map(len, server.messages))))
+
+    def cmd_CAPA(self, server, args):
+        self._send(b'+OK\r\n' + b''.join(c.encode() + b'\r\n' for c in server.capabilities) + b'.\r\n')
+
+    def cmd_LIST(self, server, args):
+        if args:
+            n = int(args[0])
+            self._send(b'+OK %d %d\r\n' % (n, len(server.messages[n - 1])))
+            return
+        self._send(b'+OK\r\n' + b''.join(b'%d %d\r\n' % (i, len(m)) for i, m in enumerate(server.messages, 1)) + b'.\r\n')
+
+    def cmd_UIDL(self, server, args):
+        if args:
+            n = int(args[0])
+            server.messages[n - 1]
+            self._send(b'+OK %d uid-%d\r\n' % (n, n))
+            return
+        self._send(b'+OK\r\n' + b''.join(b'%d uid-%d\r\n' % (i, i) for i in range(1, len(server.messages) + 1)) + b'.\r\n')
+
+    def cmd_RETR(self, server, args):
+        message = server.stuffed[int(args[0]) - 1]
+        self._send(b'+OK\r\n')
+        self._send(message)
+        self._send(b'.\r\n')
+
+    def cmd_TOP(self, server, args):
+        message = server.messages[int(args[0]) - 1]
+        header = message.split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+        self._send(b'+OK\r\n' + _stuff(header) + b'.\r\n')
+
+    def cmd_STLS(self, server, args):
+        if server.tls_context is None or isinstance(self.request, ssl.SSLSocket):
+            self._send(b'-ERR STLS not available\r\n')
+            return
+        self._send(b'+OK begin TLS\r\n')
+        self._flush()
+        self.request = server.tls_context.wrap_socket(self.request, server_side=True)
+
+    def cmd_QUIT(self, server, args):
+        self._send(b'+OK bye\r\n')
+
+
+class FakePOP3Server(socketserver.ThreadingTCPServer):
+    """
+    * messages: 邮件原文列表（bytes，CRLF 换行）
+    * capabilities: CAPA 返回的能力列表
+    * tls_context: 服务端 TLS 上下文，implicit_tls 为 True 时连接一建立就握手（相当于 995 端口），
+      否则在 capabilities 里带上 'STLS' 由客户端用 STLS 升级
+    * latency: 每次往返额外等待的秒数
+    round_trips / sent_bytes 统计服务器发出应答的次数和字节数，reset_counters() 清零
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, messages, capabilities=('UIDL', 'TOP', 'PIPELINING'), handler=_Handler,
+                 tls_context=None, implicit_tls=False, latency=0.0):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.tls_context = tls_context
+        self.implicit_tls = implicit_tls
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.sent_bytes = 0
+        self.messages = list(messages)
+        self.stuffed = [_stuff(m) for m in self.messages]
+        self.capabilities = list(capabilities)
+
+    def count_round_trip(self, size):
+        with self.lock:
+            self.round_trips += 1
+            self.sent_bytes += size
+
+    def reset_counters(self):
+        with self.lock:
+            self.round_trips = 0
+            self.sent_bytes = 0
+
+    def get_request(self):
+        sock, addr = super().get_request()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.implicit_tls:
+            # 握手放到处理线程里的第一次读写，不阻塞 accept
+            sock = self.tls_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, addr
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
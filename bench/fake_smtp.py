@@ -0,0 +1,182 @@
+"""
+本地 SMTP 模拟服务器，用于基准测试；收到的邮件只计数，不保存
+"""
+import select
+import socketserver
+import threading
+import time
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """
+    应答先缓存起来，等客户端的数据全部处理完、需要再次等待客户端时才一起发出，
+    发出前先睡眠 server.latency 秒，以此模拟一次网络往返
+    """
+
+    def setup(self):
+        self.inbuf = bytearray()
+        self.outbuf = []
+
+    def _send(self, data):
+        self.outbuf.append(data)
+
+    def _recv(self):
+        # 客户端还有数据在路上（流水线）时先不回复
+        if self.outbuf and not select.select([self.request], [], [], 0.001)[0]:
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            self.request.sendall(b''.join(self.outbuf))
+            self.outbuf = []
+            self.server.count_round_trip()
+        data = self.request.recv(65536)
+        if not data:
+            raise EOFError
+        self.inbuf += data
+
+    def _readline(self):
+        while True:
+            end = self.inbuf.find(b'\n')
+            if end >= 0:
+                line = bytes(self.inbuf[:end + 1])
+                del self.inbuf[:end + 1]
+                return line
+            self._recv()
+
+    def _read(self, size):
+        while len(self.inbuf) < size:
+            self._recv()
+        data = bytes(self.inbuf[:size])
+        del self.inbuf[:size]
+        return data
+
+    def handle(self):
+        self._send(b'220 fake SMTP ready\r\n')
+        self.auth_step = 0
+        self.recipients = 0
+        self.chunked = 0
+        try:
+            while self._serve_line(self._readline()):
+                pass
+        except EOFError:
+            pass
+
+    def _serve_line(self, raw):
+        line = raw.rstrip(b'\r\n')
+        if self.auth_step:
+            self.auth_step -= 1
+            self._send(b'334 UGFzc3dvcmQ6\r\n' if self.auth_step else b'235 authenticated\r\n')
+            return True
+        words = line.split(None, 1)
+        cmd = words[0].upper().decode('ascii', 'replace') if words else ''
+        handler = getattr(self, 'cmd_' + cmd, None)
+        if handler is None:
+            self._send(b'500 unknown command\r\n')
+            return True
+        handler(self.server, words[1] if len(words) > 1 else b'')
+        if cmd == 'QUIT':
+            self.request.sendall(b''.join(self.outbuf))
+            return False
+        return True
+
+    def cmd_HELO(self, server, arg):
+        self._send(b'250 fake\r\n')
+
+    def cmd_EHLO(self, server, arg):
+        if not server.esmtp:
+            self._send(b'502 not implemented\r\n')
+            return
+        lines = [b'fake'] + [c.encode() for c in server.capabilities]
+        self._send(b''.join(b'250-' + l + b'\r\n' for l in lines[:-1]) + b'250 ' + lines[-1] + b'\r\n')
+
+    def cmd_AUTH(self, server, arg):
+        self.auth_step = 2
+        self._send(b'334 VXNlcm5hbWU6\r\n')
+
+    def cmd_MAIL(self, server, arg):
+        self.recipients = 0
+        self.chunked = 0
+        self._send(b'250 sender ok\r\n')
+
+    def cmd_RCPT(self, server, arg):
+        if b'reject' in arg:
+            self._send(b'550 no such user\r\n')
+            return
+        self.recipients += 1
+        self._send(b'250 recipient ok\r\n')
+
+    def cmd_DATA(self, server, arg):
+        if not self.recipients:
+            self._send(b'554 no valid recipients\r\n')
+            return
+        self._send(b'354 end with .\r\n')
+        size = 0
+        while True:
+            raw = self._readline()
+            if raw == b'.\r\n':
+                break
+            size += len(raw)
+        server.record(size)
+        self._send(b'250 queued\r\n')
+
+    def cmd_BDAT(self, server, arg):
+        words = arg.split()
+        self.chunked += len(self._read(int(words[0])))
+        if not self.recipients:
+            self._send(b'554 no valid recipients\r\n')
+        elif len(words) > 1 and words[1].upper() == b'LAST':
+            server.record(self.chunked)
+            self._send(b'250 queued\r\n')
+        else:
+            self._send(b'250 chunk ok\r\n')
+
+    def cmd_RSET(self, server, arg):
+        self.recipients = 0
+        self._send(b'250 reset\r\n')
+
+    def cmd_NOOP(self, server, arg):
+        self._send(b'250 ok\r\n')
+
+    def cmd_QUIT(self, server, arg):
+        self._send(b'221 bye\r\n')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    * capabilities: EHLO 返回的扩展列表，例如 ('PIPELINING', 'CHUNKING')
+    * esmtp: 为 False 时拒绝 EHLO，只能用 HELO
+    * latency: 每次往返额外等待的秒数
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, capabilities=('AUTH LOGIN',), esmtp=True, latency=0.0, handler=_Handler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.capabilities = list(capabilities)
+        self.esmtp = esmtp
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.received = 0
+        self.received_bytes = 0
+        self.round_trips = 0
+
+    def record(self, size):
+        with self.lock:
+            self.received += 1
+            self.received_bytes += size
+
+    def count_round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
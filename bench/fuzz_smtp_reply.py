@@ -0,0 +1,96 @@
+"""
+SMTPReplyReader 的模糊测试与基准：随机生成单行/多行应答，按随机长度切成 TCP 段
+（一个段里可能有半条或好几条应答）经 socketpair 发送，检查解析结果；再测解析吞吐量
+
+    python -m bench.fuzz_smtp_reply [--replies 20000] [--seed 1]
+"""
+import argparse
+import random
+import socket
+import threading
+import time
+
+import smtp_lib
+
+
+def random_reply(rng):
+    code = rng.choice([220, 221, 235, 250, 251, 334, 354, 421, 450, 451, 500, 530, 550, 554])
+    lines = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789 .-=') for _ in range(rng.randint(0, 80)))
+             for _ in range(rng.choice([1, 1, 1, 2, 5, 12]))]
+    lines = [line.strip() for line in lines]
+    wire = b''.join(b'%d-%s\r\n' % (code, line.encode()) for line in lines[:-1])
+    wire += b'%d %s\r\n' % (code, lines[-1].encode()) if lines[-1] else b'%d\r\n' % code
+    return (code, lines), wire
+
+
+def feed(sock, data, rng):
+    # 以随机长度的段发送，模拟应答被拆分或合并
+    pos = 0
+    while pos < len(data):
+        size = rng.choice([1, 2, 3, 7, 64, 512, 4096, 65536])
+        sock.sendall(data[pos:pos + size])
+        pos += size
+    sock.close()
+
+
+def fuzz(count, rng):
+    expected, wire = zip(*(random_reply(rng) for _ in range(count)))
+    client, server = socket.socketpair()
+    threading.Thread(target=feed, args=(server, b''.join(wire), rng), daemon=True).start()
+    reader = smtp_lib.SMTPReplyReader(client)
+    for want in expected:
+        got = reader.read_reply()
+        assert got == want, (got, want)
+    try:
+        reader.read_reply()
+    except smtp_lib.SMTPProtocolError:
+        pass
+    else:
+        raise AssertionError('expected EOF')
+    client.close()
+
+
+def fuzz_malformed(rng):
+    for wire in [b'25 ok\r\n', b'abc ok\r\n', b'250-a\r\n251 b\r\n', b'250xok\r\n', b'250-' + b'x' * 10000 + b'\r\n', b'250-partial']:
+        client, server = socket.socketpair()
+        threading.Thread(target=feed, args=(server, wire, rng), daemon=True).start()
+        try:
+            smtp_lib.SMTPReplyReader(client).read_reply()
+        except smtp_lib.SMTPProtocolError:
+            pass
+        else:
+            raise AssertionError('accepted malformed reply %r' % wire[:40])
+        client.close()
+
+
+def bench(count, rng):
+    _, wire = zip(*(random_reply(rng) for _ in range(count)))
+    data = b''.join(wire)
+    client, server = socket.socketpair()
+    threading.Thread(target=lambda: (server.sendall(data), server.close()), daemon=True).start()
+    reader = smtp_lib.SMTPReplyReader(client, bufsize=65536)
+    start = time.perf_counter()
+    for _ in range(count):
+        reader.read_reply()
+    elapsed = time.perf_counter() - start
+    client.close()
+    return count / elapsed, len(data) / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replies', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    for _ in range(args.rounds):
+        fuzz(args.replies // args.rounds, rng)
+    fuzz_malformed(rng)
+    print(f"fuzz: {args.replies} replies in {args.rounds} rounds parsed correctly")
+    rate, mbps = bench(args.replies * 5, rng)
+    print(f"parse: {rate:10.0f} replies/s ({mbps:.1f} MB/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""
+收发信协议基准套件：在进程内启动模拟的 POP3 / SMTP 服务器，测量同步和发送路径的
+吞吐量（msgs/s、bytes/s）、每封邮件的往返次数和内存峰值，结果写成 JSON 便于跟踪回归
+
+    python -m bench.suite [--quick] [--latency 0.002] [--output results.json]
+    python -m bench.suite --compare baseline.json [--tolerance 0.2]
+
+--compare 时与基线逐项比较，吞吐量下降或往返次数增加超过 tolerance 的场景退出码为 1。
+内存峰值用 tracemalloc 单独跑一遍得到（包括进程内的模拟服务器），不影响计时。
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pop_lib
+import smtp_lib
+import storage
+from bench.fake_pop3 import FakePOP3Server, make_message, self_signed_cert, server_context
+from bench.fake_smtp import FakeSMTPServer
+from sync_engine import sync_account
+
+POP3_CAPABILITIES = ('UIDL', 'TOP')
+
+
+class Scenario:
+    """
+    一个基准场景
+    * name: 场景名，也是结果 JSON 里的键
+    * run: run(config) -> (邮件数, 字节数, 服务器往返次数, 秒数)，
+      秒数只包括客户端收发的部分，不包括启动、关闭模拟服务器
+    """
+
+    def __init__(self, name, run):
+        self.name = name
+        self.run = run
+
+
+def _pop3_server(config, capabilities, tls):
+    messages = [make_message(i, config.size) for i in range(1, config.messages + 1)]
+    tls_context = server_context(*config.cert) if tls else None
+    if tls:
+        capabilities += ('STLS',)
+    return FakePOP3Server(messages, capabilities, tls_context=tls_context, latency=config.latency).start()
+
+
+def _pop3_login(server, tls):
+    pop_conn = pop_lib.POP3('127.0.0.1', server.port)
+    if tls:
+        pop_conn.stls()
+    pop_conn.user('bench')
+    pop_conn.pass_('secret')
+    return pop_conn
+
+
+def pop3_sync(capabilities, tls=False):
+    """首次同步：UIDL 列表 + TOP 取邮件头 + 写入 SQLite"""
+    def run(config):
+        server = _pop3_server(config, capabilities, tls)
+        with tempfile.TemporaryDirectory() as directory:
+            conn = storage.connect(os.path.join(directory, 'bench.db'))
+            try:
+                server.reset_counters()
+                start = time.perf_counter()
+                pop_conn = _pop3_login(server, tls)
+                # 每次同步最多 SYNC_LIMIT 封，邮箱较大时像连续几次轮询一样分几轮取完
+                added = 0
+                complete = False
+                while not complete:
+                    count, complete = sync_account(conn, pop_conn, 'bench@example.com', batch_size=100)
+                    added += count
+                pop_conn.quit()
+                elapsed = time.perf_counter() - start
+            finally:
+                conn.close()
+                server.stop()
+        assert added == config.messages, added
+        return added, server.sent_bytes, server.round_trips, elapsed
+    return run
+
+
+def pop3_retr(tls=False):
+    """逐封 RETR 下载完整邮件，流式写到空的 sink"""
+    def run(config):
+        server = _pop3_server(config, POP3_CAPABILITIES, tls)
+        try:
+            server.reset_counters()
+            start = time.perf_counter()
+            pop_conn = _pop3_login(server, tls)
+            for num in range(1, config.messages + 1):
+                pop_conn.retr_to(num, lambda data: None)
+            pop_conn.quit()
+            elapsed = time.perf_counter() - start
+        finally:
+            server.stop()
+        return config.messages, server.sent_bytes, server.round_trips, elapsed
+    return run
+
+
+def smtp_send(options, persistent):
+    """发送 config.messages 封邮件，每封两个收件人"""
+    def run(config):
+        server = FakeSMTPServer(latency=config.latency, **options).start()
+        body = ('x' * 74 + '\n') * max(1, config.size // 75)
+        message = smtp_lib.build_message('me@example.com', ['you@example.com'], 'bench', body)
+        recipients = ['you@example.com', 'cc@example.com']
+        try:
+            start = time.perf_counter()
+            if persistent:
+                with smtp_lib.SMTPSession('127.0.0.1', server.port, 'user', 'secret') as session:
+                    session.send_many([('me@example.com', recipients, message)] * config.messages)
+            else:
+                for _ in range(config.messages):
+                    smtp_lib.send_email_via_smtp('127.0.0.1', server.port, 'user', 'secret', 'me@example.com',
+                                                 recipients, 'bench', body)
+            elapsed = time.perf_counter() - start
+        finally:
+            server.stop()
+        assert server.received == config.messages, server.received
+        return server.received, server.received_bytes, server.round_trips, elapsed
+    return run
+
+
+SCENARIOS = [
+    Scenario('pop3_sync', pop3_sync(POP3_CAPABILITIES)),
+    Scenario('pop3_sync_pipelining', pop3_sync(POP3_CAPABILITIES + ('PIPELINING',))),
+    Scenario('pop3_sync_pipelining_stls', pop3_sync(POP3_CAPABILITIES + ('PIPELINING',), tls=True)),
+    Scenario('pop3_retr', pop3_retr()),
+    Scenario('pop3_retr_stls', pop3_retr(tls=True)),
+    Scenario('smtp_connection_per_message', smtp_send(dict(esmtp=False), False)),
+    Scenario('smtp_session', smtp_send(dict(esmtp=False), True)),
+    Scenario('smtp_session_pipelining', smtp_send(dict(capabilities=('AUTH LOGIN', 'PIPELINING')), True)),
+    Scenario('smtp_session_pipelining_chunking',
+             smtp_send(dict(capabilities=('AUTH LOGIN', 'PIPELINING', 'CHUNKING')), True)),
+]
+
+
+def measure(scenario, config):
+    """跑一个场景，返回结果字典：计时一遍，另用 tracemalloc 跑一遍取内存峰值"""
+    count, size, round_trips, elapsed = scenario.run(config)
+    result = {
+        'messages': count,
+        'bytes': size,
+        'seconds': round(elapsed, 6),
+        'msgs_per_sec': round(count / elapsed, 1),
+        'bytes_per_sec': round(size / elapsed),
+        'round_trips': round_trips,
+        'round_trips_per_msg': round(round_trips / count, 3),
+    }
+    if config.memory:
+        tracemalloc.start()
+        try:
+            scenario.run(config)
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+# 越大越好的指标与越小越好的指标，--compare 时检查
+HIGHER_IS_BETTER = ('msgs_per_sec', 'bytes_per_sec')
+LOWER_IS_BETTER = ('round_trips_per_msg', 'peak_memory_bytes')
+
+
+def compare(results, baseline, tolerance):
+    """返回 [(场景, 指标, 基线值, 当前值)]，列出变差超过 tolerance 的指标"""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for key in HIGHER_IS_BETTER:
+            if key in old and key in result and result[key] < old[key] * (1 - tolerance):
+                regressions.append((name, key, old[key], result[key]))
+        for key in LOWER_IS_BETTER:
+            if key in old and key in result and result[key] > old[key] * (1 + tolerance):
+                regressions.append((name, key, old[key], result[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='POP3 / SMTP 协议基准套件')
+    parser.add_argument('--messages', type=int, default=500, help='每个场景的邮件数')
+    parser.add_argument('--size', type=int, default=4000, help='每封邮件的大小（字节）')
+    parser.add_argument('--latency', type=float, default=0.002, help='模拟的单次往返时延（秒）')
+    parser.add_argument('--quick', action='store_true', help='少量邮件快速跑一遍，用于检查套件本身')
+    parser.add_argument('--only', action='append', help='只跑名字包含这个字符串的场景，可重复')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='不测内存峰值')
+    parser.add_argument('--output', help='把结果写到这个 JSON 文件')
+    parser.add_argument('--compare', help='与这个基线 JSON 文件比较')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允许变差的比例')
+    config = parser.parse_args()
+    if config.quick:
+        config.messages = min(config.messages, 50)
+
+    scenarios = [s for s in SCENARIOS if not config.only or any(part in s.name for part in config.only)]
+    with tempfile.TemporaryDirectory() as directory:
+        config.cert = self_signed_cert(directory) if any('stls' in s.name for s in scenarios) else None
+        results = {}
+        for scenario in scenarios:
+            result = results[scenario.name] = measure(scenario, config)
+            print(f"{scenario.name:>34}: {result['msgs_per_sec']:9.1f} msg/s {result['bytes_per_sec'] / 1e6:8.2f} MB/s "
+                  f"{result['round_trips_per_msg']:6.2f} rtt/msg"
+                  + (f" {result['peak_memory_bytes'] / 1e6:7.2f} MB peak" if 'peak_memory_bytes' in result else ''))
+
+    report = {
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'messages': config.messages, 'size': config.size, 'latency': config.latency},
+        'results': results,
+    }
+    if config.output:
+        with open(config.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if config.compare:
+        with open(config.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != report['config']:
+            print(f"警告: 基线的参数 {baseline.get('config')} 与本次不同", file=sys.stderr)
+        regressions = compare(results, baseline['results'], config.tolerance)
+        for name, key, old, new in regressions:
+            print(f"回归: {name} {key} {old} -> {new}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
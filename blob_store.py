@@ -0,0 +1,221 @@
+"""
+内容寻址的压缩存储：邮件原文和附件按 SHA-256 保存为文件，内容相同的只存一份
+
+数据库里只保存邮件头和原文由哪几个块按顺序拼成（message_blobs 表），
+同一个附件转发、回复多次时，各封邮件引用同一个块。
+"""
+import email.parser
+import email.policy
+import hashlib
+import mmap
+import os
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+    HAVE_ZSTD = True
+except ImportError:
+    HAVE_ZSTD = False
+
+# 块文件第一个字节表示压缩方式
+RAW = b'n'
+ZLIB = b'z'
+ZSTD = b's'
+
+# 不小于这个大小的块文件用 mmap 读取，不经过 read() 的缓冲区复制
+MMAP_THRESHOLD = 1 << 16
+
+# 编码后不小于这个大小的附件单独存一块，可以在邮件之间去重
+ATTACHMENT_MIN_SIZE = 4096
+
+# gc 不删除修改时间在这么多秒以内的块：它们可能刚写入、引用还没提交
+GC_GRACE = 3600
+
+
+class BlobStore:
+    """
+    按内容寻址的块存储
+    * directory: 存储目录，块按 SHA-256 前两位分到子目录
+    * codec: 'zstd'、'zlib' 或 'none'（不压缩），默认有 zstandard 模块时用 zstd
+    * level: 压缩级别
+    压缩后没有明显变小的块（图片、压缩包等）原样保存。多个线程、进程可以同时使用。
+    """
+
+    def __init__(self, directory, codec=None, level=None):
+        if codec is None:
+            codec = 'zstd' if HAVE_ZSTD else 'zlib'
+        if codec == 'zstd' and not HAVE_ZSTD:
+            raise ValueError('zstd 压缩需要 zstandard 模块')
+        self.directory = directory
+        self.codec = codec
+        self.level = level
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def _compress(self, data):
+        if self.codec == 'zstd':
+            return ZSTD, zstandard.ZstdCompressor(level=self.level or 3).compress(data)
+        if self.codec == 'zlib':
+            return ZLIB, zlib.compress(data, 6 if self.level is None else self.level)
+        return RAW, data
+
+    def put(self, data):
+        """保存一块数据，返回它的 key（SHA-256 十六进制）；已有相同内容时不重复写入"""
+        key = hashlib.sha256(data).hexdigest()
+        path = self._path(key)
+        try:
+            # 已存在：更新修改时间，gc 不会在引用提交前删掉它
+            os.utime(path)
+            return key
+        except FileNotFoundError:
+            pass
+        tag, packed = self._compress(data)
+        if len(packed) >= len(data) * 0.95:
+            tag, packed = RAW, data
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再改名，读到的不会是写了一半的文件；并发写入同一块时内容相同，谁覆盖谁都可以
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(tag)
+            f.write(packed)
+        os.replace(tmp, path)
+        return key
+
+    def get(self, key):
+        """读取一块数据，不存在时抛出 KeyError"""
+        try:
+            f = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key) from None
+        with f:
+            if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+                return self._unpack(memoryview(f.read()))
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    return self._unpack(view)
+                finally:
+                    view.release()
+
+    def _unpack(self, view):
+        tag, payload = bytes(view[:1]), view[1:]
+        try:
+            if tag == RAW:
+                return bytes(payload)
+            if tag == ZLIB:
+                return zlib.decompress(payload)
+            if tag == ZSTD:
+                if not HAVE_ZSTD:
+                    raise ValueError('读取 zstd 压缩的块需要 zstandard 模块')
+                return zstandard.ZstdDecompressor().decompress(payload)
+            raise ValueError(f'未知的块格式 {tag!r}')
+        finally:
+            payload.release()
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def keys(self):
+        """遍历所有块的 (key, 文件大小, 修改时间)"""
+        for prefix in os.scandir(self.directory):
+            if not prefix.is_dir() or len(prefix.name) != 2:
+                continue
+            for entry in os.scandir(prefix.path):
+                if not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    yield prefix.name + entry.name, stat.st_size, stat.st_mtime
+
+    def gc(self, live, grace=GC_GRACE):
+        """
+        删除不在 live 中的块，返回 (删除的块数, 释放的字节数)
+        * live: 仍被引用的 key 集合
+        * grace: 最近 grace 秒内写入或复用过的块不删除
+        """
+        cutoff = time.time() - grace
+        removed = freed = 0
+        for key, size, mtime in list(self.keys()):
+            if key in live or mtime > cutoff:
+                continue
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += size
+        return removed, freed
+
+
+def split_message(raw):
+    """
+    把邮件原文切成几段，拼起来与原文完全相同：较大附件的正文（编码后的内容）各自成段，
+    其余部分（邮件头、正文、MIME 分隔行）按顺序夹在中间
+    * raw: 邮件原文（bytes）
+    """
+    message = email.parser.BytesParser(policy=email.policy.compat32).parsebytes(raw)
+    segments = []
+    pos = 0
+    for part in message.walk():
+        if part.is_multipart() or part is message:
+            continue
+        if part.get_content_disposition() != 'attachment' and part.get_content_maintype() == 'text':
+            continue
+        payload = part.get_payload()
+        if not isinstance(payload, str) or len(payload) < ATTACHMENT_MIN_SIZE:
+            continue
+        body = payload.encode('ascii', 'surrogateescape')
+        # 解析器保留了原始字节和换行，在原文里按顺序找到这一段；找不到时这个附件不单独存
+        start = raw.find(body, pos)
+        if start < 0:
+            continue
+        segments.append(raw[pos:start])
+        segments.append(body)
+        pos = start + len(body)
+    segments.append(raw[pos:])
+    return [segment for segment in segments if segment]
+
+
+class MessageStore:
+    """
+    邮件原文的存取：块在 BlobStore 里，引用在 message_blobs 表里
+    * conn: 本线程的 storage.connect() 连接
+    * blobs: BlobStore
+    """
+
+    def __init__(self, conn, blobs):
+        self.conn = conn
+        self.blobs = blobs
+
+    def put(self, email_id, raw):
+        """保存一封邮件的原文，附件按内容去重"""
+        keys = [self.blobs.put(segment) for segment in split_message(raw)]
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO message_blobs (email_id, blob_keys, size, stored) VALUES (?, ?, ?, ?)',
+                              (email_id, ' '.join(keys), len(raw), time.time()))
+
+    def get(self, email_id):
+        """返回邮件原文，没有保存过或块已丢失时返回 None"""
+        row = self.conn.execute('SELECT blob_keys FROM message_blobs WHERE email_id = ?', (email_id,)).fetchone()
+        if row is None:
+            return None
+        try:
+            return b''.join(self.blobs.get(key) for key in row[0].split())
+        except KeyError:
+            return None
+
+    def gc(self, grace=GC_GRACE):
+        """
+        清理：先删除邮件已不存在的引用，再删除没有被引用的块
+        返回 (删除的引用数, 删除的块数, 释放的字节数)
+        """
+        with self.conn:
+            orphans = self.conn.execute(
+                'DELETE FROM message_blobs WHERE email_id NOT IN (SELECT email_id FROM emails)').rowcount
+        live = set()
+        for (keys,) in self.conn.execute('SELECT blob_keys FROM message_blobs'):
+            live.update(keys.split())
+        removed, freed = self.blobs.gc(live, grace)
+        return orphans, removed, freed
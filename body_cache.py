@@ -0,0 +1,272 @@
+import email
+import email.policy
+import hashlib
+import heapq
+import io
+import itertools
+import os
+import threading
+from collections import OrderedDict
+
+import pop_lib
+import storage
+from blob_store import MessageStore
+from mime_parse import parse_headers
+from outbox import parse_server
+from pop_pool import POP3Pool
+from sync_engine import UidlSync
+
+
+def decode_body(raw):
+    """
+    从邮件原文中取出用于显示的正文：优先 text/plain，其次 text/html，按声明的字符集解码
+    * raw: RETR 得到的邮件原文（bytes）
+    """
+    message = email.message_from_bytes(raw, policy=email.policy.default)
+    part = message.get_body(preferencelist=('plain', 'html'))
+    if part is None:
+        return ''
+    try:
+        text = part.get_content()
+    except (LookupError, UnicodeError, KeyError):
+        # 未知或写错的字符集
+        payload = part.get_payload(decode=True) or b''
+        text = payload.decode('utf-8', 'replace')
+    return text.replace('\r\n', '\n')
+
+
+class BodyCache:
+    """
+    解码后正文的两级 LRU 缓存：内存里保留最近打开的，磁盘上保留更多，两级都有容量上限
+    * directory: 磁盘缓存目录，每封邮件一个文件
+    * memory_bytes / disk_bytes: 两级缓存的容量（按 UTF-8 字节数计）
+    多个线程可以同时使用。
+    """
+
+    def __init__(self, directory, memory_bytes=16 << 20, disk_bytes=256 << 20):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()   # email_id -> (正文, 字节数)
+        self.memory_used = 0
+        self.disk = OrderedDict()     # 文件名 -> 字节数，按最近使用排序
+        self.disk_used = 0
+        os.makedirs(directory, exist_ok=True)
+        # 启动时按修改时间恢复磁盘上的 LRU 顺序，读取命中时会更新修改时间
+        entries = sorted((entry for entry in os.scandir(directory) if entry.name.endswith('.txt')),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            size = entry.stat().st_size
+            self.disk[entry.name] = size
+            self.disk_used += size
+
+    def _filename(self, email_id):
+        return hashlib.sha1(email_id.encode('utf-8', 'surrogateescape')).hexdigest() + '.txt'
+
+    def get(self, email_id):
+        """返回缓存的正文，没有时返回 None"""
+        with self.lock:
+            item = self.memory.get(email_id)
+            if item is not None:
+                self.memory.move_to_end(email_id)
+                return item[0]
+            name = self._filename(email_id)
+            if name not in self.disk:
+                return None
+            self.disk.move_to_end(name)
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.disk_used -= self.disk.pop(name, 0)
+            return None
+        text = data.decode('utf-8', 'surrogateescape')
+        with self.lock:
+            self._remember(email_id, text, len(data))
+        return text
+
+    def put(self, email_id, text):
+        data = text.encode('utf-8', 'surrogateescape')
+        name = self._filename(email_id)
+        path = os.path.join(self.directory, name)
+        # 先写临时文件再改名，读到的不会是写了一半的文件
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        with self.lock:
+            self._remember(email_id, text, len(data))
+            self.disk_used += len(data) - self.disk.pop(name, 0)
+            self.disk[name] = len(data)
+            expired = []
+            while self.disk_used > self.disk_bytes and len(self.disk) > 1:
+                old, size = self.disk.popitem(last=False)
+                self.disk_used -= size
+                expired.append(old)
+        for old in expired:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+
+    def _remember(self, email_id, text, size):
+        old = self.memory.pop(email_id, None)
+        if old is not None:
+            self.memory_used -= old[1]
+        self.memory[email_id] = (text, size)
+        self.memory_used += size
+        while self.memory_used > self.memory_bytes and len(self.memory) > 1:
+            self.memory_used -= self.memory.popitem(last=False)[1][1]
+
+
+# 请求的优先级：用户打开的邮件先于预取
+OPEN = 0
+PREFETCH = 1
+
+
+class BodyLoader:
+    """
+    按需下载正文的后台线程：同步时只取邮件头，打开邮件时才 RETR，结果放进 BodyCache
+    * db_path: 数据库路径，线程使用独立连接
+    * cache: BodyCache
+    * pool: 共享的 POP3Pool，紧挨着的几次下载复用同一个已登录的会话
+    * on_loaded: on_loaded(email_id, text, error)，在下载线程中调用；找不到邮件时 text 为 None
+    * blobs: blob_store.BlobStore，给出时下载的原文保存在本地，之后（包括从服务器删除后）直接从本地解码
+    只用一个线程：很多服务器同一邮箱同时只允许一个会话，顺序 RETR 也不比并发慢。
+    """
+
+    def __init__(self, db_path, cache, pool=None, on_loaded=None, blobs=None):
+        self.db_path = db_path
+        self.cache = cache
+        self.pool = pool if pool is not None else POP3Pool()
+        self.on_loaded = on_loaded
+        self.blobs = blobs
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.queue = []      # (优先级, 序号, email_id)
+        self.queued = {}     # email_id -> 已排队的最高优先级
+        self.counter = itertools.count()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='body-loader', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def request(self, email_id, priority=OPEN):
+        """
+        请求下载正文；已在缓存中的邮件不会重复下载。
+        打开新邮件时先前排队的预取会让路给它。
+        """
+        if self.cache.get(email_id) is not None:
+            return
+        with self.cond:
+            if self.queued.get(email_id, PREFETCH + 1) <= priority:
+                return
+            self.queued[email_id] = priority
+            heapq.heappush(self.queue, (priority, next(self.counter), email_id))
+            self.cond.notify()
+
+    def prefetch(self, email_ids):
+        for email_id in email_ids:
+            self.request(email_id, PREFETCH)
+
+    def _take(self):
+        with self.cond:
+            while not self.stopping:
+                while self.queue:
+                    priority, _, email_id = heapq.heappop(self.queue)
+                    # 同一封邮件可能以更高优先级重复排队，只处理一次
+                    if self.queued.get(email_id) == priority:
+                        del self.queued[email_id]
+                        return email_id
+                self.cond.wait()
+            return None
+
+    def _run(self):
+        conn = storage.connect(self.db_path)
+        try:
+            while True:
+                email_id = self._take()
+                if email_id is None:
+                    return
+                if self.cache.get(email_id) is not None:
+                    continue
+                try:
+                    text = self.fetch(conn, email_id)
+                except Exception as e:
+                    print(f"正文下载失败: {e}")
+                    self._loaded(email_id, None, str(e))
+                    continue
+                if text is not None:
+                    self.cache.put(email_id, text)
+                self._loaded(email_id, text, None)
+        finally:
+            conn.close()
+
+    def _loaded(self, email_id, text, error):
+        if self.on_loaded is not None:
+            self.on_loaded(email_id, text, error)
+
+    def fetch(self, conn, email_id):
+        """
+        取得一封邮件并解码正文：本地保存过原文时直接读取，否则从服务器下载；
+        邮件不是通过 UIDL 同步的或已从服务器删除时返回 None
+        解码后的正文同时写进 emails 表，之后可以按正文搜索到这封邮件。
+        """
+        messages = MessageStore(conn, self.blobs) if self.blobs is not None else None
+        raw = messages.get(email_id) if messages is not None else None
+        if raw is None:
+            raw = self.download(conn, email_id)
+            if raw is None:
+                return None
+            if messages is not None:
+                messages.put(email_id, raw)
+        text = decode_body(raw)
+        storage.MailStore(conn).set_body(email_id, text)
+        return text
+
+    def download(self, conn, email_id):
+        """从服务器 RETR 一封邮件的原文，找不到时返回 None"""
+        row = conn.execute('''
+            SELECT uidl_state.account, uidl_state.uid, uidl_state.msg_num, accounts.password, accounts.pop_server
+            FROM uidl_state JOIN accounts ON accounts.email = uidl_state.account
+            WHERE uidl_state.email_id = ? LIMIT 1
+        ''', (email_id,)).fetchone()
+        if row is None:
+            return None
+        account, uid, msg_num, password, pop_server = row
+        host, port = parse_server(pop_server, pop_lib.POP3_SSL_PORT)
+        with self.pool.session(host, account, password, port) as pop_conn:
+            num = self._locate(conn, account, pop_conn, uid, msg_num)
+            if num is None:
+                return None
+            buf = io.BytesIO()
+            pop_conn.retr_to(num, buf.write)
+        return buf.getvalue()
+
+    def _locate(self, conn, account, pop_conn, uid, msg_num):
+        # 邮件序号在会话之间可能变化：先验证同步时记下的序号，不对再取完整列表。
+        # 不支持 UIDL 的服务器上 uid 是 Message-ID（见 UidlSync.listing），用 TOP n 0 验证
+        try:
+            parts = pop_conn.uidl(msg_num).split()
+            if len(parts) >= 3 and parts[2].decode('ascii', 'replace') == uid:
+                return msg_num
+        except pop_lib.error_proto:
+            try:
+                _, lines, _ = pop_conn.top(msg_num, 0)
+                if parse_headers(b'\r\n'.join(lines))[0] == uid:
+                    return msg_num
+            except pop_lib.error_proto:
+                pass
+        return UidlSync(conn, account).listing(pop_conn).get(uid)
@@ -0,0 +1,440 @@
+import json
+from collections import OrderedDict
+
+from PyQt5.QtCore import QAbstractItemModel, QAbstractListModel, QModelIndex, Qt
+
+import storage
+from thread_index import ThreadIndex
+
+
+class MailboxModel(QAbstractListModel):
+    """
+    收件箱列表模型：只从 SQLite 分页读取邮件头，不读取正文。
+    * conn: SQLite 连接
+    * page_size: 每页行数，fetchMore 每次多暴露一页
+    * max_pages: 内存中最多缓存的页数，滚动到别处时旧页会被丢弃
+    邮件按插入顺序从新到旧显示，所有账户的邮件合并在一起；setSearch() 之后改为显示全文搜索结果，按相关度排序。
+    完整列表与 ThreadModel 一样按 rowid 定位每一页（WHERE rowid < ? ORDER BY rowid DESC LIMIT ?），翻到后面不会变慢。
+    """
+
+    def __init__(self, conn, page_size=200, max_pages=8, parent=None):
+        super().__init__(parent)
+        self.conn = conn
+        self.store = storage.MailStore(conn)
+        self.search = None
+        self.exhausted = False
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.bounds = {}                # 页号 -> 该页最旧一行的 rowid（负数页号为最新一行的）
+        self.total = self._count()
+        self.loaded = 0
+        # 打开或重新加载时最新一封的 rowid，第 0 页从它开始往下数；之后同步到的 head 封排在它上面，
+        # 按负数页号从 anchor 往上数，已经读过的页和 bounds 不会因为插入新邮件而错位
+        self.anchor = self._anchor()
+        self.head = 0
+        self.fetching = False           # 同 ThreadModel
+
+    def _count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM emails').fetchone()[0]
+
+    def _anchor(self):
+        return self.conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM emails').fetchone()[0]
+
+    def _locate(self, row):
+        """第 row 行所在的页号和在该页里的位置"""
+        if row >= self.head:
+            return divmod(row - self.head, self.page_size)
+        # anchor 上面的新邮件从 anchor 往上分页，最上面一页可能不满
+        number = -((self.head - 1 - row) // self.page_size) - 1
+        page = self._page(number)
+        return number, len(page) - 1 - (self.head + (number + 1) * self.page_size - 1 - row)
+
+    def _page(self, number):
+        page = self.pages.get(number)
+        if page is not None:
+            self.pages.move_to_end(number)
+            return page
+        if self.search:
+            page = self.store.search(self.search, self.page_size, number * self.page_size)
+        else:
+            query = 'SELECT email_id, sender, subject, date, account, rowid FROM emails WHERE {where} ORDER BY rowid {order} LIMIT ? {offset}'
+            if number >= 0:
+                # 按上一页最后一行的 rowid 定位下一页，直接拖动滚动条跳过了前一页时才用 OFFSET
+                if number > 0 and number - 1 in self.bounds:
+                    rows = self.conn.execute(query.format(where='rowid < ?', order='DESC', offset=''),
+                                             (self.bounds[number - 1], self.page_size)).fetchall()
+                else:
+                    rows = self.conn.execute(query.format(where='rowid <= ?', order='DESC', offset='OFFSET ?'),
+                                             (self.anchor, self.page_size, number * self.page_size)).fetchall()
+            else:
+                if number < -1 and number + 1 in self.bounds:
+                    rows = self.conn.execute(query.format(where='rowid > ?', order='ASC', offset=''),
+                                             (self.bounds[number + 1], self.page_size)).fetchall()
+                else:
+                    rows = self.conn.execute(query.format(where='rowid > ?', order='ASC', offset='OFFSET ?'),
+                                             (self.anchor, self.page_size, (-number - 1) * self.page_size)).fetchall()
+                rows.reverse()
+            if rows:
+                self.bounds[number] = rows[-1 if number >= 0 else 0][-1]
+            page = [row[:-1] for row in rows]
+        self.pages[number] = page
+        if len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+        return page
+
+    def header(self, row):
+        """返回第 row 行的 (email_id, sender, subject, date, account)"""
+        number, offset = self._locate(row)
+        return self._page(number)[offset]
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.loaded
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return False
+        if self.search:
+            return not self.exhausted
+        return self.loaded < self.total
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.fetching:
+            return
+        if self.search:
+            # 搜索结果的总数未知，取到不满一页为止
+            count = len(self._page(self.loaded // self.page_size))
+            self.exhausted = count < self.page_size
+        else:
+            count = min(self.page_size, self.total - self.loaded)
+        if count <= 0:
+            return
+        self.fetching = True
+        try:
+            self.beginInsertRows(QModelIndex(), self.loaded, self.loaded + count - 1)
+            self.loaded += count
+            self.endInsertRows()
+        finally:
+            self.fetching = False
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.loaded:
+            return None
+        if role == Qt.DisplayRole:
+            email_id, sender, subject, date, account = self.header(index.row())
+            text = f"Subject: {subject}  ,From: {sender}  ,Date: {date}"
+            if account:
+                text = f"[{account}] " + text
+            return text
+        if role == Qt.UserRole:
+            return self.header(index.row())[0]
+        return None
+
+    def prependRows(self, count):
+        """后台同步写入了 count 封新邮件，它们显示在列表最上面"""
+        if count <= 0:
+            return
+        if self.search:
+            self.reload()
+            return
+        self.fetching = True
+        try:
+            self.beginInsertRows(QModelIndex(), 0, count - 1)
+            # 已经读过的页都还有效，只有最上面不满的一页要重新读
+            if self.head % self.page_size:
+                number = -((self.head - 1) // self.page_size) - 1
+                self.pages.pop(number, None)
+                self.bounds.pop(number, None)
+            self.head += count
+            self.total += count
+            self.loaded += count
+            self.endInsertRows()
+        finally:
+            self.fetching = False
+
+    def setSearch(self, text):
+        """设置搜索文字，空字符串恢复为完整列表"""
+        self.search = text.strip() or None
+        self.reload()
+
+    def reload(self):
+        self.beginResetModel()
+        self.pages.clear()
+        self.bounds.clear()
+        self.exhausted = False
+        self.total = self._count()
+        self.loaded = 0
+        self.anchor = self._anchor()
+        self.head = 0
+        self.endResetModel()
+
+
+class ThreadModel(QAbstractItemModel):
+    """
+    按会话显示的收件箱：第一层每个会话一行，按最新一封邮件的到达顺序从新到旧，展开后是会话里的邮件。
+    第一层直接分页读取 threads 表，按已加载的最后一行的 last_seq 定位下一页（不用 OFFSET），
+    每页的开销与会话里有多少邮件、翻到了第几页都无关；展开时才读取会话里的邮件。
+    * conn: SQLite 连接
+    * page_size / max_pages: 同 MailboxModel
+    * max_threads: 内存中最多缓存多少个展开过的会话的邮件列表
+    升级前收到的邮件要先用 ThreadIndex.catch_up() 补进索引才会显示，见 main.py。
+    """
+
+    def __init__(self, conn, page_size=200, max_pages=8, max_threads=64, parent=None):
+        super().__init__(parent)
+        self.conn = conn
+        self.threads = ThreadIndex(conn)
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.max_threads = max_threads
+        self.order = []                 # 已加载的各行的 thread_id
+        self.rows = None                # thread_id -> 行号，order 变化后按需重建
+        self.heads = OrderedDict()      # thread_id -> (subject, message_count, email_id, sender, date, account)
+        self.children = OrderedDict()   # thread_id -> ThreadIndex.messages()
+        self.sizes = {}                 # thread_id -> 已经告诉视图的子行数
+        self.total = self._count()
+        self.top = self.conn.execute('SELECT COALESCE(MAX(last_seq), 0) FROM threads').fetchone()[0]
+        self.tail = self.top + 1        # 已加载的最后一行的 last_seq，之后移到最上面的会话不会再被 fetchMore 读到
+        # 正在发出插入、移动行的信号；收到信号的对象（例如 QAbstractItemModelTester）这时调用 fetchMore 直接返回
+        self.fetching = False
+
+    _HEADS = '''
+        SELECT threads.thread_id, threads.subject, threads.message_count, emails.email_id, emails.sender, emails.date, emails.account,
+               threads.last_seq
+        FROM threads JOIN emails ON emails.email_id = threads.last_email_id
+    '''
+
+    def _count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM threads').fetchone()[0]
+
+    def _cache(self, rows):
+        for row in rows:
+            self.heads[row[0]] = row[1:-1]
+            self.heads.move_to_end(row[0])
+        while len(self.heads) > self.page_size * self.max_pages:
+            self.heads.popitem(last=False)
+
+    def _row(self, thread_id):
+        """已加载的会话所在的行号，没有加载时返回 None"""
+        if self.rows is None:
+            self.rows = {thread_id: row for row, thread_id in enumerate(self.order)}
+        return self.rows.get(thread_id)
+
+    @property
+    def loaded(self):
+        return len(self.order)
+
+    def thread(self, row):
+        """返回第 row 个会话的 (thread_id, subject, message_count, 最新邮件的 email_id, sender, date, account)"""
+        thread_id = self.order[row]
+        head = self.heads.get(thread_id)
+        if head is None:
+            # 缓存里被挤掉了，按行号重新读取所在的一页
+            start = row // self.page_size * self.page_size
+            ids = self.order[start:start + self.page_size]
+            self._cache(self.conn.execute(self._HEADS + f'WHERE threads.thread_id IN ({",".join("?" * len(ids))})',
+                                          ids).fetchall())
+            # 刚被合并掉的会话 prependRows 正在逐行删除，删除信号发出期间仍可能被读取
+            head = self.heads.get(thread_id, (None, 0, None, None, None, None))
+        else:
+            self.heads.move_to_end(thread_id)
+        return (thread_id,) + head
+
+    def messages(self, thread_id):
+        """会话里的邮件 [(email_id, sender, subject, date, account, depth)]"""
+        messages = self.children.get(thread_id)
+        if messages is None:
+            messages = self.children[thread_id] = self.threads.messages(thread_id)
+            if len(self.children) > self.max_threads:
+                self.children.popitem(last=False)
+        else:
+            self.children.move_to_end(thread_id)
+        return messages
+
+    # 第一层的 internalId 为 0，第二层为所属会话的 thread_id，会话移动位置后子行的索引仍然有效
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if parent.isValid():
+            return self.createIndex(row, column, self.order[parent.row()])
+        return self.createIndex(row, column, 0)
+
+    def parent(self, index):
+        if not index.isValid() or index.internalId() == 0:
+            return QModelIndex()
+        return self.createIndex(self._row(index.internalId()), 0, 0)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return self.loaded > 0
+        if parent.internalId() != 0 or parent.row() >= self.loaded:
+            return False
+        return self.thread(parent.row())[2] > 1
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return self.loaded
+        if parent.internalId() != 0 or parent.row() >= self.loaded:
+            return 0
+        thread_id = self.order[parent.row()]
+        if thread_id not in self.sizes:
+            self.sizes[thread_id] = len(self.messages(thread_id)) if self.hasChildren(parent) else 0
+        return self.sizes[thread_id]
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return False
+        return self.loaded < self.total
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.fetching:
+            return
+        rows = self.conn.execute(self._HEADS + 'WHERE threads.last_seq < ? ORDER BY threads.last_seq DESC LIMIT ?',
+                                 (self.tail, self.page_size)).fetchall()
+        if not rows:
+            self.total = self.loaded
+            return
+        self.fetching = True
+        try:
+            self.beginInsertRows(QModelIndex(), self.loaded, self.loaded + len(rows) - 1)
+            self.order.extend(row[0] for row in rows)
+            self.rows = None
+            self._cache(rows)
+            self.tail = rows[-1][-1]
+            self.endInsertRows()
+        finally:
+            self.fetching = False
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if index.internalId() == 0:
+            if index.row() >= self.loaded:
+                return None
+            thread_id, subject, count, email_id, sender, date, account = self.thread(index.row())
+            depth = 0
+        else:
+            messages = self.messages(index.internalId())
+            if index.row() >= len(messages):
+                return None
+            email_id, sender, subject, date, account, depth = messages[index.row()]
+            count = 1
+        if role == Qt.DisplayRole:
+            text = f"Subject: {subject}  ,From: {sender}  ,Date: {date}"
+            if count > 1:
+                text = f"({count}) " + text
+            if account:
+                text = f"[{account}] " + text
+            return '    ' * depth + text
+        if role == Qt.UserRole:
+            # 会话行对应最新的一封
+            return email_id
+        return None
+
+    def prependRows(self, count):
+        """
+        后台同步写入了新邮件：有新邮件的会话移到最上面，新会话插在最上面，被合并掉的会话删除，
+        展开过的会话插入新的子行。只发出移动、插入、删除信号，不重置模型，展开状态、选中行和滚动位置都保留。
+        """
+        if count <= 0:
+            return
+        changed = self.conn.execute('SELECT thread_id, last_seq FROM threads WHERE last_seq > ? ORDER BY last_seq',
+                                    (self.top,)).fetchall()
+        if not changed:
+            return
+        self.fetching = True
+        try:
+            self._prepend(changed)
+        finally:
+            self.fetching = False
+
+    def _prepend(self, changed):
+        # 一封邮件连起几个会话时较小的会话被删掉（ThreadIndex._merge），已加载的要从列表里去掉
+        gone = [row[0] for row in self.conn.execute(
+            'SELECT value FROM json_each(?) WHERE NOT EXISTS (SELECT 1 FROM threads WHERE thread_id = value)',
+            (json.dumps(self.order),))]
+        for thread_id in gone:
+            row = self._row(thread_id)
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.order[row]
+            self.rows = None
+            self._forget(thread_id)
+            self.endRemoveRows()
+
+        for thread_id, _ in changed:
+            # 从旧到新逐个移到第 0 行，最后最新的在最上面
+            row = self._row(thread_id)
+            self.heads.pop(thread_id, None)
+            if row is None:
+                self._forget(thread_id)
+                self.beginInsertRows(QModelIndex(), 0, 0)
+                self.order.insert(0, thread_id)
+                self.rows = None
+                self.endInsertRows()
+                continue
+            if row > 0:
+                self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), 0)
+                del self.order[row]
+                self.order.insert(0, thread_id)
+                self.rows = None
+                self.endMoveRows()
+            self._updateChildren(thread_id)
+            self.dataChanged.emit(self.index(0, 0), self.index(0, 0))
+        self.top = changed[-1][1]
+        self.total = self._count()
+
+    def _forget(self, thread_id):
+        self.heads.pop(thread_id, None)
+        self.children.pop(thread_id, None)
+        self.sizes.pop(thread_id, None)
+
+    def _updateChildren(self, thread_id):
+        # 视图只知道 rowCount() 报告过的子行数；没有报告过的不用通知，展开时会重新询问
+        size = self.sizes.get(thread_id)
+        if size is None:
+            self.children.pop(thread_id, None)
+            return
+        old = [message[0] for message in self.children.pop(thread_id, ())]
+        messages = self.children[thread_id] = self.threads.messages(thread_id)
+        if len(self.children) > self.max_threads:
+            self.children.popitem(last=False)
+        parent = self.index(self._row(thread_id), 0)
+        new = [message[0] for message in messages]
+        known = set(old)
+        if len(old) == size and [email_id for email_id in new if email_id in known] == old:
+            # 会话里的邮件按 seq 排列，新邮件通常排在最后，已有的行顺序不变，逐行插入
+            for row, email_id in enumerate(new):
+                if email_id not in known:
+                    self.beginInsertRows(parent, row, row)
+                    self.sizes[thread_id] += 1
+                    self.endInsertRows()
+        else:
+            if size:
+                self.beginRemoveRows(parent, 0, size - 1)
+                self.sizes[thread_id] = 0
+                self.endRemoveRows()
+            if new:
+                self.beginInsertRows(parent, 0, len(new) - 1)
+                self.sizes[thread_id] = len(new)
+                self.endInsertRows()
+        if new:
+            # 占位的上级邮件到达后，已有子行的缩进可能变化
+            self.dataChanged.emit(self.index(0, 0, parent), self.index(len(new) - 1, 0, parent))
+
+    def reload(self):
+        self.beginResetModel()
+        self.order.clear()
+        self.rows = None
+        self.heads.clear()
+        self.children.clear()
+        self.sizes.clear()
+        self.total = self._count()
+        self.top = self.conn.execute('SELECT COALESCE(MAX(last_seq), 0) FROM threads').fetchone()[0]
+        self.tail = self.top + 1
+        self.endResetModel()
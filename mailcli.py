@@ -0,0 +1,298 @@
+"""
+不依赖 PyQt 的命令行入口：收信、发件箱投递写入与图形界面相同的 SQLite 数据库
+
+    python mailcli.py sync [--account a@example.com] [--check] [--json]
+    python mailcli.py send --account a@example.com --to b@example.com --subject 标题 < 正文.txt
+    python mailcli.py deliver
+    python mailcli.py daemon [--min-interval 30] [--max-interval 900]
+    python mailcli.py accounts
+    python mailcli.py add-account a@example.com --smtp smtp.example.com:587 --pop pop.example.com:995
+    python mailcli.py --metrics metrics.prom daemon
+    python mailcli.py gc [--vacuum]
+
+--json 时每个事件输出一行 JSON，其余提示信息写到 stderr。
+--metrics 记录命令耗时、传输字节数和数据库写入耗时，见 metrics.py；daemon 每轮结束时写出一次。
+退出码：0 成功，1 有账户同步失败或有邮件没能发出（包括等待重试的），2 参数错误或没有可用的账户。
+"""
+import argparse
+import contextlib
+import getpass
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+import metrics
+import storage
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+
+class Reporter:
+    """
+    输出事件：--json 时一行一个 JSON 对象，否则为 "事件 key=value ..." 形式的文本行
+    * json_lines: 是否输出 JSON
+    * stream: 输出流，多个线程可以同时调用 emit()
+    """
+
+    def __init__(self, json_lines, stream):
+        self.json_lines = json_lines
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        if self.json_lines:
+            line = json.dumps({'event': event, 'time': round(time.time(), 3), **fields}, ensure_ascii=False)
+        else:
+            line = ' '.join([event] + [f'{key}={value}' for key, value in fields.items() if value is not None])
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+
+def load_accounts(conn, emails=None):
+    """[(email, password, pop_server)]，emails 不为空时只取其中的账户"""
+    accounts = conn.execute('SELECT email, password, pop_server FROM accounts ORDER BY email').fetchall()
+    if emails:
+        accounts = [account for account in accounts if account[0] in emails]
+    return accounts
+
+
+def report_sync(reporter, results):
+    """输出每个账户的同步结果，返回是否全部成功"""
+    ok = True
+    for email, result in sorted(results.items()):
+        if isinstance(result, Exception):
+            ok = False
+            reporter.emit('sync_failed', account=email, error=str(result))
+        else:
+            reporter.emit('synced', account=email, added=result)
+    return ok
+
+
+def cmd_sync(args, reporter):
+    from mime_parse import ParserPool
+    from sync_scheduler import SyncScheduler
+
+    conn = storage.connect(args.db)
+    accounts = load_accounts(conn, args.account)
+    conn.close()
+    if not accounts:
+        reporter.emit('error', error='no accounts')
+        return EXIT_USAGE
+    parser = ParserPool()
+    scheduler = SyncScheduler(args.db, workers=args.workers, per_server=args.per_server, parser=parser)
+    try:
+        results = scheduler.run(accounts, check=args.check)
+    finally:
+        scheduler.pool.close_all()
+        parser.close()
+    return EXIT_OK if report_sync(reporter, results) else EXIT_FAILED
+
+
+def _delivery_pool(args, reporter, states):
+    from outbox import DeliveryPool
+
+    def on_status(outbox_id, status, error):
+        states[outbox_id] = status
+        reporter.emit('outbox', id=outbox_id, status=status, error=error)
+
+    return DeliveryPool(args.db, on_status=on_status)
+
+
+def cmd_deliver(args, reporter):
+    from outbox import SENT
+
+    states = {}
+    count = _delivery_pool(args, reporter, states).deliver_due()
+    # 没发出去的包括永久失败的和等待重试的
+    unsent = sum(status != SENT for status in states.values())
+    reporter.emit('delivered', count=count, sent=count - unsent, unsent=unsent)
+    return EXIT_FAILED if unsent else EXIT_OK
+
+
+def cmd_send(args, reporter):
+    from outbox import Outbox
+
+    conn = storage.connect(args.db)
+    try:
+        row = conn.execute('SELECT smtp_server FROM accounts WHERE email = ?', (args.account,)).fetchone()
+        if row is None:
+            reporter.emit('error', error=f'unknown account {args.account}')
+            return EXIT_USAGE
+        body = args.body if args.body is not None else sys.stdin.read()
+        outbox_id = Outbox(conn).enqueue(args.account, row[0], args.account, args.to, args.subject, body)
+    finally:
+        conn.close()
+    reporter.emit('queued', id=outbox_id)
+    if args.queue_only:
+        return EXIT_OK
+    return cmd_deliver(args, reporter)
+
+
+def cmd_daemon(args, reporter):
+    from mime_parse import ParserPool
+    from poll_policy import PollPolicy
+    from pop_pool import POP3Pool
+    from sync_scheduler import SyncScheduler
+
+    stop = threading.Event()
+    current = []
+
+    def on_signal(signum, frame):
+        reporter.emit('stopping', signal=signum)
+        stop.set()
+        for scheduler in current:
+            scheduler.cancel()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    policy = PollPolicy(min_interval=args.min_interval, max_interval=args.max_interval)
+    pool = POP3Pool(next_use=policy.due.get)
+    parser = ParserPool()
+    delivery = _delivery_pool(args, reporter, {})
+    delivery.start()
+    conn = storage.connect(args.db)
+    reporter.emit('started', pid=os.getpid(), db=args.db)
+    try:
+        while not stop.is_set():
+            accounts = load_accounts(conn, args.account)
+            due = set(policy.due_accounts([account[0] for account in accounts]))
+            accounts = [account for account in accounts if account[0] in due]
+            if accounts:
+                scheduler = SyncScheduler(args.db, pool, args.workers, args.per_server, parser=parser,
+                                          fingerprints=policy.fingerprints)
+                current[:] = [scheduler]
+                results = scheduler.run(accounts, check=True)
+                current[:] = []
+                report_sync(reporter, results)
+                for email, _, _ in accounts:
+                    result = results.get(email)
+                    policy.record(email, isinstance(result, int) and result > 0)
+                # 新写入的发件箱邮件（例如另一个进程执行了 send --queue-only）
+                delivery.wake()
+            if metrics.sink is not None:
+                metrics.sink.flush()
+            stop.wait(policy.next_wait() if policy.due else args.min_interval)
+    finally:
+        delivery.stop(timeout=10)
+        pool.close_all()
+        parser.close()
+        conn.close()
+        reporter.emit('stopped')
+    return EXIT_OK
+
+
+def cmd_accounts(args, reporter):
+    conn = storage.connect(args.db)
+    try:
+        for email, smtp_server, pop_server in conn.execute('SELECT email, smtp_server, pop_server FROM accounts ORDER BY email'):
+            reporter.emit('account', account=email, smtp_server=smtp_server, pop_server=pop_server)
+    finally:
+        conn.close()
+    return EXIT_OK
+
+
+def cmd_add_account(args, reporter):
+    password = os.environ.get(args.password_env) if args.password_env else getpass.getpass('密码: ')
+    if not password:
+        reporter.emit('error', error='empty password')
+        return EXIT_USAGE
+    conn = storage.connect(args.db)
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO accounts (email, password, smtp_server, pop_server) VALUES (?, ?, ?, ?)',
+                         (args.email, password, args.smtp, args.pop))
+    finally:
+        conn.close()
+    reporter.emit('account_saved', account=args.email)
+    return EXIT_OK
+
+
+def cmd_gc(args, reporter):
+    from blob_store import BlobStore, MessageStore
+
+    conn = storage.connect(args.db)
+    try:
+        messages = MessageStore(conn, BlobStore(storage.blob_path(args.db)))
+        orphans, removed, freed = messages.gc(args.grace)
+        reporter.emit('gc', references=orphans, blobs=removed, freed_bytes=freed)
+        if args.vacuum:
+            conn.execute('VACUUM')
+            reporter.emit('vacuumed')
+    finally:
+        conn.close()
+    return EXIT_OK
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='邮件客户端命令行：收信、发信、后台运行')
+    parser.add_argument('--db', default=storage.DEFAULT_DB_PATH, help='数据库路径，默认与图形界面相同')
+    parser.add_argument('--json', action='store_true', help='每个事件输出一行 JSON')
+    parser.add_argument('--metrics', help='把度量写到这个文件，.prom 为 Prometheus 文本格式，其余为 JSON 行')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def sync_options(command):
+        command.add_argument('--account', action='append', help='只处理这个账户，可重复')
+        command.add_argument('--workers', type=int, default=4, help='同时同步的账户数')
+        command.add_argument('--per-server', type=int, default=2, help='同一 POP3 服务器的连接数上限')
+
+    sync = commands.add_parser('sync', help='同步一次所有账户后退出')
+    sync_options(sync)
+    sync.add_argument('--check', action='store_true', help='先用 STAT 检查，邮箱没有变化时跳过')
+    sync.set_defaults(func=cmd_sync)
+
+    send = commands.add_parser('send', help='写入发件箱并立即投递')
+    send.add_argument('--account', required=True, help='发件账户')
+    send.add_argument('--to', action='append', required=True, help='收件人，可重复')
+    send.add_argument('--subject', default='')
+    send.add_argument('--body', help='正文，不给出时从标准输入读取')
+    send.add_argument('--queue-only', action='store_true', help='只写入发件箱，由 daemon 或界面投递')
+    send.set_defaults(func=cmd_send)
+
+    deliver = commands.add_parser('deliver', help='投递发件箱里所有到期的邮件后退出')
+    deliver.set_defaults(func=cmd_deliver)
+
+    daemon = commands.add_parser('daemon', help='常驻运行：自适应轮询收信并投递发件箱，SIGTERM/Ctrl-C 退出')
+    sync_options(daemon)
+    daemon.add_argument('--min-interval', type=float, default=30, help='有新邮件后的轮询间隔（秒）')
+    daemon.add_argument('--max-interval', type=float, default=900, help='没有新邮件时轮询间隔的上限（秒）')
+    daemon.set_defaults(func=cmd_daemon)
+
+    accounts = commands.add_parser('accounts', help='列出保存的账户')
+    accounts.set_defaults(func=cmd_accounts)
+
+    add = commands.add_parser('add-account', help='保存一个账户')
+    add.add_argument('email')
+    add.add_argument('--smtp', required=True, help='SMTP 服务器，host[:port]')
+    add.add_argument('--pop', required=True, help='POP3 服务器，host[:port]，默认 995 端口 TLS')
+    add.add_argument('--password-env', help='从这个环境变量读取密码，不给出时交互输入')
+    add.set_defaults(func=cmd_add_account)
+
+    gc = commands.add_parser('gc', help='删除已不存在的邮件的原文和不再被引用的块')
+    gc.add_argument('--grace', type=float, default=3600, help='最近这么多秒内写入的块不删除')
+    gc.add_argument('--vacuum', action='store_true', help='之后再整理数据库文件，释放空闲页')
+    gc.set_defaults(func=cmd_gc)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    reporter = Reporter(args.json, sys.stdout)
+    if args.metrics:
+        metrics.enable(metrics.sink_for_path(args.metrics))
+    # 收发信模块的进度提示都写到 stderr，stdout 只有事件，便于脚本解析
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            return args.func(args, reporter)
+    finally:
+        metrics.disable()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
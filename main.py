@@ -1,14 +1,21 @@
-import pop_lib
 import sys
-import sqlite3
-from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QLineEdit, QLabel, QVBoxLayout, QWidget, QTextEdit, QTabWidget, QListWidget, QHBoxLayout
-from email.mime.text import MIMEText
-from email.parser import Parser
-from smtp_lib import send_email_via_smtp,receive_email_via_pop
+import threading
+import metrics
+import storage
+from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QLineEdit, QLabel, QVBoxLayout, QWidget, QTextEdit, QTabWidget, QListWidget, QHBoxLayout, QTreeView, QCheckBox
+from mailbox_model import MailboxModel, ThreadModel
+from thread_index import ThreadIndex
 import pathlib
 import os
-from PyQt5.QtCore import QTimer, Qt
-DB_PATH = os.path.join(pathlib.Path(__file__).parent.absolute(), 'email_client.db')
+from PyQt5.QtCore import QTimer, Qt, QEvent, pyqtSignal
+# 界面只是数据库的查看器：收发信的网络部分（pop_lib、smtp_lib、ssl 等）在打开邮件客户端窗口时才导入，
+# 登录窗口可以尽快显示；没有界面时用 mailcli.py 收发信
+DB_PATH = storage.DEFAULT_DB_PATH
+BODY_CACHE_PATH = os.path.join(pathlib.Path(__file__).parent.absolute(), 'bodies')
+# 下载过的邮件原文（按内容去重、压缩），见 blob_store.py
+BLOB_PATH = storage.blob_path(DB_PATH)
+# 打开一封邮件时在后台预取列表中它下面的几封
+PREFETCH_COUNT = 3
 
 class LoginWindow(QMainWindow):
     def __init__(self):
@@ -71,27 +78,8 @@ class LoginWindow(QMainWindow):
         self.setCentralWidget(centralWidget)
 
     def initDB(self):
-        self.conn = sqlite3.connect(DB_PATH)
+        self.conn = storage.connect(DB_PATH)
         self.cursor = self.conn.cursor()
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS accounts (
-                email TEXT PRIMARY KEY,
-                password TEXT,
-                smtp_server TEXT,
-                pop_server TEXT
-            )
-        ''')
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS emails (
-                email_id TEXT PRIMARY KEY,
-                sender TEXT,
-                recipient TEXT,
-                subject TEXT,
-                body TEXT,
-                date TEXT
-            )
-        ''')
-        self.conn.commit()
 
     def login(self):
         email = self.emailLineEdit.text()
@@ -110,18 +98,52 @@ class LoginWindow(QMainWindow):
 
 
 class EmailClientWindow(QMainWindow):
+    # 发件箱状态变化 (outbox_id, status, error)，由投递线程发出
+    outboxStatusChanged = pyqtSignal(int, str, object)
+    # 正文下载完成 (email_id, 正文, error)，由下载线程发出
+    bodyLoaded = pyqtSignal(str, object, object)
+    # 旧邮件补进会话索引完成 (error)，由补索引的线程发出
+    threadIndexReady = pyqtSignal(object)
+
     def __init__(self, email, password, smtp_server, pop_server):
+        from outbox import Outbox, DeliveryPool
+        from pop_pool import POP3Pool
+        from poll_policy import PollPolicy
+        from blob_store import BlobStore
+        from body_cache import BodyCache, BodyLoader
+        from mime_parse import ParserPool
         super().__init__()
         self.email = email
         self.password = password
         self.smtp_server = smtp_server
         self.pop_server = pop_server
-        self.conn = sqlite3.connect(DB_PATH)
+        self.conn = storage.connect(DB_PATH)
         self.cursor = self.conn.cursor()
+        self.syncWorker = None
+        self.syncing = False
+        # 自适应轮询：没有新邮件时间隔逐步变长，收到新邮件或窗口在前台时缩短，同步进行中不计时
+        self.pollPolicy = PollPolicy()
+        # 下次轮询前预先建立 POP3 连接，省去轮询时的握手
+        self.popPool = POP3Pool(next_use=self.pollPolicy.due.get)
+        # 首次同步大量邮件时邮件头在多个进程里解析
+        self.parserPool = ParserPool()
+        self.outbox = Outbox(self.conn)
+        # 同步只取邮件头，正文在打开邮件时下载，原文保存在 BLOB_PATH，解码后的正文缓存在内存和磁盘上
+        self.currentEmailId = None
+        self.bodyCache = BodyCache(BODY_CACHE_PATH)
+        self.bodyLoaded.connect(self.onBodyLoaded)
+        self.bodyLoader = BodyLoader(DB_PATH, self.bodyCache, pool=self.popPool, on_loaded=self.bodyLoaded.emit,
+                                     blobs=BlobStore(BLOB_PATH))
+        self.bodyLoader.start()
         self.initUI()
+        # 后台投递发件箱里的邮件，发送不会阻塞界面，失败的邮件按指数退避重试
+        self.outboxStatusChanged.connect(self.onOutboxStatus)
+        self.deliveryPool = DeliveryPool(DB_PATH, on_status=self.outboxStatusChanged.emit)
+        self.deliveryPool.start()
         self.timer = QTimer(self)
-        self.timer.timeout.connect(self.refreshInbox)
-        self.timer.start(30000)  # 每隔1秒触发一次timeout信号
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.pollInbox)
+        self.timer.start(self.pollPolicy.min_interval * 1000)
         self.statu = 'New'
         self.label1=QLabel(self)
         self.label1.setText(self.email)
@@ -134,6 +156,7 @@ class EmailClientWindow(QMainWindow):
 
         self.createSendTab()
         self.createInboxTab()
+        self.createOutboxTab()
 
         self.setCentralWidget(self.tabWidget)
 
@@ -163,6 +186,41 @@ class EmailClientWindow(QMainWindow):
         self.tabWidget.addTab(self.sendTab, "发送邮件")
 
 
+    def createOutboxTab(self):
+        self.outboxTab = QWidget()
+        layout = QVBoxLayout()
+        self.outboxList = QListWidget()
+        self.retryButton = QPushButton('重新发送')
+        self.retryButton.clicked.connect(self.retryOutbox)
+        layout.addWidget(self.outboxList)
+        layout.addWidget(self.retryButton)
+        self.outboxTab.setLayout(layout)
+        self.tabWidget.addTab(self.outboxTab, "发件箱")
+        self.refreshOutbox()
+
+    def refreshOutbox(self):
+        self.outboxList.clear()
+        for outbox_id, to_addrs, subject, status, attempts, last_error in self.outbox.recent(self.email):
+            text = f"[{status}] To: {to_addrs}  ,Subject: {subject}"
+            if last_error:
+                text += f"  ,{last_error}"
+            self.outboxList.addItem(text)
+            self.outboxList.item(self.outboxList.count() - 1).setData(Qt.UserRole, outbox_id)
+
+    def retryOutbox(self):
+        item = self.outboxList.currentItem()
+        if item is not None:
+            self.outbox.retry_failed(item.data(Qt.UserRole))
+            self.deliveryPool.wake()
+            self.refreshOutbox()
+
+    def onOutboxStatus(self, outbox_id, status, error):
+        if status == 'sent':
+            print("邮件发送成功")
+        elif error:
+            print("邮件发送失败:", error)
+        self.refreshOutbox()
+
     def createInboxTab(self):
         self.inboxTab = QWidget()
         layout = QHBoxLayout()  # 使用 QHBoxLayout
@@ -170,14 +228,39 @@ class EmailClientWindow(QMainWindow):
         self.mailListLayout = QVBoxLayout()  # 邮件列表的布局
         self.refreshButton = QPushButton('刷新收件箱')
         self.refreshButton.clicked.connect(self.refreshInbox)
-        self.mailList = QListWidget()
+        self.cancelButton = QPushButton('取消刷新')
+        self.cancelButton.clicked.connect(self.cancelRefresh)
+        self.cancelButton.setEnabled(False)
+        # 全文搜索框，输入停顿 300 毫秒后再查询
+        self.searchLineEdit = QLineEdit()
+        self.searchLineEdit.setPlaceholderText('搜索邮件')
+        self.searchTimer = QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.timeout.connect(self.searchInbox)
+        self.searchLineEdit.textChanged.connect(lambda: self.searchTimer.start(300))
+        self.searchLineEdit.returnPressed.connect(self.searchInbox)
+        # 按会话分组显示，点三角展开；搜索时总是平铺显示搜索结果
+        self.threadCheckBox = QCheckBox('按会话显示')
+        self.threadCheckBox.toggled.connect(self.updateMailView)
+        self.threadIndexReady.connect(self.onThreadIndexReady)
+        self.threadIndexing = False
+
+        # 列表按需分页读取邮件头，正文在选中邮件时才读取
+        self.mailModel = MailboxModel(self.conn, parent=self)
+        self.threadModel = None
+        self.mailList = QTreeView()
+        self.mailList.setHeaderHidden(True)
+        self.mailList.setUniformRowHeights(True)
+        self.mailList.setRootIsDecorated(False)
+        self.mailList.setModel(self.mailModel)
         self.mailList.clicked.connect(self.displayEmailContent)
-        # 把数据库中所有的邮件都显示在列表中
-        saved_emails = self.cursor.execute('SELECT * FROM emails').fetchall()
-        for message in saved_emails:
-            self.mailList.addItem(f"Subject: {message[3]}  ,From: {message[1]}  ,Date: {message[5]}  ,Content: {message[4]}")
 
-        self.mailListLayout.addWidget(self.refreshButton)
+        buttonLayout = QHBoxLayout()
+        buttonLayout.addWidget(self.refreshButton)
+        buttonLayout.addWidget(self.cancelButton)
+        buttonLayout.addWidget(self.threadCheckBox)
+        self.mailListLayout.addLayout(buttonLayout)
+        self.mailListLayout.addWidget(self.searchLineEdit)
         self.mailListLayout.addWidget(self.mailList)
 
         self.mailContent = QTextEdit()  # 邮件内容展示区域
@@ -187,82 +270,200 @@ class EmailClientWindow(QMainWindow):
         layout.addLayout(self.mailListLayout, 3)  # 添加邮件列表布局
         layout.addWidget(self.mailContent, 5)  # 添加邮件内容展示区域，更大的比重
 
-        self.inboxTab.setLayout(layout)
-        self.tabWidget.addTab(self.inboxTab, "收件箱")
         # 在收件箱最下面加一行小字，显示当前登录的邮箱地址和刷新状态
-        
+        self.statusLabel = QLabel(self.email)
+        inboxLayout = QVBoxLayout()
+        inboxLayout.addLayout(layout)
+        inboxLayout.addWidget(self.statusLabel)
 
+        self.inboxTab.setLayout(inboxLayout)
+        self.tabWidget.addTab(self.inboxTab, "收件箱")
 
-    def displayEmailContent(self, index):
-        email_id = index.row()  # 获取选中邮件的序号
-        # 这里需要实现根据邮件ID获取邮件内容的逻辑
-        # 假设我们有一个方法 get_email_content(email_id) 来获取邮件内容
-        email_content = self.get_email_content(email_id)
-        self.mailContent.setText(email_content)
 
-    def get_email_content(self, email_id):
-        # 这里应该是从服务器获取邮件内容的逻辑
-        # 暂时返回假数据
-        rsp = self.mailList.item(email_id).text()
-        parse = rsp.split(',')
-        return parse[0] + '\n' + parse[1] + '\n' + parse[2] + '\n' + parse[3] + '\n'
+    def searchInbox(self):
+        self.searchTimer.stop()
+        self.mailModel.setSearch(self.searchLineEdit.text())
+        self.updateMailView()
+
+    def updateMailView(self):
+        threaded = self.threadCheckBox.isChecked() and self.mailModel.search is None
+        if threaded and self.threadModel is None:
+            # 第一次切换时先在后台线程把升级前的邮件补进会话索引（已经补完时只查询一次），
+            # 完成后 onThreadIndexReady 建立会话模型，在那之前仍然平铺显示
+            self.startThreadIndex()
+            threaded = False
+        model = self.threadModel if threaded else self.mailModel
+        if self.mailList.model() is not model:
+            self.mailList.setModel(model)
+            self.mailList.setRootIsDecorated(threaded)
+
+    def startThreadIndex(self):
+        # 几十万封旧邮件要十几秒，在后台线程里用独立连接补，界面照常使用
+        if self.threadIndexing:
+            return
+        self.threadIndexing = True
+        self.statusLabel.setText(f"{self.email}  正在建立会话索引...")
+        threading.Thread(target=self.catchUpThreads, name='thread-index', daemon=True).start()
+
+    def catchUpThreads(self):
+        conn = storage.connect(DB_PATH)
+        try:
+            ThreadIndex(conn).catch_up()
+        except Exception as e:
+            self.threadIndexReady.emit(str(e))
+        else:
+            self.threadIndexReady.emit(None)
+        finally:
+            conn.close()
+
+    def onThreadIndexReady(self, error):
+        self.threadIndexing = False
+        if error is not None:
+            self.statusLabel.setText(f"{self.email}  会话索引建立失败: {error}")
+            return
+        self.statusLabel.setText(self.email)
+        self.threadModel = ThreadModel(self.conn, parent=self)
+        self.updateMailView()
+
+    def displayEmailContent(self, index):
+        email_id = index.data(Qt.UserRole)  # 获取选中邮件的 email_id
+        self.currentEmailId = email_id
+        body = self.bodyCache.get(email_id)
+        if body is None:
+            self.bodyLoader.request(email_id)
+            body = '正在下载正文...'
+        self.mailContent.setText(self.get_email_content(email_id, body))
+        # 预取列表中它下面的几封（按会话显示时包括展开的会话里的邮件），接着往下看时不用等待
+        below = []
+        index = self.mailList.indexBelow(index)
+        while index.isValid() and len(below) < PREFETCH_COUNT:
+            below.append(index.data(Qt.UserRole))
+            index = self.mailList.indexBelow(index)
+        self.bodyLoader.prefetch(below)
+
+    def onBodyLoaded(self, email_id, body, error):
+        if email_id != self.currentEmailId:
+            return
+        if error is not None:
+            body = f'正文下载失败: {error}'
+        elif body is None:
+            # 不是通过 UIDL 同步的旧邮件，或已从服务器删除：显示数据库里保存的内容
+            row = self.cursor.execute('SELECT body FROM emails WHERE email_id = ?', (email_id,)).fetchone()
+            body = row[0] if row and row[0] else '邮件已从服务器删除'
+        self.mailContent.setText(self.get_email_content(email_id, body))
+
+    def get_email_content(self, email_id, body):
+        # 邮件头从数据库读取，正文来自缓存或服务器
+        row = self.cursor.execute('SELECT subject, sender, date FROM emails WHERE email_id = ?', (email_id,)).fetchone()
+        if row is None:
+            return ''
+        subject, sender, date = row
+        return f"Subject: {subject}\nFrom: {sender}\nDate: {date}\nContent: {body}\n"
 
 
     def sendEmail(self):
-        # 这里应该有发送邮件的逻辑，使用 self.email 和 self.password
-        recipient = self.recipientLineEdit.text()
+        # 邮件先写入发件箱，由后台线程投递；多个收件人用逗号或分号分隔
+        recipients = [addr.strip() for addr in self.recipientLineEdit.text().replace(';', ',').split(',') if addr.strip()]
         subject = self.subjectLineEdit.text()
         body = self.bodyTextEdit.toPlainText()
+        if not recipients:
+            return
 
-        # 构建邮件内容
-        msg = MIMEText(body)
-        msg['From'] = self.email
-        msg['To'] = recipient
-        msg['Subject'] = subject
-
-        try:
-            send_email_via_smtp(self.smtp_server, 587, self.email, self.password, self.email, recipient, subject, body)
-            print("邮件发送成功")
-        except Exception as e:
-            print("邮件发送失败:", e)
+        self.outbox.enqueue(self.email, self.smtp_server, self.email, recipients, subject, body)
+        self.deliveryPool.wake()
+        self.refreshOutbox()
         self.recipientLineEdit.clear()
         self.subjectLineEdit.clear()
         self.bodyTextEdit.clear()
 
     def refreshInbox(self):
+        # 手动刷新：所有保存的账户都完整同步一次
+        self.startSync(self.cursor.execute('SELECT email, password, pop_server FROM accounts').fetchall(), check=False)
+
+    def pollInbox(self):
+        # 定时轮询：只检查到期的账户，先用 STAT 判断邮箱有没有变化
+        accounts = self.cursor.execute('SELECT email, password, pop_server FROM accounts').fetchall()
+        due = set(self.pollPolicy.due_accounts([account[0] for account in accounts]))
+        accounts = [account for account in accounts if account[0] in due]
+        if accounts:
+            self.startSync(accounts, check=True)
+        else:
+            self.schedulePoll()
+
+    def schedulePoll(self):
+        # 同步进行中暂停计时，结束后再安排下一次
+        if self.syncing:
+            return
+        self.timer.start(int(self.pollPolicy.next_wait() * 1000))
+
+    def changeEvent(self, event):
+        if event.type() == QEvent.ActivationChange:
+            self.pollPolicy.set_focused(self.isActiveWindow())
+            self.schedulePoll()
+        super().changeEvent(event)
+
+    def startSync(self, accounts, check):
+        # 收信在后台线程进行，上一次同步还没结束时不重复启动；所有账户的邮件在收件箱合并显示
+        if self.syncing:
+            return
+        from sync_worker import SyncWorker
         print("refreshing inbox...")
-        saved_email_ids = self.cursor.execute('SELECT email_id FROM emails').fetchall()
-        try:
-            pop_conn = pop_lib.POP3(self.pop_server)  # 更改为您的POP服务器
-            pop_conn.user(self.email)
-            pop_conn.pass_(self.password)
-
-            # 获取邮件数量
-            message_count, _ = pop_conn.stat()
-
-            # 获取最新的几封邮件
-            num_messages = min(255, message_count)  # 例如，获取最新的5封邮件
-            for i in range(message_count, message_count - num_messages, -1):
-                print(f"正在获取第{i}封邮件")
-                try:
-                    # 获取邮件的头部信息
-                    response, lines, octets = pop_conn.top(i, 0)
-                    message_content = b'\n'.join(lines).decode('utf-8')
-                    message = Parser().parsestr(message_content)
-                    if (message['message-id'],) in saved_email_ids:
-                        break
-                    print(message)
-                    self.cursor.execute('INSERT INTO emails (email_id, sender, recipient, subject, body, date) VALUES (?, ?, ?, ?, ?, ?)', (message['message-id'], message['from'], message['to'], message['subject'], message.get_payload(), message['date']))
-                    # self.mailList.addItem(f"Subject: {message['subject']}  ,From: {message['from']}  ,Date: {message['date']}  ,Content: {message.get_payload()}")
-                    self.mailList.insertItem(0, f"Subject: {message['subject']}  ,From: {message['from']}  ,Date: {message['date']}  ,Content: {message.get_payload()}")
-                except Exception as e:
-                    print(f"获取邮件失败: {e}")
-            self.conn.commit() # 把接收到的最新邮件保存到数据库
-            pop_conn.quit() # 退出
-        except Exception as e:
-            print(f"邮件接收失败: {e}")
-
-
-app = QApplication(sys.argv)
-loginWin = LoginWindow()
-sys.exit(app.exec_())
+        self.syncing = True
+        self.timer.stop()
+        self.syncWorker = SyncWorker(DB_PATH, accounts, pool=self.popPool, parser=self.parserPool,
+                                     fingerprints=self.pollPolicy.fingerprints, check=check, parent=self)
+        self.syncWorker.headersReady.connect(self.onHeadersReady)
+        self.syncWorker.progress.connect(self.onSyncProgress)
+        self.syncWorker.syncFailed.connect(self.onSyncFailed)
+        self.syncWorker.finished.connect(self.onSyncFinished)
+        self.cancelButton.setEnabled(True)
+        self.statusLabel.setText(f"{self.email}  正在刷新...")
+        self.syncWorker.start()
+
+    def cancelRefresh(self):
+        if self.syncWorker is not None:
+            self.syncWorker.cancel()
+
+    def onHeadersReady(self, rows):
+        self.mailModel.prependRows(len(rows))
+        if self.threadModel is not None:
+            self.threadModel.prependRows(len(rows))
+
+    def onSyncProgress(self, done, total):
+        self.statusLabel.setText(f"{self.email}  正在刷新 {done}/{total}")
+
+    def onSyncFailed(self, error):
+        self.statusLabel.setText(f"{self.email}  邮件接收失败: {error}")
+
+    def onSyncFinished(self):
+        self.syncing = False
+        self.cancelButton.setEnabled(False)
+        for account in self.syncWorker.accounts:
+            result = self.syncWorker.results.get(account[0])
+            self.pollPolicy.record(account[0], isinstance(result, int) and result > 0)
+        self.schedulePoll()
+        if self.syncWorker.error is None:
+            self.statusLabel.setText(f"{self.email}  刷新完成，新邮件 {self.syncWorker.added} 封，"
+                                     f"连接复用已节省 {self.popPool.saved_seconds():.2f} 秒")
+
+    def closeEvent(self, event):
+        if self.syncWorker is not None:
+            self.syncWorker.cancel()
+            self.syncWorker.wait()
+        self.deliveryPool.stop(timeout=5)
+        self.bodyLoader.stop(timeout=5)
+        self.popPool.close_all()
+        self.parserPool.close()
+        super().closeEvent(event)
+
+
+# 解析进程池在某些平台上用 spawn 启动子进程，子进程会重新导入本模块，界面只能在主进程里创建
+if __name__ == '__main__':
+    # MAIL_METRICS=metrics.prom python main.py：记录收发信和数据库写入的耗时，.prom 为 Prometheus 格式，其余为 JSON 行
+    if os.environ.get('MAIL_METRICS'):
+        metrics.enable(metrics.sink_for_path(os.environ['MAIL_METRICS']))
+    app = QApplication(sys.argv)
+    loginWin = LoginWindow()
+    code = app.exec_()
+    metrics.disable()
+    sys.exit(code)
@@ -0,0 +1,247 @@
+"""
+收发信和存储热路径的度量：命令耗时直方图、传输字节数、连接/TLS 握手耗时、SQLite 写入耗时
+
+默认不启用（sink 为 None），埋点处先判断 metrics.sink is not None 再取时间，关闭时只多一次属性查找。
+启用时把观测值交给 sink：
+
+    metrics.enable(metrics.MemorySink())            # 内存里聚合，snapshot() / prometheus_text()
+    metrics.enable(metrics.JSONLinesSink(path))     # 每个观测值一行 JSON
+    metrics.enable(metrics.PrometheusSink(path))    # 聚合后写成 Prometheus 文本格式，flush() 时落盘
+
+度量名：
+    pop3_command_seconds{command}     POP3 命令从发出到读完应答（流水线中从上一条应答读完算起）
+    pop3_connect_seconds{tls}         建立连接到读完欢迎信息
+    pop3_bytes_sent_total / pop3_bytes_received_total
+    smtp_command_seconds{command}     BODY 为正文上传到收到最终应答
+    smtp_connect_seconds              建立连接到登录完成
+    smtp_bytes_sent_total
+    tls_handshake_seconds{protocol, resumed}
+    sqlite_write_seconds{operation}   含提交
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+# 延迟直方图的桶上限（秒）：Prometheus 客户端库的默认值，再加上局域网内单条命令常见的亚毫秒级
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# 当前的 sink，None 表示不启用
+sink = None
+
+
+def enable(new_sink):
+    """开始把观测值交给 new_sink，返回 new_sink；之前的 sink 会被关闭"""
+    global sink
+    old, sink = sink, new_sink
+    if old is not None:
+        old.close()
+    return new_sink
+
+
+def disable():
+    global sink
+    old, sink = sink, None
+    if old is not None:
+        old.close()
+
+
+def observe(name, value, **labels):
+    """记录一次耗时（秒）或大小，进入直方图"""
+    if sink is not None:
+        sink.observe(name, value, labels)
+
+
+def count(name, value=1, **labels):
+    """计数器加 value"""
+    if sink is not None:
+        sink.count(name, value, labels)
+
+
+class timed:
+    """
+    with metrics.timed('sqlite_write_seconds', operation='sync_batch'): ...
+    未启用时不取时间
+    """
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        if sink is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.start is not None and sink is not None:
+            sink.observe(self.name, time.perf_counter() - self.start, self.labels)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+
+class Histogram:
+    """固定桶的直方图：各桶计数、总数和总和"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # 最后一个是 +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """按桶估计分位数，返回所在桶的上限；落在 +Inf 桶时返回 None"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+
+class MemorySink:
+    """
+    在内存里聚合：直方图和计数器，按 (名字, 标签) 区分
+    * buckets: 直方图的桶上限
+    多个线程可以同时记录。
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}   # (名字, 标签) -> Histogram
+        self.counters = {}     # (名字, 标签) -> 值
+
+    def observe(self, name, value, labels):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.add(value)
+
+    def count(self, name, value, labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def snapshot(self):
+        """返回可以直接 json.dumps 的字典"""
+        with self.lock:
+            return {
+                'histograms': [{'name': name, 'labels': dict(labels), 'count': h.count, 'sum': h.sum,
+                                'buckets': dict(zip(map(str, h.buckets + ('+Inf',)), h.counts))}
+                               for (name, labels), h in sorted(self.histograms.items())],
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+            }
+
+    def prometheus_text(self):
+        """Prometheus 文本格式（0.0.4）"""
+        out = []
+        with self.lock:
+            typed = set()
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    out.append(f'# TYPE {name} histogram')
+                cumulative = 0
+                for bound, n in zip(h.buckets + ('+Inf',), h.counts):
+                    cumulative += n
+                    out.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+                out.append(f'{name}_sum{_format_labels(labels)} {h.sum}')
+                out.append(f'{name}_count{_format_labels(labels)} {h.count}')
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    out.append(f'# TYPE {name} counter')
+                out.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(out) + '\n'
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class PrometheusSink(MemorySink):
+    """
+    聚合后写成 Prometheus 文本文件，供 node_exporter 的 textfile 收集器读取
+    * path: 输出文件，flush() 和 close() 时整体替换
+    """
+
+    def __init__(self, path, buckets=DEFAULT_BUCKETS):
+        super().__init__(buckets)
+        self.path = path
+
+    def flush(self):
+        # 先写临时文件再改名，收集器读到的不会是写了一半的文件
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text())
+        os.replace(self.path + '.tmp', self.path)
+
+    def close(self):
+        self.flush()
+
+
+class JSONLinesSink:
+    """
+    每个观测值写一行 JSON：{"time", "metric", "type", "value", 标签...}
+    * path: 追加写入的文件
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def _write(self, kind, name, value, labels):
+        line = json.dumps({'time': round(time.time(), 6), 'metric': name, 'type': kind, 'value': value, **labels},
+                          ensure_ascii=False)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line + '\n')
+
+    def observe(self, name, value, labels):
+        self._write('histogram', name, value, labels)
+
+    def count(self, name, value, labels):
+        self._write('counter', name, value, labels)
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            file, self.file = self.file, None
+        if file is not None:
+            file.close()
+
+
+def sink_for_path(path):
+    """按扩展名选择 sink：.prom 为 PrometheusSink，其余为 JSONLinesSink"""
+    if path.endswith('.prom'):
+        return PrometheusSink(path)
+    return JSONLinesSink(path)
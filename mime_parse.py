@@ -0,0 +1,102 @@
+import concurrent.futures
+import email.errors
+import email.header
+import email.parser
+import email.policy
+import multiprocessing
+import os
+import re
+import threading
+
+# 邮件头里没有按 RFC 2047 编码、直接出现的 8 位字节，按这个顺序尝试解码
+FALLBACK_CHARSETS = ('utf-8', 'gb18030', 'latin-1')
+
+HEADER_FIELDS = ('message-id', 'from', 'to', 'subject', 'date', 'in-reply-to', 'references')
+
+# 折行：换行后紧跟空白
+_FOLD = re.compile(r'\r?\n(?=[ \t])')
+
+
+def _text(value):
+    # BytesParser 把原始 8 位字节保留为代理字符，这里换回字节再按常见字符集解码
+    try:
+        value.encode('utf-8')
+        return value
+    except UnicodeEncodeError:
+        pass
+    raw = value.encode('utf-8', 'surrogateescape')
+    for charset in FALLBACK_CHARSETS:
+        try:
+            return raw.decode(charset)
+        except UnicodeDecodeError:
+            continue
+
+
+def _header(value):
+    if value is None:
+        return None
+    value = _text(_FOLD.sub('', value))
+    if '=?' in value:
+        try:
+            value = str(email.header.make_header(email.header.decode_header(value)))
+        except (LookupError, UnicodeError, email.errors.HeaderParseError):
+            # 未知字符集或写错的编码字，保留原文
+            pass
+    return value
+
+
+def parse_headers(raw):
+    """
+    解析邮件头，返回紧凑的记录 (message_id, sender, recipient, subject, date, in_reply_to, references)，
+    编码字（=?charset?b?...?=）和各种字符集都已解码为 str，缺少的字段为 None
+    * raw: TOP n 0 或 RETR 得到的原文（bytes）
+    只取这几个字段，用 compat32 解析再用 email.header 解码编码字，比 policy.default 的完整头部解析快数倍。
+    """
+    message = email.parser.BytesParser(policy=email.policy.compat32).parsebytes(raw, headersonly=True)
+    headers = {}
+    for name, value in message.raw_items():
+        headers.setdefault(name.lower(), value)
+    return tuple(_header(headers.get(name)) for name in HEADER_FIELDS)
+
+
+def parse_many(raws):
+    """批量解析，在子进程中执行时一次往返处理一整批"""
+    return [parse_headers(raw) for raw in raws]
+
+
+class ParserPool:
+    """
+    邮件头解析进程池：首次同步几万封邮件时解析可以用满多个 CPU 核
+    * workers: 进程数，默认为 CPU 核数
+    * min_batch: 小于这个数量的批次直接在当前线程解析，省去进程间传输；日常轮询只有几封新邮件
+    进程池在第一次需要时才创建，多个线程可以共用同一个 ParserPool。
+    """
+
+    def __init__(self, workers=None, min_batch=32):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_batch = min_batch
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def submit(self, raws):
+        """提交一批邮件原文，返回 concurrent.futures.Future，结果为 parse_many(raws)"""
+        if len(raws) < self.min_batch or self.workers < 2:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(parse_many(raws))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        with self.lock:
+            if self.executor is None:
+                # 调用方是同步线程，进程里还有界面、投递、下载等线程，fork 可能把别的线程持有的锁带进子进程而死锁，
+                # 所以用 spawn 启动解析进程（入口脚本因此要有 __main__ 保护）
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.executor.submit(parse_many, raws)
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
@@ -0,0 +1,376 @@
+import os
+import socket
+import threading
+import time
+
+import metrics
+import smtp_lib
+import storage
+
+
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+# smtp_server 里没有写端口时使用的端口
+DEFAULT_SMTP_PORT = 587
+
+# 认领的有效期（秒）：状态为 sending 的邮件超过这么久还没有结果，认为认领它的进程已经退出，重新排队
+CLAIM_LEASE = 900
+
+
+def parse_server(value, default_port=DEFAULT_SMTP_PORT):
+    """'smtp.example.com:25' -> ('smtp.example.com', 25)，没有端口时用 default_port"""
+    host, sep, port = value.rpartition(':')
+    if sep and port.isdigit():
+        return host, int(port)
+    return value, default_port
+
+
+class Outbox:
+    """
+    发件箱表的读写，邮件先写入数据库再由后台线程投递，程序退出或发送失败都不会丢失
+    * conn: storage.connect() 返回的连接
+    * lease: 认领的有效期（秒），见 CLAIM_LEASE
+    多个进程可以共用一个发件箱：claim() 记下认领的进程和时间，别的进程只接手已过期的认领。
+    """
+
+    def __init__(self, conn, lease=CLAIM_LEASE):
+        self.conn = conn
+        self.lease = lease
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+
+    def enqueue(self, account, smtp_server, from_addr, to_addrs, subject, body):
+        """加入发件箱，返回邮件在 outbox 表中的 id"""
+        message = smtp_lib.build_message(from_addr, to_addrs, subject, body).encode()
+        now = time.time()
+        with metrics.timed('sqlite_write_seconds', operation='outbox_enqueue'), self.conn:
+            cursor = self.conn.execute('''
+                INSERT INTO outbox (account, smtp_server, from_addr, to_addrs, subject, message, status, attempts, next_attempt, created)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?)
+            ''', (account, smtp_server, from_addr, ','.join(to_addrs), subject, message, QUEUED, now, now))
+        return cursor.lastrowid
+
+    def claim(self, busy_servers=()):
+        """
+        取出一封已到发送时间的邮件并标记为 sending，没有时返回 None；认领已过期的 sending 邮件也会被取出
+        * busy_servers: 并发已满的服务器，跳过发往这些服务器的邮件
+        """
+        busy = list(busy_servers)
+        marks = ','.join('?' * len(busy))
+        now = time.time()
+        # 包括 BEGIN IMMEDIATE 等待写锁的时间
+        with metrics.timed('sqlite_write_seconds', operation='outbox_claim'):
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute(f'''
+                    SELECT outbox.id, outbox.account, outbox.smtp_server, outbox.from_addr, outbox.to_addrs,
+                           outbox.message, outbox.attempts, accounts.password
+                    FROM outbox LEFT JOIN accounts ON accounts.email = outbox.account
+                    WHERE ((outbox.status = ? AND outbox.next_attempt <= ?)
+                           OR (outbox.status = ? AND COALESCE(outbox.claimed_at, 0) < ?))
+                      AND outbox.smtp_server NOT IN ({marks})
+                    ORDER BY outbox.next_attempt LIMIT 1
+                ''', [QUEUED, now, SENDING, now - self.lease] + busy).fetchone()
+                if row is not None:
+                    self.conn.execute('UPDATE outbox SET status = ?, claimed_by = ?, claimed_at = ? WHERE id = ?',
+                                      (SENDING, self.owner, now, row[0]))
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        return row
+
+    def next_due(self, busy_servers=()):
+        """
+        最早一封待发送邮件的发送时间，没有时返回 None
+        * busy_servers: 同 claim()，不考虑发往这些服务器的邮件
+        """
+        busy = list(busy_servers)
+        marks = ','.join('?' * len(busy))
+        return self.conn.execute(f'SELECT MIN(next_attempt) FROM outbox WHERE status = ? AND smtp_server NOT IN ({marks})',
+                                 [QUEUED] + busy).fetchone()[0]
+
+    # mark_*() 只修改本进程认领的邮件：认领过期后被别的进程接手的邮件，以新的认领者的结果为准
+
+    def mark_sent(self, outbox_id, note=None):
+        with self.conn:
+            self.conn.execute('UPDATE outbox SET status = ?, sent_at = ?, last_error = ? WHERE id = ? AND claimed_by = ?',
+                              (SENT, time.time(), note, outbox_id, self.owner))
+
+    def mark_retry(self, outbox_id, attempts, delay, error):
+        with self.conn:
+            self.conn.execute('''
+                UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, last_error = ? WHERE id = ? AND claimed_by = ?
+            ''', (QUEUED, attempts, time.time() + delay, error, outbox_id, self.owner))
+
+    def mark_failed(self, outbox_id, attempts, error):
+        with self.conn:
+            self.conn.execute('UPDATE outbox SET status = ?, attempts = ?, last_error = ? WHERE id = ? AND claimed_by = ?',
+                              (FAILED, attempts, error, outbox_id, self.owner))
+
+    def renew(self, outbox_ids):
+        """延长本进程正在发送的邮件的认领，发送时间超过 lease 也不会被别的进程接手"""
+        ids = list(outbox_ids)
+        marks = ','.join('?' * len(ids))
+        with self.conn:
+            self.conn.execute(f'UPDATE outbox SET claimed_at = ? WHERE status = ? AND claimed_by = ? AND id IN ({marks})',
+                              [time.time(), SENDING, self.owner] + ids)
+
+    def recover(self):
+        """
+        认领已过期的 sending 邮件（认领它的进程异常退出）重新排队，返回数量
+        其他进程正在发送的邮件认领未过期，保持不变。
+        """
+        with self.conn:
+            return self.conn.execute('UPDATE outbox SET status = ? WHERE status = ? AND COALESCE(claimed_at, 0) < ?',
+                                     (QUEUED, SENDING, time.time() - self.lease)).rowcount
+
+    def retry_failed(self, outbox_id):
+        """手动重发一封已失败的邮件"""
+        with self.conn:
+            self.conn.execute('UPDATE outbox SET status = ?, attempts = 0, next_attempt = ? WHERE id = ? AND status = ?',
+                              (QUEUED, time.time(), outbox_id, FAILED))
+
+    def recent(self, account, limit=100):
+        """最近的发件记录 [(id, to_addrs, subject, status, attempts, last_error)]，用于界面显示"""
+        return self.conn.execute('''
+            SELECT id, to_addrs, subject, status, attempts, last_error FROM outbox
+            WHERE account = ? ORDER BY id DESC LIMIT ?
+        ''', (account, limit)).fetchall()
+
+
+class DeliveryPool:
+    """
+    后台投递线程池
+    * db_path: 数据库路径，每个线程使用独立连接
+    * workers: 线程数，发往不同服务器的邮件可以同时投递
+    * per_server: 同一服务器最多同时使用的连接数
+    * max_attempts: 临时错误最多尝试的次数，超过后标记为 failed
+    * base_delay / max_delay: 重试间隔从 base_delay 秒开始翻倍，不超过 max_delay
+    * idle_timeout: 空闲 SMTP 连接保留的秒数，期间发往同一服务器的邮件复用该连接
+    * on_status: 状态回调 on_status(outbox_id, status, error)，在投递线程中调用
+    """
+
+    def __init__(self, db_path, workers=4, per_server=2, max_attempts=6, base_delay=30,
+                 max_delay=3600, idle_timeout=60, on_status=None):
+        self.db_path = db_path
+        self.workers = workers
+        self.per_server = per_server
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.idle_timeout = idle_timeout
+        self.on_status = on_status
+        self.cond = threading.Condition()
+        # 算出满载的服务器、认领、占用连接数三步要连在一起，否则几个线程可能同时认领发往同一服务器的邮件
+        self.claiming = threading.Lock()
+        self.stopping = False
+        self.threads = []
+        self.active = {}   # smtp_server -> 正在使用的连接数
+        self.sending = set()   # 正在发送的 outbox id，由 _keep_leases 定期续期
+        self.keeper = None     # (线程, 停止用的 Event)
+        self.idle = {}     # (host, port, username) -> [(SMTPSession, 上次使用时间)]
+
+    def start(self):
+        conn = storage.connect(self.db_path)
+        Outbox(conn).recover()
+        conn.close()
+        self._start_keeper()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'outbox-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def wake(self):
+        """有新邮件入队时调用"""
+        with self.cond:
+            self.cond.notify_all()
+
+    def stop(self, timeout=None):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        self._stop_keeper()
+        self._close_idle(0)
+
+    def _start_keeper(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=self._keep_leases, args=(stop,), name='outbox-lease', daemon=True)
+        thread.start()
+        self.keeper = (thread, stop)
+
+    def _stop_keeper(self):
+        if self.keeper is not None:
+            thread, stop = self.keeper
+            self.keeper = None
+            stop.set()
+            thread.join()
+
+    def _keep_leases(self, stop):
+        # 每过三分之一个认领有效期续期一次，发送大邮件或服务器很慢时认领也不会过期
+        conn = storage.connect(self.db_path)
+        outbox = Outbox(conn)
+        try:
+            while not stop.wait(outbox.lease / 3):
+                with self.cond:
+                    sending = list(self.sending)
+                if sending:
+                    outbox.renew(sending)
+        finally:
+            conn.close()
+
+    def deliver_due(self):
+        """
+        在当前线程里投递所有已到期的邮件，投递完返回处理的封数，供命令行一次性发送使用，不需要 start()
+        """
+        conn = storage.connect(self.db_path)
+        outbox = Outbox(conn)
+        count = 0
+        self._start_keeper()
+        try:
+            while True:
+                job = outbox.claim()
+                if job is None:
+                    return count
+                self._deliver(outbox, job)
+                count += 1
+        finally:
+            self._stop_keeper()
+            self._close_idle(0)
+            conn.close()
+
+    def _status(self, outbox_id, status, error=None):
+        if self.on_status is not None:
+            self.on_status(outbox_id, status, error)
+
+    def _run(self):
+        conn = storage.connect(self.db_path)
+        outbox = Outbox(conn)
+        try:
+            while True:
+                with self.claiming:
+                    with self.cond:
+                        if self.stopping:
+                            return
+                        busy = [server for server, count in self.active.items() if count >= self.per_server]
+                    job = outbox.claim(busy)
+                    if job is not None:
+                        with self.cond:
+                            self.active[job[2]] = self.active.get(job[2], 0) + 1
+                if job is None:
+                    self._close_idle(self.idle_timeout)
+                    # 到期的邮件都发往满载的服务器时，等连接空出来（finally 里 notify_all），不反复认领
+                    due = outbox.next_due(busy)
+                    wait = 30 if due is None else min(30, max(0.05, due - time.time()))
+                    with self.cond:
+                        if not self.stopping:
+                            self.cond.wait(wait)
+                    continue
+                server = job[2]
+                try:
+                    self._deliver(outbox, job)
+                finally:
+                    with self.cond:
+                        self.active[server] -= 1
+                        self.cond.notify_all()
+        finally:
+            conn.close()
+
+    def _deliver(self, outbox, job):
+        with self.cond:
+            self.sending.add(job[0])
+        try:
+            self._attempt(outbox, job)
+        finally:
+            with self.cond:
+                self.sending.discard(job[0])
+
+    def _attempt(self, outbox, job):
+        outbox_id, account, smtp_server, from_addr, to_addrs, message, attempts, password = job
+        self._status(outbox_id, SENDING)
+        attempts += 1
+        if password is None:
+            outbox.mark_failed(outbox_id, attempts, 'account not found')
+            self._status(outbox_id, FAILED, 'account not found')
+            return
+        host, port = parse_server(smtp_server)
+        key = (host, port, account)
+        try:
+            refused = self._send(key, password, from_addr, to_addrs.split(','), message)
+        except smtp_lib.SMTPPermanentError as e:
+            outbox.mark_failed(outbox_id, attempts, str(e))
+            self._status(outbox_id, FAILED, str(e))
+        except (smtp_lib.SMTPError, OSError) as e:
+            if attempts >= self.max_attempts:
+                outbox.mark_failed(outbox_id, attempts, str(e))
+                self._status(outbox_id, FAILED, str(e))
+            else:
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+                outbox.mark_retry(outbox_id, attempts, delay, str(e))
+                self._status(outbox_id, QUEUED, f'{e}，{delay} 秒后重试')
+        else:
+            note = f'refused: {",".join(refused)}' if refused else None
+            outbox.mark_sent(outbox_id, note)
+            self._status(outbox_id, SENT, note)
+
+    def _send(self, key, password, from_addr, to_addrs, message):
+        # 优先复用空闲连接；复用的连接可能已被服务器关闭，此时换新连接再试一次
+        session = self._take_idle(key)
+        if session is not None:
+            try:
+                return self._send_on(key, session, from_addr, to_addrs, message)
+            except (smtp_lib.SMTPProtocolError, OSError):
+                pass
+        host, port, username = key
+        session = smtp_lib.SMTPSession(host, port, username, password)
+        try:
+            session.connect()
+        except BaseException:
+            session.close()
+            raise
+        return self._send_on(key, session, from_addr, to_addrs, message)
+
+    def _send_on(self, key, session, from_addr, to_addrs, message):
+        # 服务器拒绝这封邮件时连接仍然可用，放回空闲列表；连接出错时关闭
+        try:
+            refused = session.send(from_addr, to_addrs, message)
+        except (smtp_lib.SMTPProtocolError, OSError):
+            session.close()
+            raise
+        except smtp_lib.SMTPError:
+            self._put_idle(key, session)
+            raise
+        self._put_idle(key, session)
+        return refused
+
+    def _take_idle(self, key):
+        with self.cond:
+            sessions = self.idle.get(key)
+            if sessions:
+                return sessions.pop()[0]
+        return None
+
+    def _put_idle(self, key, session):
+        if session.sock is None:
+            return
+        with self.cond:
+            self.idle.setdefault(key, []).append((session, time.monotonic()))
+
+    def _close_idle(self, max_idle):
+        now = time.monotonic()
+        expired = []
+        with self.cond:
+            for key, sessions in self.idle.items():
+                keep = [(s, t) for s, t in sessions if now - t < max_idle]
+                expired.extend(s for s, t in sessions if now - t >= max_idle)
+                self.idle[key] = keep
+        for session in expired:
+            try:
+                session.quit()
+            except (smtp_lib.SMTPError, OSError):
+                session.close()
@@ -0,0 +1,64 @@
+import random
+import time
+
+
+class PollPolicy:
+    """
+    自适应轮询：每个账户单独计算下次检查的时间
+    * min_interval: 收到新邮件后的轮询间隔（秒）
+    * max_interval: 一直没有新邮件时退避到的上限
+    * focused_interval: 窗口在前台时间隔不超过这个值
+    * factor: 每次没有新邮件，间隔乘以 factor
+    * jitter: 间隔随机浮动的比例，多个账户、多个客户端不会在同一时刻轮询
+    fingerprints 保存每个账户上次完整同步后 STAT 的 (邮件数, 总大小)，
+    由 SyncScheduler 用来跳过没有变化的邮箱。
+    """
+
+    def __init__(self, min_interval=30, max_interval=900, focused_interval=60, factor=2, jitter=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.focused_interval = focused_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.focused = False
+        self.intervals = {}     # account -> 当前间隔（未加前台上限和抖动）
+        self.due = {}           # account -> 下次检查的 time.monotonic()
+        self.fingerprints = {}  # account -> (邮件数, 总大小)
+
+    def _delay(self, interval):
+        if self.focused:
+            interval = min(interval, self.focused_interval)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def due_accounts(self, accounts, now=None):
+        """返回 accounts 中已经到检查时间的账户，没有检查过的账户立即到期"""
+        now = time.monotonic() if now is None else now
+        return [account for account in accounts if self.due.get(account, now) <= now]
+
+    def record(self, account, changed, now=None):
+        """
+        一次检查结束后调用
+        * changed: 是否收到了新邮件，是则回到 min_interval，否则按 factor 退避
+        """
+        now = time.monotonic() if now is None else now
+        if changed:
+            interval = self.min_interval
+        else:
+            interval = min(self.max_interval, self.intervals.get(account, self.min_interval / self.factor) * self.factor)
+        self.intervals[account] = interval
+        self.due[account] = now + self._delay(interval)
+
+    def set_focused(self, focused, now=None):
+        """窗口切到前台时，把较远的下次检查时间提前到 focused_interval 以内"""
+        now = time.monotonic() if now is None else now
+        self.focused = focused
+        if focused:
+            for account, due in self.due.items():
+                self.due[account] = min(due, now + self._delay(self.focused_interval))
+
+    def next_wait(self, now=None):
+        """距离最近一个账户到期还有多少秒"""
+        now = time.monotonic() if now is None else now
+        if not self.due:
+            return 0
+        return max(0, min(self.due.values()) - now)
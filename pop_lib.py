@@ -2,6 +2,9 @@ import errno
 import re
 import socket
 import sys
+import time
+
+import metrics
 
 try:
     import ssl
@@ -29,29 +32,231 @@ CRLF = CR+LF
 
 _MAXLINE = 2048
 
+# Number of commands written in one go when pipelining (RFC 2449)
+_PIPELINE_BATCH = 64
+
+# Size of a single recv_into() by the fast reader
+_RECV_SIZE = 65536
+
+# Last TLS session per (host, port) as (context, session).  Offering it
+# on the next connection lets the server resume instead of running a
+# full handshake; a session is only valid with the context that made it.
+_tls_sessions = {}
+
+_shared_contexts = {}
+
+
+# Response parsing shared by POP3 and aiopop_lib.AsyncPOP3.
+
+# Internal: strip the line terminator, return (line, octets).
+# server can send any combination of CR & LF
+# however, 'readline()' returns lines ending in LF
+# so only possibilities are ...LF, ...CRLF, CR...LF
+
+def _stripline(line):
+    octets = len(line)
+    if line[-2:] == CRLF:
+        return line[:-2], octets
+    if line[:1] == CR:
+        return line[1:-1], octets
+    return line[:-1], octets
+
+
+# Internal: raise 'error_proto' if the response doesn't start with '+'.
+
+def _checkresp(resp):
+    if not resp.startswith(b'+'):
+        raise error_proto(resp)
+    return resp
+
+
+# Internal: undo the byte-stuffing of one line of multi-line text.
+# 'octets' is the size on the wire, which callers add up; the stuffed
+# dot is not counted.
+
+def _unstuff(line, octets):
+    if line.startswith(b'..'):
+        return line[1:], octets-1
+    return line, octets
+
+
+# Internal: tell whether a command is answered with a multi-line response
+
+def _islongcmd(line):
+    words = line.split()
+    name = words[0].upper()
+    if name in ('LIST', 'UIDL'):
+        return len(words) == 1
+    return name in ('RETR', 'TOP', 'CAPA')
+
+
+def _parsestat(resp):
+    rets = resp.split()
+    return int(rets[1]), int(rets[2])
+
+
+def _parsecapa(lines):
+    caps = {}
+    for capline in lines:
+        lst = capline.decode('ascii').split()
+        caps[lst[0]] = lst[1:]
+    return caps
+
+
+timestamp = re.compile(br'\+OK.[^<]*(<.*>)')
+
+def _apopdigest(welcome, password, encoding):
+    m = timestamp.match(welcome)
+    if not m:
+        raise error_proto('-ERR APOP not supported by server')
+    import hashlib
+    digest = m.group(1) + bytes(password, encoding)
+    return hashlib.md5(digest).hexdigest()
+
+
+# Internal: buffered reader working directly on the socket.
+# It offers the readline() used by POP3._getline() and, for multi-line
+# responses, readlong() which finds the terminating '.' line and
+# splits/unstuffs the whole text with a handful of C level calls
+# instead of one Python level iteration per line.
+
+class _SocketReader:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray()
+        self.pos = 0
+        self.chunk = bytearray(_RECV_SIZE)
+        self.view = memoryview(self.chunk)
+
+    def _fill(self):
+        n = self.sock.recv_into(self.view)
+        if not n:
+            return False
+        if metrics.sink is not None:
+            metrics.count('pop3_bytes_received_total', n)
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += self.view[:n]
+        return True
+
+    def readline(self, limit):
+        while True:
+            end = self.buf.find(LF, self.pos, self.pos + limit)
+            if end >= 0:
+                end = end + 1
+                break
+            if len(self.buf) - self.pos >= limit:
+                end = self.pos + limit
+                break
+            if not self._fill():
+                end = len(self.buf)
+                break
+        line = bytes(self.buf[self.pos:end])
+        self.pos = end
+        return line
+
+    def readlong(self):
+        """Return (lines, octets) for the text up to the '.' line.
+
+        Returns None, consuming nothing, if the text does not use CRLF
+        line endings throughout so the caller can fall back to reading
+        line by line.
+        """
+        # Servers are consistent in their line endings, so checking
+        # the first line is enough to know whether the bulk path applies.
+        while True:
+            first = self.buf.find(LF, self.pos, self.pos + _MAXLINE + 1)
+            if first >= 0:
+                break
+            if len(self.buf) - self.pos > _MAXLINE:
+                raise error_proto('line too long')
+            if not self._fill():
+                raise error_proto('-ERR EOF')
+        if first == self.pos or self.buf[first - 1] != CR[0]:
+            return None
+        scan = 0
+        while True:
+            if self.buf.startswith(b'.' + CRLF, self.pos):
+                end = self.pos
+                break
+            end = self.buf.find(CRLF + b'.' + CRLF, self.pos + scan)
+            if end >= 0:
+                end = end + 2
+                break
+            scan = max(0, len(self.buf) - self.pos - 4)
+            if len(self.buf) - max(self.buf.rfind(LF, self.pos) + 1, self.pos) > _MAXLINE:
+                raise error_proto('line too long')
+            if not self._fill():
+                raise error_proto('-ERR EOF')
+        text = bytes(self.buf[self.pos:end])
+        if text.count(LF) != text.count(CRLF):
+            return None
+        self.pos = end + 3
+        if text.startswith(b'..'):
+            text = text[1:]
+        text = text.replace(CRLF + b'..', CRLF + b'.')
+        lines = text.split(CRLF)
+        lines.pop()
+        if lines and len(max(lines, key=len)) + 2 > _MAXLINE:
+            raise error_proto('line too long')
+        return lines, len(text)
+
+    def close(self):
+        self.buf = None
+        self.view.release()
+
 
 class POP3:
 
     encoding = 'UTF-8'
+    fast_reader = True
 
     def __init__(self, host, port=POP3_PORT,
                  timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
         self.host = host
         self.port = port
         self._tls_established = False
+        self._pipelining = None
         sys.audit("poplib.connect", self, host, port)
+        start = time.perf_counter() if metrics.sink is not None else None
         self.sock = self._create_socket(timeout)
-        self.file = self.sock.makefile('rb')
+        self.file = self._makefile()
         self._debugging = 0
         self.welcome = self._getresp()
+        if start is not None:
+            metrics.observe('pop3_connect_seconds', time.perf_counter() - start,
+                            tls='implicit' if self._tls_established else 'none')
+        if self._tls_established:
+            self._save_tls_session()
 
     def _create_socket(self, timeout):
         return socket.create_connection((self.host, self.port), timeout)
 
+    def _makefile(self):
+        if self.fast_reader:
+            return _SocketReader(self.sock)
+        return self.sock.makefile('rb')
+
     def _putline(self, line):
         if self._debugging > 1: print('*put*', repr(line))
         sys.audit("poplib.putline", self, line)
         self.sock.sendall(line + CRLF)
+        if metrics.sink is not None:
+            metrics.count('pop3_bytes_sent_total', len(line) + 2)
+
+
+    # Internal: send several lines with a single sendall()
+
+    def _putlines(self, lines):
+        for line in lines:
+            if self._debugging > 1: print('*put*', repr(line))
+            sys.audit("poplib.putline", self, line)
+        data = b''.join(line + CRLF for line in lines)
+        self.sock.sendall(data)
+        if metrics.sink is not None:
+            metrics.count('pop3_bytes_sent_total', len(data))
 
 
     # Internal: send one command to the server (through _putline())
@@ -73,15 +278,7 @@ class POP3:
 
         if self._debugging > 1: print('*get*', repr(line))
         if not line: raise error_proto('-ERR EOF')
-        octets = len(line)
-        # server can send any combination of CR & LF
-        # however, 'readline()' returns lines ending in LF
-        # so only possibilities are ...LF, ...CRLF, CR...LF
-        if line[-2:] == CRLF:
-            return line[:-2], octets
-        if line[:1] == CR:
-            return line[1:-1], octets
-        return line[:-1], octets
+        return _stripline(line)
 
 
     # Internal: get a response from the server.
@@ -90,39 +287,96 @@ class POP3:
     def _getresp(self):
         resp, o = self._getline()
         if self._debugging > 1: print('*resp*', repr(resp))
-        if not resp.startswith(b'+'):
-            raise error_proto(resp)
-        return resp
+        return _checkresp(resp)
 
 
     # Internal: get a response plus following text from the server.
 
     def _getlongresp(self):
         resp = self._getresp()
+        if isinstance(self.file, _SocketReader) and self._debugging < 2:
+            res = self.file.readlong()
+            if res is not None:
+                return resp, res[0], res[1]
         list = []; octets = 0
-        line, o = self._getline()
-        while line != b'.':
-            if line.startswith(b'..'):
-                o = o-1
-                line = line[1:]
+        for line, o in self._iterlongtext():
             octets = octets + o
             list.append(line)
-            line, o = self._getline()
         return resp, list, octets
 
 
+    # Internal: yield the text following a response as (line, octets)
+    # pairs, dot-unstuffed, up to and excluding the terminating '.'.
+
+    def _iterlongtext(self):
+        line, o = self._getline()
+        while line != b'.':
+            yield _unstuff(line, o)
+            line, o = self._getline()
+
+
+    # Internal: send a command and feed the following text to 'sink'
+    # one CRLF terminated line at a time.
+
+    def _longcmd_to(self, line, sink):
+        start = time.perf_counter() if metrics.sink is not None else None
+        self._putcmd(line)
+        resp = self._getresp()
+        octets = 0
+        for text, o in self._iterlongtext():
+            octets = octets + o
+            sink(text + CRLF)
+        if start is not None:
+            self._record(line, start)
+        return resp, octets
+
+
     # Internal: send a command and get the response
 
     def _shortcmd(self, line):
+        start = time.perf_counter() if metrics.sink is not None else None
         self._putcmd(line)
-        return self._getresp()
+        resp = self._getresp()
+        if start is not None:
+            self._record(line, start)
+        return resp
 
 
     # Internal: send a command and get the response plus following text
 
     def _longcmd(self, line):
+        start = time.perf_counter() if metrics.sink is not None else None
         self._putcmd(line)
-        return self._getlongresp()
+        resp = self._getlongresp()
+        if start is not None:
+            self._record(line, start)
+        return resp
+
+
+    # Internal: report the time since 'start' as the latency of 'line'
+    # and return the current time.  Only the command word is used as a
+    # label, never its arguments (PASS carries the password).
+
+    def _record(self, line, start):
+        now = time.perf_counter()
+        metrics.observe('pop3_command_seconds', now - start,
+                        command=line.split(None, 1)[0].upper())
+        return now
+
+
+    # Internal: read the response to 'line'.  A '-ERR' from the server is
+    # returned instead of raised so that later pipelined responses stay
+    # in step; local errors (EOF, line too long) still propagate.
+
+    def _getcmdresp(self, line):
+        try:
+            if _islongcmd(line):
+                return self._getlongresp()
+            return self._getresp()
+        except error_proto as err:
+            if not isinstance(err.args[0], bytes):
+                raise
+            return err
 
 
     # These can be useful:
@@ -161,11 +415,8 @@ class POP3:
         Result is tuple of 2 ints (message count, mailbox size)
         """
         retval = self._shortcmd('STAT')
-        rets = retval.split()
-        if self._debugging: print('*stat*', repr(rets))
-        numMessages = int(rets[1])
-        sizeMessages = int(rets[2])
-        return (numMessages, sizeMessages)
+        if self._debugging: print('*stat*', repr(retval))
+        return _parsestat(retval)
 
 
     def list(self, which=None):
@@ -190,6 +441,28 @@ class POP3:
         return self._longcmd('RETR %s' % which)
 
 
+    def retr_iter(self, which):
+        """Retrieve message number 'which' as a stream of lines.
+
+        Result is ('response', iterator).  The iterator yields the
+        dot-unstuffed lines without terminators and must be exhausted
+        before any other command is sent.
+        """
+        resp = self._shortcmd('RETR %s' % which)
+        return resp, (line for line, o in self._iterlongtext())
+
+
+    def retr_to(self, which, sink):
+        """Retrieve message number 'which' and pass it to 'sink'.
+
+        'sink' is called with every line terminated by CRLF, so a
+        file's write(), a hash's update() or BytesFeedParser.feed()
+        can be given directly.  Only one line is held in memory at a
+        time.  Result is ('response', octets).
+        """
+        return self._longcmd_to('RETR %s' % which, sink)
+
+
     def dele(self, which):
         """Delete message number 'which'.
 
@@ -219,6 +492,8 @@ class POP3:
 
     def close(self):
         """Close the connection without assuming anything about it."""
+        if self._tls_established and self.sock is not None:
+            self._save_tls_session()
         try:
             file = self.file
             self.file = None
@@ -249,7 +524,7 @@ class POP3:
         return self._shortcmd('RPOP %s' % user)
 
 
-    timestamp = re.compile(br'\+OK.[^<]*(<.*>)')
+    timestamp = timestamp
 
     def apop(self, user, password):
         """Authorisation
@@ -262,13 +537,7 @@ class POP3:
 
         NB: mailbox is locked by server from here to 'quit()'
         """
-        secret = bytes(password, self.encoding)
-        m = self.timestamp.match(self.welcome)
-        if not m:
-            raise error_proto('-ERR APOP not supported by server')
-        import hashlib
-        digest = m.group(1)+secret
-        digest = hashlib.md5(digest).hexdigest()
+        digest = _apopdigest(self.welcome, password, self.encoding)
         return self._shortcmd('APOP %s %s' % (user, digest))
 
 
@@ -281,6 +550,97 @@ class POP3:
         return self._longcmd('TOP %s %s' % (which, howmuch))
 
 
+    def top_iter(self, which, howmuch):
+        """Streaming variant of top(), see retr_iter()."""
+        resp = self._shortcmd('TOP %s %s' % (which, howmuch))
+        return resp, (line for line, o in self._iterlongtext())
+
+
+    def top_to(self, which, howmuch, sink):
+        """Streaming variant of top(), see retr_to()."""
+        return self._longcmd_to('TOP %s %s' % (which, howmuch), sink)
+
+
+    def uidl(self, which=None):
+        """Return message digest (unique id) list.
+
+        If 'which', result contains unique id for that message
+        in the form 'response mesgnum uid', otherwise result is
+        the list ['response', ['mesgnum uid', ...], octets]
+        """
+        if which is not None:
+            return self._shortcmd('UIDL %s' % which)
+        return self._longcmd('UIDL')
+
+
+
+    def uidl_many(self, whichs):
+        """Return the 'response mesgnum uid' lines for several messages."""
+        return self.pipeline(['UIDL %s' % which for which in whichs])
+
+
+    def has_pipelining(self):
+        """Return True if the server advertises PIPELINING (RFC 2449).
+
+        The CAPA lookup is done once per session.
+        """
+        if self._pipelining is None:
+            try:
+                self._pipelining = 'PIPELINING' in self.capa()
+            except error_proto:
+                self._pipelining = False
+        return self._pipelining
+
+
+    def pipeline(self, cmds, batch=_PIPELINE_BATCH):
+        """Send several commands and return their responses in order.
+
+        When the server supports PIPELINING, up to 'batch' commands are
+        written with one sendall() and the responses are read back
+        afterwards; otherwise the commands are sent one at a time.
+
+        Result is a list holding 'response' for single line commands and
+        ['response', ['line', ...], octets] for multi-line ones.  A command
+        refused by the server yields an error_proto instance in its slot.
+        """
+        cmds = list(cmds)
+        if not self.has_pipelining():
+            batch = 1
+        results = []
+        for offset in range(0, len(cmds), batch):
+            chunk = cmds[offset:offset + batch]
+            if self._debugging:
+                for line in chunk: print('*cmd*', repr(line))
+            # Each pipelined response is timed from the one before it,
+            # the first from the moment the batch was written.
+            start = time.perf_counter() if metrics.sink is not None else None
+            self._putlines([bytes(line, self.encoding) for line in chunk])
+            for line in chunk:
+                results.append(self._getcmdresp(line))
+                if start is not None:
+                    start = self._record(line, start)
+        return results
+
+
+    def top_many(self, whichs, howmuch):
+        """Pipelined top() over several message numbers."""
+        return self.pipeline(['TOP %s %s' % (which, howmuch) for which in whichs])
+
+
+    def retr_many(self, whichs):
+        """Pipelined retr() over several message numbers."""
+        return self.pipeline(['RETR %s' % which for which in whichs])
+
+
+    def dele_many(self, whichs):
+        """Pipelined dele() over several message numbers."""
+        return self.pipeline(['DELE %s' % which for which in whichs])
+
+
+    def list_many(self, whichs):
+        """Pipelined scan listings for several message numbers."""
+        return self.pipeline(['LIST %s' % which for which in whichs])
+
 
     def utf8(self):
         """Try to enter UTF-8 mode (see RFC 6856). Returns server response.
@@ -289,21 +649,12 @@ class POP3:
 
 
     def capa(self):
-
-        def _parsecap(line):
-            lst = line.decode('ascii').split()
-            return lst[0], lst[1:]
-
-        caps = {}
+        """Return server capabilities (RFC 2449) as a dictionary."""
         try:
             resp = self._longcmd('CAPA')
-            rawcaps = resp[1]
-            for capline in rawcaps:
-                capnm, capargs = _parsecap(capline)
-                caps[capnm] = capargs
         except error_proto as _err:
             raise error_proto('-ERR CAPA not supported by server')
-        return caps
+        return _parsecapa(resp[1])
 
 
     def stls(self, context=None):
@@ -317,12 +668,100 @@ class POP3:
         if not 'STLS' in caps:
             raise error_proto('-ERR STLS not supported by server')
         if context is None:
-            context = ssl._create_stdlib_context()
+            context = shared_context(verify=False)
         resp = self._shortcmd('STLS')
-        self.sock = context.wrap_socket(self.sock,
-                                        server_hostname=self.host)
-        self.file = self.sock.makefile('rb')
+        self.sock = self._wrap_socket(context, self.sock)
+        self.file = self._makefile()
         self._tls_established = True
+        self._pipelining = None
         return resp
 
 
+    # Internal: start TLS on 'sock', offering the session remembered for
+    # this server so the handshake can be abbreviated.
+
+    def _wrap_socket(self, context, sock):
+        cached = _tls_sessions.get((self.host, self.port))
+        session = cached[1] if cached and cached[0] is context else None
+        start = time.perf_counter() if metrics.sink is not None else None
+        sock = context.wrap_socket(sock, server_hostname=self.host,
+                                   session=session)
+        if start is not None:
+            metrics.observe('tls_handshake_seconds', time.perf_counter() - start,
+                            protocol='pop3', resumed=str(sock.session_reused).lower())
+        self.context = context
+        return sock
+
+
+    # Internal: remember the TLS session for the next connection.  With
+    # TLS 1.3 the ticket arrives after the handshake, so this is called
+    # once the greeting has been read and again before closing.
+
+    def _save_tls_session(self):
+        session = getattr(self.sock, 'session', None)
+        if session is not None:
+            _tls_sessions[(self.host, self.port)] = (self.context, session)
+
+
+    def tls_resumed(self):
+        """Return True if the TLS handshake resumed an earlier session."""
+        return bool(getattr(self.sock, 'session_reused', False))
+
+
+
+
+if HAVE_SSL:
+
+    def shared_context(verify=True):
+        """Return the process wide SSLContext used for POP3 over TLS.
+
+        TLS sessions can only be resumed through the context that created
+        them, so connections that share a context skip the full handshake
+        when reconnecting to the same server.  With 'verify' the context
+        checks certificates and host names against the system CAs;
+        without it nothing is checked, like the default of POP3_SSL.
+        """
+        context = _shared_contexts.get(verify)
+        if context is None:
+            if verify:
+                context = ssl.create_default_context()
+            else:
+                context = ssl._create_stdlib_context()
+            context = _shared_contexts.setdefault(verify, context)
+        return context
+
+    class POP3_SSL(POP3):
+        """POP3 client class over SSL connection
+
+        Instantiate with: POP3_SSL(hostname, port=995, timeout=None, context=None)
+
+               hostname - the hostname of the pop3 over ssl server
+               port - port number
+               timeout - socket timeout
+               context - a ssl.SSLContext, shared_context(verify=False)
+                         if not given
+
+        See the methods of the parent class POP3 for more documentation.
+        """
+
+        def __init__(self, host, port=POP3_SSL_PORT,
+                     timeout=socket._GLOBAL_DEFAULT_TIMEOUT, context=None):
+            if context is None:
+                context = shared_context(verify=False)
+            self.context = context
+            POP3.__init__(self, host, port, timeout)
+
+        def _create_socket(self, timeout):
+            sock = POP3._create_socket(self, timeout)
+            sock = self._wrap_socket(self.context, sock)
+            self._tls_established = True
+            return sock
+
+        def stls(self, context=None):
+            """The method unconditionally raises an exception since the
+            STLS command doesn't make any sense on an already established
+            SSL/TLS session.
+            """
+            raise error_proto('-ERR TLS session already established')
+
+    __all__.extend(["POP3_SSL", "shared_context"])
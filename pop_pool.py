@@ -0,0 +1,257 @@
+import contextlib
+import threading
+import time
+
+import pop_lib
+
+
+def connect_pop3(host, port, timeout):
+    """995 端口用 POP3_SSL，其余端口明文连接；TLS 使用共享的上下文，重连时可以恢复会话"""
+    if port == pop_lib.POP3_SSL_PORT and pop_lib.HAVE_SSL:
+        return pop_lib.POP3_SSL(host, port, timeout, context=pop_lib.shared_context())
+    return pop_lib.POP3(host, port, timeout)
+
+
+class POP3Pool:
+    """
+    POP3 连接管理：减少每次轮询都要重新建立 TCP/TLS 连接、读取欢迎信息和 CAPA 的开销。
+
+    POP3 会话在登录时固定邮箱快照，登录后到达的新邮件要重新登录才能看到，因此：
+    * 已登录的会话在 reuse_window 秒内可被复用（例如同步后紧接着按需获取正文），
+      空闲超过 probe_after 秒先用 NOOP 探测，窗口过后自动 QUIT 释放邮箱锁；
+    * fresh=True（轮询新邮件）时会先 QUIT 旧会话以拿到新的快照；
+    * keep_warm 为 True 且知道账户下次什么时候用（next_use）时，在那之前 warm_lead 秒建立一个尚未登录的
+      备用连接，下次登录只需 USER/PASS；备用连接 warm_max_age 秒内没有用上就关闭（很多服务器会断开长时间
+      不登录的连接），计入 stats['warm_discarded']，与 warm_hits 对照可以看出备用连接是否划算；
+    * 复用的连接已被服务器关闭时透明地重连；备用连接上登录失败（包括服务器断开前发来的
+      "-ERR Disconnected for inactivity." 之类）一律换新连接重试一次，密码错误时新连接上同样会失败；
+    * 每个服务器的 CAPA 结果只查询一次；
+    * 同一账户同时只有一个会话：遵循 RFC 1939 的服务器登录后锁定邮箱，第二个会话的 PASS 会失败，
+      所以同步进行中打开邮件时，下载正文要等同步用完会话，之后直接复用它。
+
+    * connect: 创建连接的函数 connect(host, port, timeout)，默认 connect_pop3
+    * next_use: next_use(user) 返回账户下次轮询的 time.monotonic() 时间，未知时返回 None（不建立备用连接），
+      一般传入 PollPolicy.due.get
+    * timeout: 套接字超时（秒）
+    """
+
+    def __init__(self, connect=connect_pop3, reuse_window=10, probe_after=5, keep_warm=True, next_use=None,
+                 warm_lead=5, warm_max_age=60, timeout=30):
+        self.connect = connect
+        self.reuse_window = reuse_window
+        self.probe_after = probe_after
+        self.keep_warm = keep_warm
+        self.next_use = next_use
+        self.warm_lead = warm_lead
+        self.warm_max_age = warm_max_age
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}     # (host, port, user) -> (已登录的 POP3, 放回时间)
+        self.warm = {}     # (host, port, user) -> (未登录的 POP3, 建立时间)
+        self.caps = {}     # (host, port) -> capa() 结果
+        self.busy = {}     # (host, port, user) -> 会话使用中持有的锁
+        self.timers = {}   # (host, port, user) -> 复用窗口结束、建立或关闭备用连接的定时器，每个账户最多一个
+        self.stats = {
+            'connects': 0, 'connect_seconds': 0.0,
+            'logins': 0, 'login_seconds': 0.0,
+            'reuses': 0, 'warm_hits': 0, 'warm_discarded': 0, 'reconnects': 0,
+        }
+
+    def saved_seconds(self):
+        """按平均建连、登录耗时估算复用连接节省的时间，没用上的备用连接白白建立，按建连耗时扣除"""
+        stats = self.stats
+        connect = stats['connect_seconds'] / stats['connects'] if stats['connects'] else 0.0
+        login = stats['login_seconds'] / stats['logins'] if stats['logins'] else 0.0
+        return stats['reuses'] * (connect + login) + (stats['warm_hits'] - stats['warm_discarded']) * connect
+
+    def capa(self, host, port=pop_lib.POP3_PORT):
+        """缓存的 CAPA 结果，还没有连接过该服务器时返回 None"""
+        return self.caps.get((host, port))
+
+    @contextlib.contextmanager
+    def session(self, host, user, password, port=pop_lib.POP3_PORT, fresh=False):
+        """
+        取得一个已登录的 POP3 会话，with 结束后放回池中；with 内部出错时会话直接关闭
+        同一账户的会话正在别的线程使用时等它用完。
+        * fresh: 需要最新的邮箱快照时为 True
+        """
+        key = (host, port, user)
+        with self.lock:
+            busy = self.busy.setdefault(key, threading.Lock())
+        with busy:
+            pop_conn = self._acquire(key, password, fresh)
+            try:
+                yield pop_conn
+            except BaseException:
+                pop_conn.close()
+                raise
+            self._release(key, pop_conn)
+
+    def _acquire(self, key, password, fresh):
+        with self.lock:
+            idle = self.idle.pop(key, None)
+            warm = self.warm.pop(key, None)
+            timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if idle is not None:
+            pop_conn, since = idle
+            if fresh or time.monotonic() - since > self.reuse_window:
+                self._quit(pop_conn)
+            elif self._alive(pop_conn, since):
+                self.stats['reuses'] += 1
+                if warm is not None:
+                    self._discard(warm[0])
+                return pop_conn
+            else:
+                self.stats['reconnects'] += 1
+        if warm is not None:
+            warm, since = warm
+            if time.monotonic() - since > self.warm_max_age:
+                self._discard(warm)
+            else:
+                try:
+                    self._login(warm, key[2], password)
+                    self.stats['warm_hits'] += 1
+                    return warm
+                except (pop_lib.error_proto, OSError):
+                    warm.close()
+                    self.stats['reconnects'] += 1
+        pop_conn = self._connect(key)
+        try:
+            self._login(pop_conn, key[2], password)
+        except BaseException:
+            pop_conn.close()
+            raise
+        return pop_conn
+
+    def _alive(self, pop_conn, since):
+        if time.monotonic() - since < self.probe_after:
+            return True
+        try:
+            pop_conn.noop()
+            return True
+        except (pop_lib.error_proto, OSError):
+            pop_conn.close()
+            return False
+
+    def _connect(self, key):
+        host, port, user = key
+        start = time.perf_counter()
+        pop_conn = self.connect(host, port, self.timeout)
+        self.stats['connects'] += 1
+        self.stats['connect_seconds'] += time.perf_counter() - start
+        caps = self.caps.get((host, port))
+        if caps is None:
+            try:
+                caps = pop_conn.capa()
+            except pop_lib.error_proto:
+                caps = {}
+            self.caps[(host, port)] = caps
+        pop_conn._pipelining = 'PIPELINING' in caps
+        return pop_conn
+
+    def _login(self, pop_conn, user, password):
+        start = time.perf_counter()
+        pop_conn.user(user)
+        pop_conn.pass_(password)
+        self.stats['logins'] += 1
+        self.stats['login_seconds'] += time.perf_counter() - start
+
+    def _release(self, key, pop_conn):
+        if pop_conn.sock is None:
+            return
+        timer = threading.Timer(self.reuse_window, self._expire, (key,))
+        timer.daemon = True
+        with self.lock:
+            # 同一账户只保留一个空闲会话，并发使用时多出来的直接退出
+            extra = key in self.idle
+            if not extra:
+                self.idle[key] = (pop_conn, time.monotonic())
+                self.timers[key] = timer
+        if extra:
+            self._quit(pop_conn)
+            return
+        timer.start()
+
+    def _own_timer(self, key):
+        # 定时器回调开头调用：定时器已被取消或替换时返回 False
+        with self.lock:
+            if self.timers.get(key) is not threading.current_thread():
+                return False
+            del self.timers[key]
+            return True
+
+    def _set_timer(self, key, delay, function):
+        timer = threading.Timer(delay, function, (key,))
+        timer.daemon = True
+        with self.lock:
+            if key in self.timers:
+                return
+            self.timers[key] = timer
+        timer.start()
+
+    def _expire(self, key):
+        # 复用窗口结束：QUIT 释放邮箱锁，下次轮询前再准备备用连接
+        if not self._own_timer(key):
+            return
+        with self.lock:
+            idle = self.idle.pop(key, None)
+        if idle is not None:
+            self._quit(idle[0])
+        if not self.keep_warm or self.next_use is None:
+            return
+        due = self.next_use(key[2])
+        if due is not None:
+            self._set_timer(key, max(0, due - self.warm_lead - time.monotonic()), self._warm_up)
+
+    def _warm_up(self, key):
+        if not self._own_timer(key):
+            return
+        with self.lock:
+            if key in self.warm or key in self.idle:
+                return
+        try:
+            self._put_warm(key, (self._connect(key), time.monotonic()))
+        except (pop_lib.error_proto, OSError):
+            return
+        self._set_timer(key, self.warm_max_age, self._expire_warm)
+
+    def _expire_warm(self, key):
+        # 备用连接到期还没用上（轮询推迟了或被跳过）
+        if not self._own_timer(key):
+            return
+        with self.lock:
+            warm = self.warm.pop(key, None)
+        if warm is not None:
+            self._discard(warm[0])
+
+    def _discard(self, pop_conn):
+        self.stats['warm_discarded'] += 1
+        self._quit(pop_conn)
+
+    def _put_warm(self, key, warm):
+        # warm 为 (未登录的 POP3, 建立时间)
+        with self.lock:
+            old = self.warm.pop(key, None)
+            self.warm[key] = warm
+        if old is not None:
+            self._discard(old[0])
+
+    def _quit(self, pop_conn):
+        try:
+            pop_conn.quit()
+        except (pop_lib.error_proto, OSError):
+            pop_conn.close()
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+            warm, self.warm = self.warm, {}
+            timers, self.timers = self.timers, {}
+        for timer in timers.values():
+            timer.cancel()
+        for pop_conn, since in idle.values():
+            self._quit(pop_conn)
+        for pop_conn, since in warm.values():
+            self._quit(pop_conn)
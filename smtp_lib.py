@@ -1,88 +1,459 @@
+import io
 import socket
 import base64
+import time
 
+import metrics
+from pop_pool import connect_pop3
 
-def send_email_via_smtp(server, port, username, password, from_addr, to_addr, subject, body):
+# BDAT 每块的字节数
+BDAT_CHUNK_SIZE = 1 << 16
+
+# 应答单行的最大长度（RFC 5321 规定 512，这里放宽）
+_MAXLINE = 8192
+
+
+class SMTPError(Exception):
+    """服务器返回了意料之外的应答码"""
+    def __init__(self, code, text):
+        super().__init__(code, text)
+        self.code = code
+        self.text = text
+
+
+class SMTPTransientError(SMTPError):
+    """4xx 应答，稍后重试可能成功"""
+
+
+class SMTPPermanentError(SMTPError):
+    """5xx 应答，重试也不会成功"""
+
+
+class SMTPProtocolError(SMTPError):
+    """应答格式错误或连接被关闭，连接已不可再用"""
+    def __init__(self, text):
+        super().__init__(-1, text)
+
+
+def reply_error(code, lines):
+    """按应答码生成对应类型的异常"""
+    text = '\n'.join(lines)
+    if 400 <= code < 500:
+        return SMTPTransientError(code, text)
+    if code >= 500:
+        return SMTPPermanentError(code, text)
+    return SMTPError(code, text)
+
+
+class SMTPReplyReader:
+    """
+    带缓冲的应答读取器：一次 recv_into 读入的数据可能包含半条应答、
+    多行应答（250-xxx ... 250 xxx）或流水线中连续的多条应答，都能正确切分
+    * sock: 已连接的套接字（任何提供 recv_into 的对象）
+    """
+
+    def __init__(self, sock, bufsize=4096):
+        self.sock = sock
+        self.buf = bytearray()
+        self.pos = 0
+        self.chunk = bytearray(bufsize)
+
+    def _readline(self):
+        while True:
+            end = self.buf.find(b'\n', self.pos)
+            if end >= 0:
+                line = bytes(self.buf[self.pos:end + 1])
+                self.pos = end + 1
+                if len(line) > _MAXLINE:
+                    raise SMTPProtocolError('line too long')
+                return line
+            if len(self.buf) - self.pos > _MAXLINE:
+                raise SMTPProtocolError('line too long')
+            n = self.sock.recv_into(self.chunk)
+            if not n:
+                raise SMTPProtocolError('connection closed')
+            if self.pos:
+                del self.buf[:self.pos]
+                self.pos = 0
+            self.buf += self.chunk[:n]
+
+    def read_reply(self):
+        """读取一条完整应答，返回 (应答码, 文本行列表)"""
+        lines = []
+        code = None
+        while True:
+            line = self._readline()
+            head = line[:3]
+            sep = line[3:4]
+            if not head.isdigit() or sep not in (b'-', b' ', b'\r', b'\n'):
+                raise SMTPProtocolError('malformed reply: %r' % line)
+            if code is None:
+                code = int(head)
+            elif int(head) != code:
+                raise SMTPProtocolError('reply code changed inside multi-line reply: %r' % line)
+            lines.append(line[4:].rstrip(b'\r\n').decode('utf-8', 'replace'))
+            if sep != b'-':
+                return code, lines
+
+    def pending(self):
+        """缓冲区里尚未读取的字节数"""
+        return len(self.buf) - self.pos
+
+
+def build_message(from_addr, to_addrs, subject, body):
+    """
+    拼装邮件原文（未做点填充）
+    * to_addrs: 收件人地址列表
+    """
+    return f"From: {from_addr}\r\nTo: {', '.join(to_addrs)}\r\nSubject: {subject}\r\nContent-Type: text/plain; charset=UTF-8\r\n\r\n{body}"
+
+
+def _encode_message(message):
+    """str/bytes 统一成 CRLF 换行的 bytes；文件对象原样返回，需已是 CRLF 换行"""
+    if isinstance(message, str):
+        message = message.encode()
+    if isinstance(message, (bytes, bytearray)):
+        return bytes(message).replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+    return message
+
+
+def _iter_chunks(message, size):
+    # 按块切分邮件原文，bytes 用 memoryview 切片，不产生拷贝
+    if isinstance(message, bytes):
+        view = memoryview(message)
+        for start in range(0, len(view), size):
+            yield view[start:start + size]
+        return
+    while True:
+        chunk = message.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _iter_stuffed(message, size):
+    # DATA 用：以 '.' 开头的行前面再加一个 '.'，并以 CRLF.CRLF 结束
+    if isinstance(message, bytes):
+        data = message.replace(b'\r\n.', b'\r\n..')
+        if data.startswith(b'.'):
+            data = b'.' + data
+        yield data
+        last = data[-2:]
+    else:
+        buf = []
+        pending = 0
+        line = b''
+        for line in message:
+            if line.startswith(b'.'):
+                line = b'.' + line
+            buf.append(line)
+            pending += len(line)
+            if pending >= size:
+                yield b''.join(buf)
+                buf = []
+                pending = 0
+        yield b''.join(buf)
+        last = line[-2:]
+    yield b'.\r\n' if last == b'\r\n' else b'\r\n.\r\n'
+
+
+class SMTPSession:
     """
+    可复用的 SMTP 会话：连接和登录只做一次，之后在同一连接上发送多封邮件，两封邮件之间用 RSET 复位。
+    EHLO 协商扩展：服务器支持 PIPELINING (RFC 2920) 时 RSET/MAIL/RCPT/DATA 作为一组发送，
+    支持 CHUNKING (RFC 3030) 时用 BDAT 分块发送正文，不做点填充
     * server: SMTP 服务器地址
     * port: SMTP 服务器端口
     * username: SMTP 服务器用户名
     * password: SMTP 服务器密码
-    * from_addr: 发件人地址
-    * to_addr: 收件人地址
-    * subject: 邮件主题
-    * body: 邮件正文
+    * timeout: 套接字超时（秒）
     """
-    message = f"From: {from_addr}\r\nTo: {to_addr}\r\nSubject: {subject}\r\nContent-Type: text/plain; charset=UTF-8\r\n\r\n{body}"   
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((server, port))
-        s.recv(1024)  # 读取欢迎信息
-        
-        # 发送 HELO 命令并读取回应
-        s.sendall(b'HELO mydomain.com\r\n')
-        s.recv(1024)
-
-        # 登录
-        s.sendall(b'AUTH LOGIN\r\n')
-        s.recv(1024)
-        s.sendall(base64.b64encode(username.encode()) + b'\r\n')
-        s.recv(1024)
-        s.sendall(base64.b64encode(password.encode()) + b'\r\n')
-        s.recv(1024)
-
-        # 发送邮件
-        s.sendall(f'MAIL FROM: <{from_addr}>\r\n'.encode())
-        s.recv(1024)
-        s.sendall(f'RCPT TO: <{to_addr}>\r\n'.encode())
-        s.recv(1024)
-        s.sendall(b'DATA\r\n')
-        s.recv(1024)
-        s.sendall(f'{message}\r\n.\r\n'.encode())
-        s.recv(1024)
-
-        # 退出
-        s.sendall(b'QUIT\r\n')
-        s.recv(1024)
-
-
-def receive_email_via_pop(server, port, username, password):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((server, port))
-        s.recv(1024)  # 读取欢迎信息
-
-        # 登录
-        s.sendall(f'USER {username}\r\n'.encode())
-        s.recv(1024)
-        s.sendall(f'PASS {password}\r\n'.encode())
-        response = s.recv(1024)
-        print(response)  # 打印登录响应
-
-        # 请求邮件列表
-        s.sendall(b'LIST\r\n')
-        response = s.recv(1024)
-        print(response)  # 打印邮件列表
-
-        # 提取最新邮件的编号
-        lines = response.splitlines()
-        latest_email_number = lines[-2].split()[0]  # 假设最后一行是'.\r\n'，前一行是最新邮件的信息
-
-        # 获取最新邮件的内容
-        s.sendall(f'RETR {latest_email_number.decode()}\r\n'.encode())
-        response = b""
+
+    def __init__(self, server, port, username, password, timeout=30):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.sent = 0
+        self.esmtp_features = {}
+        self.chunk_size = BDAT_CHUNK_SIZE
+
+    def __enter__(self):
+        if self.sock is None:
+            self.connect()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.quit()
+        else:
+            self.close()
+
+    def connect(self):
+        start = time.perf_counter() if metrics.sink is not None else None
+        self.sock = socket.create_connection((self.server, self.port), self.timeout)
+        # 流水线发送时不能让 Nagle 算法把小包攒到对方 ACK 之后
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = SMTPReplyReader(self.sock)
+        self._expect(220)  # 读取欢迎信息
+        if not self.ehlo():
+            self.command('HELO mydomain.com', 250)
+        # 登录；用户名和密码两行也记在 AUTH 名下
+        self.command('AUTH LOGIN', 334)
+        self._command('AUTH', base64.b64encode(self.username.encode()).decode(), 334)
+        self._command('AUTH', base64.b64encode(self.password.encode()).decode(), 235)
+        if start is not None:
+            metrics.observe('smtp_connect_seconds', time.perf_counter() - start)
+
+    def ehlo(self):
+        """发送 EHLO 并记录服务器支持的扩展，服务器不支持 ESMTP 时返回 False"""
+        start = time.perf_counter() if metrics.sink is not None else None
+        self._sendall(b'EHLO mydomain.com\r\n')
+        code, lines = self._getreply()
+        if start is not None:
+            self._record('EHLO', start)
+        if code != 250:
+            return False
+        self.esmtp_features = {}
+        for line in lines[1:]:
+            words = line.split(None, 1)
+            if words:
+                self.esmtp_features[words[0].upper()] = words[1] if len(words) > 1 else ''
+        return True
+
+    def has_extn(self, name):
+        return name.upper() in self.esmtp_features
+
+    def _group(self, lines):
+        """
+        发送一组命令并按顺序读取全部应答，返回 [(应答码, 文本行列表)]
+        支持 PIPELINING 时整组只用一次 sendall
+        """
+        start = time.perf_counter() if metrics.sink is not None else None
+        if self.has_extn('PIPELINING'):
+            self._sendall(b''.join(line.encode() + b'\r\n' for line in lines))
+            return self._replies(lines, start)
+        replies = []
+        for line in lines:
+            self._sendall(line.encode() + b'\r\n')
+            replies.extend(self._replies([line], start))
+            if start is not None:
+                start = time.perf_counter()
+        return replies
+
+    def _replies(self, lines, start):
+        """
+        依次读取 lines 的应答；start 不为 None 时记录每条命令的耗时，
+        流水线中的后一条从前一条应答读完算起
+        """
+        replies = []
+        for line in lines:
+            replies.append(self._getreply())
+            if start is not None:
+                start = self._record(line.split(None, 1)[0].upper(), start)
+        return replies
+
+    def _record(self, verb, start):
+        """记录从 start 到现在的耗时，返回现在的时间"""
+        now = time.perf_counter()
+        metrics.observe('smtp_command_seconds', now - start, command=verb)
+        return now
+
+    def _sendall(self, data):
+        self.sock.sendall(data)
+        if metrics.sink is not None:
+            metrics.count('smtp_bytes_sent_total', len(data))
+
+    def _getreply(self):
+        """读取一条完整应答（包括 250-xxx 这样的多行应答），返回 (应答码, 文本行列表)"""
+        return self.reader.read_reply()
+
+    def _expect(self, *codes):
+        code, lines = self._getreply()
+        if code not in codes:
+            raise reply_error(code, lines)
+        return code, lines
+
+    def command(self, line, *codes):
+        """发送一条命令并检查应答码"""
+        return self._command(line.split(None, 1)[0].upper(), line, *codes)
+
+    def _command(self, verb, line, *codes):
+        # verb 为记录耗时用的命令名；登录时发送的用户名、密码不能当作命令名，由调用方给出
+        start = time.perf_counter() if metrics.sink is not None else None
+        self._sendall(line.encode() + b'\r\n')
+        reply = self._expect(*codes)
+        if start is not None:
+            self._record(verb, start)
+        return reply
+
+    def send(self, from_addr, to_addrs, message):
+        """
+        在当前连接上发送一封邮件
+        * from_addr: 发件人地址
+        * to_addrs: 收件人地址，字符串或列表
+        * message: 邮件原文，str/bytes（见 build_message），或以 CRLF 换行的二进制文件对象
+        * 返回被服务器拒绝的收件人列表；全部被拒绝时抛出 SMTPError
+        """
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        message = _encode_message(message)
+        chunking = self.has_extn('CHUNKING')
+        lines = ['RSET'] if self.sent else []
+        lines.append(f'MAIL FROM: <{from_addr}>')
+        lines.extend(f'RCPT TO: <{addr}>' for addr in to_addrs)
+        if not chunking:
+            lines.append('DATA')
+        body_replies = []
+        if chunking and self.has_extn('PIPELINING'):
+            # BDAT 不需要等待 354，可以和 MAIL/RCPT 放在同一组里，一个往返发完一封邮件
+            start = time.perf_counter() if metrics.sink is not None else None
+            self._sendall(b''.join(line.encode() + b'\r\n' for line in lines))
+            count = self._write_bdat(message, wait=False)
+            replies = self._replies(lines, start)
+            body_start = time.perf_counter() if start is not None else None
+            body_replies = [self._getreply() for _ in range(count)]
+            if body_start is not None:
+                self._record('BODY', body_start)
+        else:
+            replies = self._group(lines)
+        self.sent += 1
+
+        if self.sent > 1:
+            reset = replies.pop(0)
+        else:
+            reset = (250, [])
+        mail, rcpts = replies[0], replies[1:1 + len(to_addrs)]
+        refused = [addr for addr, (code, _) in zip(to_addrs, rcpts) if code >= 400]
+        failure = None
+        if reset[0] != 250:
+            failure = reset
+        elif mail[0] != 250:
+            failure = mail
+        elif len(refused) == len(to_addrs):
+            failure = rcpts[-1]
+        if not chunking:
+            data = replies[-1]
+            if failure is not None and data[0] == 354:
+                # 流水线里 DATA 已被接受，发一个空邮件体结束它
+                self._sendall(b'.\r\n')
+                self._getreply()
+            elif failure is None and data[0] != 354:
+                failure = data
+        if failure is not None:
+            raise reply_error(*failure)
+
+        if body_replies:
+            for code, lines in body_replies:
+                if code != 250:
+                    raise reply_error(code, lines)
+            return refused
+        start = time.perf_counter() if metrics.sink is not None else None
+        if chunking:
+            self._write_bdat(message, wait=True)
+        else:
+            for chunk in _iter_stuffed(message, self.chunk_size):
+                self._sendall(chunk)
+            self._expect(250)
+        if start is not None:
+            self._record('BODY', start)
+        return refused
+
+    def _write_bdat(self, message, wait):
+        """
+        用 BDAT 分块发送正文，最后一块带 LAST
+        * wait: 为 True 时每块都等待应答；否则只发送，返回需要读取的应答个数
+        """
+        chunks = _iter_chunks(message, self.chunk_size)
+        chunk = next(chunks, b'')
+        count = 0
         while True:
-            part = s.recv(4096)
-            response += part
-            if part.endswith(b'.\r\n'):
-                break
+            following = next(chunks, None)
+            last = following is None
+            self._sendall(b'BDAT %d%s\r\n' % (len(chunk), b' LAST' if last else b'') + chunk)
+            if wait:
+                self._expect(250)
+            else:
+                count += 1
+            if last:
+                return count
+            chunk = following
 
-        # 假设邮件正文编码为 UTF-8
-        print(response.decode('utf-8'))  # 尝试以 UTF-8 解码并打印邮件内容
+    def send_many(self, messages):
+        """
+        批量发送
+        * messages: [(from_addr, to_addrs, message)]
+        * 返回与 messages 等长的列表，每项为被拒绝的收件人列表，或该邮件的 SMTPError
+        * 连接出错（SMTPProtocolError、OSError）时直接抛出
+        """
+        results = []
+        for from_addr, to_addrs, message in messages:
+            try:
+                results.append(self.send(from_addr, to_addrs, message))
+            except SMTPProtocolError:
+                raise
+            except SMTPError as e:
+                results.append(e)
+        return results
 
-        # 退出
-        s.sendall(b'QUIT\r\n')
-        s.recv(1024)
-        return response.decode('utf-8')
+    def quit(self):
+        if self.sock is None:
+            return
+        try:
+            self.command('QUIT', 221)
+        finally:
+            self.close()
 
+    def close(self):
+        self.reader = None
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            sock.close()
 
 
+def send_email_via_smtp(server, port, username, password, from_addr, to_addr, subject, body):
+    """
+    * server: SMTP 服务器地址
+    * port: SMTP 服务器端口
+    * username: SMTP 服务器用户名
+    * password: SMTP 服务器密码
+    * from_addr: 发件人地址
+    * to_addr: 收件人地址，可以是列表
+    * subject: 邮件主题
+    * body: 邮件正文
+    """
+    to_addrs = [to_addr] if isinstance(to_addr, str) else list(to_addr)
+    message = build_message(from_addr, to_addrs, subject, body)
+    with SMTPSession(server, port, username, password) as session:
+        session.send(from_addr, to_addrs, message)
+
 
+def receive_email_via_pop(server, port, username, password, sink=None):
+    """
+    获取最新一封邮件，基于 pop_lib 的流式 RETR，逐行读取并去除点填充
+    * server: POP3 服务器地址
+    * port: POP3 服务器端口，995 时使用 TLS
+    * username: 用户名
+    * password: 密码
+    * sink: 可选，接收每一行（含 CRLF）的可调用对象，例如 file.write；
+      提供时邮件不在内存中保存，返回 None，否则返回解码后的邮件原文
+    """
+    buf = None
+    if sink is None:
+        buf = io.BytesIO()
+        sink = buf.write
+    pop_conn = connect_pop3(server, port, None)
+    try:
+        pop_conn.user(username)
+        pop_conn.pass_(password)
+        message_count, _ = pop_conn.stat()
+        if message_count:
+            pop_conn.retr_to(message_count, sink)
+        pop_conn.quit()
+    finally:
+        pop_conn.close()
+    if buf is not None:
+        return buf.getvalue().decode('utf-8', 'replace')
@@ -0,0 +1,306 @@
+import os
+import sqlite3
+
+
+# 图形界面和命令行共用的数据库文件
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'email_client.db')
+
+
+def blob_path(db_path):
+    """数据库对应的邮件原文目录（见 blob_store.py），与数据库文件放在一起：email_client.db -> email_client.blobs"""
+    return os.path.splitext(db_path)[0] + '.blobs'
+
+
+# 连接参数：WAL 允许后台线程写入时界面照常读取
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA busy_timeout = 5000',
+)
+
+# SQLite 一条语句里最多绑定的参数个数（旧版本为 999）
+_MAX_VARS = 900
+
+
+# 数据库结构迁移，第 i 项把 user_version 从 i 升到 i + 1，只能追加不能修改
+MIGRATIONS = [
+    # 1: 原有的账户表和邮件表
+    '''
+    CREATE TABLE IF NOT EXISTS accounts (
+        email TEXT PRIMARY KEY,
+        password TEXT,
+        smtp_server TEXT,
+        pop_server TEXT
+    );
+    CREATE TABLE IF NOT EXISTS emails (
+        email_id TEXT PRIMARY KEY,
+        sender TEXT,
+        recipient TEXT,
+        subject TEXT,
+        body TEXT,
+        date TEXT
+    );
+    ''',
+    # 2: UIDL 增量同步状态
+    '''
+    CREATE TABLE IF NOT EXISTS uidl_state (
+        account TEXT,
+        uid TEXT,
+        msg_num INTEGER,
+        email_id TEXT,
+        state TEXT,
+        PRIMARY KEY (account, uid)
+    );
+    ''',
+    # 3: 按日期、发件人查询的索引
+    '''
+    CREATE INDEX IF NOT EXISTS emails_date ON emails (date);
+    CREATE INDEX IF NOT EXISTS emails_sender ON emails (sender);
+    ''',
+    # 4: 全文索引，外部内容表不重复保存文本，由触发器与 emails 保持同步
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+        subject, sender, recipient, body,
+        content='emails', content_rowid='rowid'
+    );
+    CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+        INSERT INTO emails_fts (rowid, subject, sender, recipient, body)
+        VALUES (new.rowid, new.subject, new.sender, new.recipient, new.body);
+    END;
+    CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, sender, recipient, body)
+        VALUES ('delete', old.rowid, old.subject, old.sender, old.recipient, old.body);
+    END;
+    CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, sender, recipient, body)
+        VALUES ('delete', old.rowid, old.subject, old.sender, old.recipient, old.body);
+        INSERT INTO emails_fts (rowid, subject, sender, recipient, body)
+        VALUES (new.rowid, new.subject, new.sender, new.recipient, new.body);
+    END;
+    INSERT INTO emails_fts (emails_fts) VALUES ('rebuild');
+    ''',
+    # 5: 发件箱，发送失败的邮件保留在这里等待重试
+    '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY,
+        account TEXT,
+        smtp_server TEXT,
+        from_addr TEXT,
+        to_addrs TEXT,
+        subject TEXT,
+        message BLOB,
+        status TEXT,
+        attempts INTEGER DEFAULT 0,
+        next_attempt REAL,
+        last_error TEXT,
+        created REAL,
+        sent_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+    ''',
+    # 6: 多账户合并收件箱，记录邮件是从哪个账户收到的
+    '''
+    ALTER TABLE emails ADD COLUMN account TEXT;
+    ''',
+    # 7: 邮件原文保存在 blob_store 里，这里只记录由哪些块按顺序拼成（空格分隔的 SHA-256）
+    '''
+    CREATE TABLE IF NOT EXISTS message_blobs (
+        email_id TEXT PRIMARY KEY,
+        blob_keys TEXT NOT NULL,
+        size INTEGER,
+        stored REAL
+    );
+    ''',
+    # 8: 会话索引（见 thread_index.py），升级前的邮件由 ThreadIndex.catch_up() 补入
+    '''
+    CREATE TABLE IF NOT EXISTS threads (
+        thread_id INTEGER PRIMARY KEY,
+        subject_key TEXT,
+        subject TEXT,
+        message_count INTEGER,
+        last_seq INTEGER,
+        last_email_id TEXT
+    );
+    CREATE INDEX IF NOT EXISTS threads_last ON threads (last_seq);
+    CREATE INDEX IF NOT EXISTS threads_subject ON threads (subject_key, last_seq);
+    CREATE TABLE IF NOT EXISTS thread_messages (
+        message_id TEXT PRIMARY KEY,
+        thread_id INTEGER NOT NULL,
+        parent_id TEXT,
+        email_id TEXT,
+        seq INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS thread_messages_thread ON thread_messages (thread_id, seq);
+    CREATE INDEX IF NOT EXISTS thread_messages_email ON thread_messages (email_id);
+    CREATE TABLE IF NOT EXISTS thread_state (caught_up INTEGER);
+    INSERT INTO thread_state (caught_up) VALUES (0);
+    ''',
+    # 9: 发件箱的认领记录，图形界面和 mailcli daemon 共用数据库时，不会重发对方正在发送的邮件
+    '''
+    ALTER TABLE outbox ADD COLUMN claimed_by TEXT;
+    ALTER TABLE outbox ADD COLUMN claimed_at REAL;
+    ''',
+    # 10: 下载后解码的正文单独存放在 email_bodies，不让 emails 表随正文变大；
+    #     全文索引改为以视图 email_search 为外部内容，正文取自 email_bodies（升级前保存在 emails.body 的正文照常索引）
+    '''
+    CREATE TABLE IF NOT EXISTS email_bodies (
+        email_id TEXT PRIMARY KEY,
+        body TEXT
+    );
+    DROP TRIGGER IF EXISTS emails_fts_insert;
+    DROP TRIGGER IF EXISTS emails_fts_delete;
+    DROP TRIGGER IF EXISTS emails_fts_update;
+    DROP TABLE IF EXISTS emails_fts;
+    CREATE VIEW IF NOT EXISTS email_search AS
+        SELECT emails.rowid AS rowid, emails.subject AS subject, emails.sender AS sender, emails.recipient AS recipient,
+               COALESCE(email_bodies.body, emails.body) AS body
+        FROM emails LEFT JOIN email_bodies ON email_bodies.email_id = emails.email_id;
+    CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+        subject, sender, recipient, body,
+        content='email_search', content_rowid='rowid'
+    );
+    CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+        INSERT INTO emails_fts (rowid, subject, sender, recipient, body)
+        VALUES (new.rowid, new.subject, new.sender, new.recipient,
+                COALESCE((SELECT body FROM email_bodies WHERE email_id = new.email_id), new.body));
+    END;
+    CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, sender, recipient, body)
+        VALUES ('delete', old.rowid, old.subject, old.sender, old.recipient,
+                COALESCE((SELECT body FROM email_bodies WHERE email_id = old.email_id), old.body));
+        DELETE FROM email_bodies WHERE email_id = old.email_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, sender, recipient, body)
+        VALUES ('delete', old.rowid, old.subject, old.sender, old.recipient,
+                COALESCE((SELECT body FROM email_bodies WHERE email_id = old.email_id), old.body));
+        INSERT INTO emails_fts (rowid, subject, sender, recipient, body)
+        VALUES (new.rowid, new.subject, new.sender, new.recipient,
+                COALESCE((SELECT body FROM email_bodies WHERE email_id = new.email_id), new.body));
+    END;
+    -- 只在第一次写入正文时更新索引（set_body 用 INSERT OR IGNORE），email_bodies 的行随 emails 一起删除
+    CREATE TRIGGER IF NOT EXISTS email_bodies_fts_insert AFTER INSERT ON email_bodies BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, sender, recipient, body)
+        SELECT 'delete', rowid, subject, sender, recipient, body FROM emails WHERE email_id = new.email_id;
+        INSERT INTO emails_fts (rowid, subject, sender, recipient, body)
+        SELECT rowid, subject, sender, recipient, new.body FROM emails WHERE email_id = new.email_id;
+    END;
+    INSERT INTO emails_fts (emails_fts) VALUES ('rebuild');
+    ''',
+    # 11: 打开邮件时按 email_id 找到它在哪个账户、uid 是什么（body_cache.BodyLoader.download）
+    '''
+    CREATE INDEX IF NOT EXISTS uidl_state_email ON uidl_state (email_id);
+    ''',
+]
+
+
+def fts_query(text):
+    """
+    把搜索框里的文字转换成 FTS5 查询：每个词加引号避免语法错误，词之间为 AND，最后一个词按前缀匹配
+    """
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    if not terms:
+        return None
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def migrate(conn):
+    """把数据库升级到最新版本，返回升级后的版本号"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number in range(version, len(MIGRATIONS)):
+        try:
+            conn.executescript('BEGIN;' + MIGRATIONS[number] + f'PRAGMA user_version = {number + 1}; COMMIT;')
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return max(version, len(MIGRATIONS))
+
+
+def connect(path, check_same_thread=True):
+    """
+    打开数据库并设置 WAL 等参数，然后执行迁移
+    * path: 数据库文件路径
+    """
+    conn = sqlite3.connect(path, check_same_thread=check_same_thread)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    migrate(conn)
+    return conn
+
+
+class MailStore:
+    """
+    邮件表的读写封装：批量写入、基于主键索引的去重
+    * conn: storage.connect() 返回的连接
+    """
+
+    COLUMNS = ('email_id', 'sender', 'recipient', 'subject', 'body', 'date')
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def existing_ids(self, email_ids):
+        """返回 email_ids 中已经保存过的 id 集合，每次查询走主键索引"""
+        email_ids = list(email_ids)
+        found = set()
+        for start in range(0, len(email_ids), _MAX_VARS):
+            chunk = email_ids[start:start + _MAX_VARS]
+            marks = ','.join('?' * len(chunk))
+            found.update(row[0] for row in self.conn.execute(f'SELECT email_id FROM emails WHERE email_id IN ({marks})', chunk))
+        return found
+
+    def insert_emails(self, rows, account=None, on_insert=None):
+        """
+        在一个事务里批量写入邮件，已存在的 email_id 会被跳过
+        （同一封邮件发给了多个账户时，合并收件箱里只保留先收到的一份）
+        * rows: [(email_id, sender, recipient, subject, body, date)]
+        * account: 收到这些邮件的账户
+        * on_insert: on_insert(new)，在同一事务里调用，用于维护会话索引这类派生数据
+        * 返回真正写入的行
+        """
+        seen = self.existing_ids(row[0] for row in rows)
+        new = []
+        for row in rows:
+            if row[0] not in seen:
+                seen.add(row[0])
+                new.append(row)
+        with self.conn:
+            self.conn.executemany('INSERT INTO emails (email_id, sender, recipient, subject, body, date, account) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  [(*row, account) for row in new])
+            if on_insert is not None and new:
+                on_insert(new)
+        return new
+
+    def set_body(self, email_id, body):
+        """
+        保存下载后解码的正文供全文索引使用，触发器同时更新索引；同步只取邮件头，正文下载过的邮件才能按正文搜到
+        正文写在 email_bodies 表里，不放进 emails，列表分页读取的表不随之变大。已经保存过的不再写入。
+        """
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO email_bodies (email_id, body) '
+                              'SELECT email_id, ? FROM emails WHERE email_id = ?', (body, email_id))
+
+    def search(self, text, limit=50, offset=0):
+        """
+        全文搜索，按 bm25 相关度排序并分页，主题、发件人的权重高于正文
+        正文只包括下载过的邮件（见 set_body）
+        * text: 用户输入的搜索文字
+        * 返回 [(email_id, sender, subject, date, account)]
+        """
+        query = fts_query(text)
+        if query is None:
+            return []
+        return self.conn.execute('''
+            SELECT emails.email_id, emails.sender, emails.subject, emails.date, emails.account
+            FROM emails_fts JOIN emails ON emails.rowid = emails_fts.rowid
+            WHERE emails_fts MATCH ?
+            ORDER BY bm25(emails_fts, 10.0, 5.0, 2.0, 1.0)
+            LIMIT ? OFFSET ?
+        ''', (query, limit, offset)).fetchall()
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM emails').fetchone()[0]
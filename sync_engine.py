@@ -0,0 +1,186 @@
+import metrics
+import pop_lib
+import storage
+from mime_parse import ParserPool, parse_headers
+from thread_index import ThreadIndex
+
+
+# 每次同步最多拉取的新邮件数量（与原来 refreshInbox 的 255 封保持一致）
+SYNC_LIMIT = 255
+
+
+def parse_uidl_listing(lines):
+    """
+    把 UIDL 的多行响应解析成 {uid: 邮件序号}
+    * lines: pop_lib.POP3.uidl() 返回的行列表，每行形如 b'1 whqtswO00WBw418f9t5JxYwZ'
+    """
+    listing = {}
+    for line in lines:
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        listing[parts[1].decode('ascii', 'replace')] = int(parts[0])
+    return listing
+
+
+class UidlSync:
+    """
+    基于 UIDL 的增量同步引擎。
+
+    每个 uid 的状态保存在 SQLite 的 uidl_state 表里（由 storage.migrate 创建），一次 UIDL 列表即可算出
+    新增 / 已删除的邮件，只对真正新增的邮件发送 TOP 命令。
+    引擎不负责 commit，调用方在写完 emails 表后统一提交。
+    """
+
+    def __init__(self, conn, account, limit=SYNC_LIMIT):
+        self.conn = conn
+        self.account = account
+        self.limit = limit
+        self.truncated = False   # 上一次 pending() 是否因为 limit 截掉了一部分新邮件
+        self.marked = 0          # 已记为获取的 uid 数
+
+    def known_uids(self):
+        rows = self.conn.execute('SELECT uid FROM uidl_state WHERE account = ?', (self.account,))
+        return {row[0] for row in rows}
+
+    def listing(self, pop_conn):
+        """向服务器请求一次 UIDL，服务器不支持时退回到 TOP + Message-ID"""
+        try:
+            _, lines, _ = pop_conn.uidl()
+        except pop_lib.error_proto:
+            return self._listing_from_message_ids(pop_conn)
+        return parse_uidl_listing(lines)
+
+    def _listing_from_message_ids(self, pop_conn):
+        # 不支持 UIDL 的服务器：用 Message-ID 充当 uid，开销与旧实现相同
+        message_count, _ = pop_conn.stat()
+        listing = {}
+        for i in range(1, message_count + 1):
+            _, lines, _ = pop_conn.top(i, 0)
+            listing[parse_headers(b'\r\n'.join(lines))[0] or 'num-%d' % i] = i
+        return listing
+
+    def plan(self, listing):
+        """
+        对比服务器列表与本地状态
+        * 返回 (new, removed)：new 为按序号从新到旧排列的 [(序号, uid)]，removed 为已从服务器删除的 uid 集合
+        """
+        known = self.known_uids()
+        new = sorted(((num, uid) for uid, num in listing.items() if uid not in known), reverse=True)
+        removed = known - listing.keys()
+        return new, removed
+
+    def forget(self, uids):
+        self.conn.executemany('DELETE FROM uidl_state WHERE account = ? AND uid = ?',
+                              [(self.account, uid) for uid in uids])
+
+    def mark_fetched(self, uid, msg_num, email_id):
+        self.marked += 1
+        self.conn.execute('INSERT OR REPLACE INTO uidl_state (account, uid, msg_num, email_id, state) VALUES (?, ?, ?, ?, ?)',
+                          (self.account, uid, msg_num, email_id, 'fetched'))
+
+    def pending(self, pop_conn):
+        """
+        请求一次 UIDL，清理服务器上已删除的 uid，返回本次需要获取的 [(序号, uid)]
+        新邮件太多时取最新的 limit 封，但按从旧到新的顺序返回：收件箱按写入顺序（rowid）排列，
+        同一次同步里较新的邮件要后写入
+        """
+        new, removed = self.plan(self.listing(pop_conn))
+        self.forget(removed)
+        self.truncated = len(new) > self.limit
+        return new[:self.limit][::-1]
+
+    def fetch(self, pop_conn, new, parser=None):
+        """
+        获取 pending() 给出的邮件头，逐个生成 (uid, 记录)，记录为 mime_parse.parse_headers() 的
+        (message_id, sender, recipient, subject, date, in_reply_to, references)。
+        调用方写入 emails 表后，引擎才把对应 uid 记为已获取；
+        获取失败的邮件不会记录状态，下次同步时会重试。
+        * parser: mime_parse.ParserPool，为 None 时在当前线程解析
+        """
+        if parser is None:
+            parser = ParserPool(workers=1)
+        # 服务器支持 PIPELINING 时，一批 TOP 命令只需一两个往返；
+        # 上一批交给解析进程的同时就去取下一批，网络和解析重叠进行
+        parsing = None
+        for start in range(0, len(new), pop_lib._PIPELINE_BATCH):
+            batch = new[start:start + pop_lib._PIPELINE_BATCH]
+            print(f"正在获取第{batch[0][0]}-{batch[-1][0]}封邮件")
+            responses = pop_conn.top_many([num for num, _ in batch], 0)
+            fetched = []
+            raws = []
+            for (num, uid), resp in zip(batch, responses):
+                if isinstance(resp, pop_lib.error_proto):
+                    print(f"获取邮件失败: {resp}")
+                    continue
+                fetched.append((num, uid))
+                raws.append(b'\r\n'.join(resp[1]))
+            if parsing is not None:
+                yield from self._parsed(*parsing)
+            parsing = (fetched, parser.submit(raws))
+        if parsing is not None:
+            yield from self._parsed(*parsing)
+
+    def _parsed(self, fetched, future):
+        for (num, uid), record in zip(fetched, future.result()):
+            yield uid, record
+            self.mark_fetched(uid, num, record[0] or uid)
+
+    def sync(self, pop_conn, parser=None):
+        """执行一次增量同步，等价于 fetch(pop_conn, pending(pop_conn))"""
+        return self.fetch(pop_conn, self.pending(pop_conn), parser)
+
+
+def sync_account(conn, pop_conn, account, batch_size=20, on_batch=None, on_progress=None, cancelled=None, parser=None):
+    """
+    对一个已登录的账户执行一次增量同步，新邮件每攒够 batch_size 封提交一次
+    * conn: 本线程的 SQLite 连接
+    * pop_conn: 已登录的 pop_lib.POP3
+    * account: 账户（邮箱地址）
+    * on_batch: on_batch(rows)，每批真正写入的新邮件 [(email_id, sender, recipient, subject, body, date)]
+    * on_progress: on_progress(done, total)
+    * cancelled: 返回 True 时在当前这封邮件处理完后停止，已获取的邮件会保存
+    * parser: 解析邮件头用的 mime_parse.ParserPool
+    * 返回 (写入的邮件数, 是否已取完)：服务器上的新邮件全部记为已获取时才算取完；超过单次上限、被取消、
+      有 TOP 失败时为 False。与已有邮件重复、没有写入的邮件也算已获取，所以写入数不能用来判断
+    """
+    engine = UidlSync(conn, account)
+    store = storage.MailStore(conn)
+    threads = ThreadIndex(conn)
+    references = {}   # email_id -> (In-Reply-To, References)
+    added = 0
+
+    def index(new):
+        for email_id, sender, recipient, subject, body, date in new:
+            threads.add(email_id, subject, *references.get(email_id, (None, None)))
+
+    def flush(batch):
+        # 同一事务里写入邮件、会话索引和 uid 状态
+        nonlocal added
+        with metrics.timed('sqlite_write_seconds', operation='sync_batch'):
+            new = store.insert_emails(batch, account, on_insert=index)
+            conn.commit()
+        references.clear()
+        if new:
+            added += len(new)
+            if on_batch is not None:
+                on_batch(new)
+
+    new = engine.pending(pop_conn)
+    if on_progress is not None:
+        on_progress(0, len(new))
+    batch = []
+    for done, (uid, record) in enumerate(engine.fetch(pop_conn, new, parser), 1):
+        message_id, sender, recipient, subject, date, in_reply_to, refs = record
+        # 只同步邮件头，正文在打开邮件时再下载
+        batch.append((message_id or uid, sender, recipient, subject, '', date))
+        references[message_id or uid] = (in_reply_to, refs)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+        if on_progress is not None:
+            on_progress(done, len(new))
+        if cancelled is not None and cancelled():
+            break
+    flush(batch)
+    return added, not engine.truncated and engine.marked == len(new)
@@ -0,0 +1,145 @@
+import random
+import threading
+import time
+
+import pop_lib
+import storage
+from outbox import parse_server
+from pop_pool import POP3Pool
+from sync_engine import sync_account
+
+
+class SyncScheduler:
+    """
+    多账户并发收信：所有账户的邮件写入同一个 emails 表，收件箱里合并显示
+    * db_path: 数据库路径，每个线程使用独立连接
+    * pool: 共享的 POP3Pool
+    * workers: 最多同时同步的账户数
+    * per_server: 同一 POP3 服务器最多同时使用的连接数，服务器忙时先同步其他服务器上的账户
+    * stagger: 相邻两个账户开始同步的间隔（秒），避免几十个账户在同一秒连上服务器
+    * jitter: 每个账户的开始时间再随机推迟 0 到 jitter 秒，多个客户端之间也不会对齐
+    * batch_size: 每攒够多少封新邮件提交一次
+    * on_batch: on_batch(account, rows)，每批新邮件写入后在同步线程中调用
+    * on_progress: on_progress(account, done, total)，在同步线程中调用
+    * parser: 共享的 mime_parse.ParserPool，为 None 时在同步线程中解析邮件头
+    * fingerprints: {email: (邮件数, 总大小)}，记录每个账户上次完整同步后的 STAT 结果，
+      run(check=True) 时 STAT 没有变化的邮箱不再请求 UIDL
+    """
+
+    def __init__(self, db_path, pool=None, workers=4, per_server=2, stagger=0.5, jitter=0.5,
+                 batch_size=20, on_batch=None, on_progress=None, parser=None, fingerprints=None):
+        self.db_path = db_path
+        self.pool = pool if pool is not None else POP3Pool()
+        self.workers = workers
+        self.per_server = per_server
+        self.stagger = stagger
+        self.jitter = jitter
+        self.batch_size = batch_size
+        self.on_batch = on_batch
+        self.on_progress = on_progress
+        self.parser = parser
+        self.fingerprints = fingerprints if fingerprints is not None else {}
+        self.check = False
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.queue = []
+        self.active = {}   # POP3 服务器 -> 正在使用的连接数
+        self.results = {}
+
+    def plan(self, accounts, now=None):
+        """
+        安排每个账户的开始时间
+        * accounts: [(email, password, pop_server)]
+        * 返回按开始时间排序的 [(开始时间, email, password, host, port)]
+        """
+        now = time.monotonic() if now is None else now
+        queue = []
+        for i, (email, password, pop_server) in enumerate(accounts):
+            host, port = parse_server(pop_server, pop_lib.POP3_SSL_PORT)
+            start = now + i * self.stagger + random.uniform(0, self.jitter)
+            queue.append((start, email, password, host, port))
+        queue.sort(key=lambda job: job[0])
+        return queue
+
+    def run(self, accounts, check=False):
+        """
+        同步所有账户，全部完成（或被取消）后返回
+        * check: 先用 STAT 检查，邮件数和总大小都没变的邮箱直接跳过
+        * 返回 {email: 新邮件数，失败时为异常对象}
+        """
+        with self.cond:
+            self.stopping = False
+            self.check = check
+            self.queue = self.plan(accounts)
+            self.active = {}
+            self.results = {}
+        threads = []
+        for i in range(min(self.workers, len(self.queue))):
+            thread = threading.Thread(target=self._run, name=f'sync-{i}', daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return self.results
+
+    def cancel(self):
+        """还没开始的账户不再同步，正在同步的账户处理完当前这封邮件后停止"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+
+    def _claim(self):
+        # 取出第一个已到开始时间、且服务器没有满载的账户；都不满足时等待
+        with self.cond:
+            while not self.stopping and self.queue:
+                now = time.monotonic()
+                wait = None
+                for i, job in enumerate(self.queue):
+                    if job[0] > now:
+                        wait = job[0] - now if wait is None else min(wait, job[0] - now)
+                        break
+                    if self.active.get(job[3], 0) < self.per_server:
+                        del self.queue[i]
+                        self.active[job[3]] = self.active.get(job[3], 0) + 1
+                        return job
+                self.cond.wait(wait)
+            return None
+
+    def _run(self):
+        conn = storage.connect(self.db_path)
+        try:
+            while True:
+                job = self._claim()
+                if job is None:
+                    return
+                _, email, password, host, port = job
+                try:
+                    self.results[email] = self._sync(conn, email, password, host, port)
+                except Exception as e:
+                    print(f"{email} 邮件接收失败: {e}")
+                    self.results[email] = e
+                finally:
+                    with self.cond:
+                        self.active[host] -= 1
+                        self.cond.notify_all()
+        finally:
+            conn.close()
+
+    def _sync(self, conn, email, password, host, port):
+        on_batch = on_progress = None
+        if self.on_batch is not None:
+            on_batch = lambda rows: self.on_batch(email, rows)
+        if self.on_progress is not None:
+            on_progress = lambda done, total: self.on_progress(email, done, total)
+        # fresh=True：需要新的邮箱快照才能看到新邮件，但可以用池里预先建好的连接
+        with self.pool.session(host, email, password, port, fresh=True) as pop_conn:
+            # STAT 只有一行响应，比 UIDL 列表便宜得多
+            fingerprint = pop_conn.stat()
+            if self.check and self.fingerprints.get(email) == fingerprint:
+                return 0
+            added, complete = sync_account(conn, pop_conn, email, self.batch_size, on_batch, on_progress,
+                                           cancelled=lambda: self.stopping, parser=self.parser)
+            # 还有邮件没取完（被取消、达到单次上限、TOP 失败）时不记录，下次照常同步
+            if complete:
+                self.fingerprints[email] = fingerprint
+            return added
@@ -0,0 +1,67 @@
+import threading
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from sync_scheduler import SyncScheduler
+
+
+class SyncWorker(QThread):
+    """
+    后台收信线程：由 SyncScheduler 并发同步所有账户，POP3 登录、UIDL 增量同步和写数据库都不在 GUI 线程里进行。
+    * db_path: 数据库路径，每个同步线程使用独立的 SQLite 连接
+    * accounts: [(email, password, pop_server)]，pop_server 可写成 host:port，不写端口时用 995 端口的 TLS 连接
+    * pool: 共享的 POP3Pool
+    * workers / per_server: 同时同步的账户数、同一服务器的连接数上限，见 SyncScheduler
+    * batch_size: 每攒够多少封新邮件就提交一次并通知界面
+    * parser: 共享的 mime_parse.ParserPool
+    * fingerprints / check: 见 SyncScheduler，定时轮询时 check=True，STAT 没变化的邮箱直接跳过
+    """
+    headersReady = pyqtSignal(list)   # 一批新邮件 [(email_id, sender, recipient, subject, body, date)]
+    progress = pyqtSignal(int, int)   # 所有账户合计 (已处理, 总数)
+    syncFailed = pyqtSignal(str)
+
+    def __init__(self, db_path, accounts, pool=None, workers=4, per_server=2, batch_size=20,
+                 parser=None, fingerprints=None, check=False, parent=None):
+        super().__init__(parent)
+        self.accounts = list(accounts)
+        self.check = check
+        self.scheduler = SyncScheduler(db_path, pool, workers, per_server, batch_size=batch_size,
+                                       on_batch=self._batch, on_progress=self._progress, parser=parser,
+                                       fingerprints=fingerprints)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.added = 0
+        self.results = {}
+        self.error = None
+
+    def cancel(self):
+        """请求取消，正在同步的账户处理完当前这封邮件后停止，已获取的邮件会保存"""
+        self.requestInterruption()
+        self.scheduler.cancel()
+
+    def run(self):
+        self.counts = {}
+        self.added = 0
+        self.error = None
+        self.results = self.scheduler.run(self.accounts, self.check)
+        errors = []
+        for email, result in self.results.items():
+            if isinstance(result, Exception):
+                errors.append(f"{email}: {result}")
+            else:
+                self.added += result
+        if errors:
+            self.error = '; '.join(errors)
+            self.syncFailed.emit(self.error)
+
+    # 以下回调在同步线程中调用，信号会排队送到 GUI 线程
+
+    def _batch(self, email, rows):
+        self.headersReady.emit(rows)
+
+    def _progress(self, email, done, total):
+        with self.lock:
+            self.counts[email] = (done, total)
+            done = sum(count[0] for count in self.counts.values())
+            total = sum(count[1] for count in self.counts.values())
+        self.progress.emit(done, total)
@@ -0,0 +1,61 @@
+"""
+会话索引与同步写入顺序：原邮件和回复在同一次同步里收到时，会话内按原邮件、回复的顺序排列
+
+    python -m unittest tests.test_thread_index
+"""
+import os
+import tempfile
+import unittest
+
+import pop_lib
+import storage
+from bench.fake_pop3 import FakePOP3Server, make_message
+from sync_engine import sync_account
+from thread_index import ThreadIndex
+
+
+def reply_to(i, reply_id):
+    return (f'Message-ID: <{reply_id}>\r\n'
+            f'From: other@example.com\r\n'
+            f'To: user@example.com\r\n'
+            f'Subject: Re: bench message {i}\r\n'
+            f'In-Reply-To: <bench-{i}@example.com>\r\n'
+            f'References: <bench-{i}@example.com>\r\n\r\n'
+            f'reply\r\n').encode()
+
+
+class SyncThreadOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.conn = storage.connect(os.path.join(directory.name, 'test.db'))
+        self.addCleanup(self.conn.close)
+
+    def sync(self, messages):
+        server = FakePOP3Server(messages, ('UIDL', 'TOP')).start()
+        self.addCleanup(server.stop)
+        pop_conn = pop_lib.POP3('127.0.0.1', server.port)
+        pop_conn.user('user')
+        pop_conn.pass_('secret')
+        try:
+            return sync_account(self.conn, pop_conn, 'user@example.com')[0]
+        finally:
+            pop_conn.quit()
+
+    def test_parent_and_reply_in_one_sync(self):
+        self.assertEqual(self.sync([make_message(1, 100), make_message(2, 100), reply_to(1, 'r1@x')]), 3)
+        # 收件箱最上面是最新的一封
+        newest = self.conn.execute('SELECT email_id FROM emails ORDER BY rowid DESC LIMIT 1').fetchone()[0]
+        self.assertEqual(newest, '<r1@x>')
+
+        thread_id, last_email_id, count = self.conn.execute(
+            "SELECT thread_id, last_email_id, message_count FROM threads WHERE subject_key = 'bench message 1'").fetchone()
+        self.assertEqual(last_email_id, '<r1@x>')
+        self.assertEqual(count, 2)
+        messages = ThreadIndex(self.conn).messages(thread_id)
+        self.assertEqual([(m[0], m[-1]) for m in messages], [('<bench-1@example.com>', 0), ('<r1@x>', 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+"""
+会话索引：按 Message-ID / In-Reply-To / References 把邮件串成会话，没有引用头的回复按主题归并（JWZ 算法的简化版）
+
+索引保存在 SQLite 的 threads / thread_messages 表里（由 storage.migrate 创建），每写入一封邮件增量更新，不需要重建：
+    thread_messages  每个 Message-ID 一行，记录所属会话和上级邮件；只被引用、还没收到的邮件也占一行（email_id 为空）
+    threads          每个会话一行，保存邮件数、最新一封邮件和排序位置，收件箱按会话显示时只读这张表
+"""
+import re
+
+# 引用头里的 <msg-id>
+_MSG_ID = re.compile(r'<[^<>\s]+>')
+
+# 主题前面的回复、转发前缀，例如 "Re: "、"Fwd[2]: "、"回复："，以及邮件列表加的 "[list] "
+_PREFIX = re.compile(r'^\s*(?:(?:re|fwd?|aw|sv|回复|答复|转发)\s*(?:\[\d+\]|\(\d+\))?\s*[:：]|\[[^\]]*\])\s*', re.IGNORECASE)
+_REPLY = re.compile(r'^\s*(?:re|fwd?|aw|sv|回复|答复|转发)\s*(?:\[\d+\]|\(\d+\))?\s*[:：]', re.IGNORECASE)
+
+
+def normalize_subject(subject):
+    """
+    去掉回复、转发前缀和邮件列表标签，返回 (用于归并的主题, 是否为回复)
+    """
+    subject = subject or ''
+    reply = False
+    while True:
+        match = _PREFIX.match(subject)
+        if match is None or not match.end():
+            break
+        reply = reply or _REPLY.match(subject) is not None
+        subject = subject[match.end():]
+    return ' '.join(subject.split()).casefold(), reply
+
+
+def parse_references(in_reply_to, references):
+    """
+    References 与 In-Reply-To 合并成从根到直接上级的 Message-ID 列表
+    In-Reply-To 里只取第一个 <msg-id>，有的客户端会在后面附加地址等文字。
+    """
+    ids = _MSG_ID.findall(references or '')
+    parent = _MSG_ID.findall(in_reply_to or '')
+    if parent and (not ids or ids[-1] != parent[0]):
+        ids.append(parent[0])
+    # 去掉重复，保留第一次出现的位置
+    seen = set()
+    return [msg_id for msg_id in ids if not (msg_id in seen or seen.add(msg_id))]
+
+
+class ThreadIndex:
+    """
+    会话索引的增量维护
+    * conn: storage.connect() 返回的连接
+    add() 不提交，调用方与写入 emails 表放在同一事务里（见 storage.MailStore.insert_emails 的 on_insert）。
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _thread_of(self, message_id):
+        row = self.conn.execute('SELECT thread_id FROM thread_messages WHERE message_id = ?', (message_id,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, email_id, subject, in_reply_to=None, references=None, seq=None):
+        """
+        把一封新写入的邮件加入索引，返回它所属的会话 id
+        * email_id: emails 表的主键（有 Message-ID 时就是 Message-ID）
+        * subject: 主题
+        * in_reply_to / references: 原始的 In-Reply-To、References 头
+        * seq: 排序位置，默认为该邮件在 emails 表中的 rowid（与收件箱平铺列表的顺序相同）
+        """
+        if seq is None:
+            seq = self.conn.execute('SELECT rowid FROM emails WHERE email_id = ?', (email_id,)).fetchone()[0]
+        refs = [msg_id for msg_id in parse_references(in_reply_to, references) if msg_id != email_id]
+        key, reply = normalize_subject(subject)
+
+        # 自己的占位行（先收到了回复）和所有引用到的邮件所在的会话
+        threads = []
+        for msg_id in [email_id] + refs:
+            thread_id = self._thread_of(msg_id)
+            if thread_id is not None and thread_id not in threads:
+                threads.append(thread_id)
+        if not threads and not refs and reply and key:
+            # 没有引用头的回复：归到同一主题最近活跃的会话
+            row = self.conn.execute('SELECT thread_id FROM threads WHERE subject_key = ? ORDER BY last_seq DESC LIMIT 1',
+                                    (key,)).fetchone()
+            if row is not None:
+                threads.append(row[0])
+
+        if not threads:
+            thread_id = self.conn.execute(
+                'INSERT INTO threads (subject_key, subject, message_count, last_seq, last_email_id) VALUES (?, ?, 0, ?, ?)',
+                (key, subject, seq, email_id)).lastrowid
+        else:
+            thread_id = self._merge(threads)
+
+        # 引用链上还没见过的邮件建占位行，上级为链上的前一封
+        parent = None
+        for msg_id in refs:
+            self.conn.execute('INSERT OR IGNORE INTO thread_messages (message_id, thread_id, parent_id) VALUES (?, ?, ?)',
+                              (msg_id, thread_id, parent))
+            parent = msg_id
+        self.conn.execute('''
+            INSERT INTO thread_messages (message_id, thread_id, parent_id, email_id, seq) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (message_id) DO UPDATE SET parent_id = excluded.parent_id, email_id = excluded.email_id, seq = excluded.seq
+        ''', (email_id, thread_id, parent, email_id, seq))
+        # 会话的主题取根邮件的；先收到回复时暂用回复的主题，根邮件到达后替换
+        self.conn.execute('''
+            UPDATE threads SET message_count = message_count + 1,
+                subject = CASE WHEN ? THEN ? ELSE subject END,
+                last_email_id = CASE WHEN ? >= last_seq THEN ? ELSE last_email_id END,
+                last_seq = MAX(last_seq, ?)
+            WHERE thread_id = ?
+        ''', (not refs and not reply, subject, seq, email_id, seq, thread_id))
+        return thread_id
+
+    def _merge(self, threads):
+        # 一封邮件连起了几个会话：并入邮件最多的那个，只移动较小会话的行
+        if len(threads) == 1:
+            return threads[0]
+        marks = ','.join('?' * len(threads))
+        rows = self.conn.execute(f'SELECT thread_id, message_count, last_seq, last_email_id FROM threads WHERE thread_id IN ({marks})',
+                                 threads).fetchall()
+        target = max(rows, key=lambda row: row[1])
+        others = [row[0] for row in rows if row[0] != target[0]]
+        latest = max(rows, key=lambda row: row[2])
+        marks = ','.join('?' * len(others))
+        self.conn.execute(f'UPDATE thread_messages SET thread_id = ? WHERE thread_id IN ({marks})', [target[0]] + others)
+        self.conn.execute(f'DELETE FROM threads WHERE thread_id IN ({marks})', others)
+        self.conn.execute('UPDATE threads SET message_count = ?, last_seq = ?, last_email_id = ? WHERE thread_id = ?',
+                          (sum(row[1] for row in rows), latest[2], latest[3], target[0]))
+        return target[0]
+
+    def _legacy(self, limit):
+        done = self.conn.execute('SELECT caught_up FROM thread_state').fetchone()[0]
+        return self.conn.execute('''
+            SELECT emails.rowid, emails.email_id, emails.subject FROM emails
+            WHERE emails.rowid > ? AND NOT EXISTS (SELECT 1 FROM thread_messages WHERE thread_messages.email_id = emails.email_id)
+            ORDER BY emails.rowid LIMIT ?
+        ''', (done, limit)).fetchall()
+
+    def catch_up(self, batch=1000):
+        """
+        把还没有加入索引的旧邮件（升级前收到的）补进来，每 batch 封提交一次，返回补入的数量
+        这些邮件没有保存引用头，只能按主题归并。进度记在 thread_state 里，补完之后再调用只需一次查询。
+        十万封大约要几秒，界面里在后台线程调用；每批在 BEGIN IMMEDIATE 里读写，可以与同步线程同时进行。
+        """
+        added = 0
+        while True:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._legacy(batch)
+                for seq, email_id, subject in rows:
+                    self.add(email_id, subject, seq=seq)
+                if rows:
+                    self.conn.execute('UPDATE thread_state SET caught_up = ?', (rows[-1][0],))
+                else:
+                    self.conn.execute('UPDATE thread_state SET caught_up = (SELECT COALESCE(MAX(rowid), 0) FROM emails)')
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+            if not rows:
+                return added
+            added += len(rows)
+
+    def messages(self, thread_id):
+        """
+        会话里已收到的邮件，按时间顺序排列并带缩进层级：
+        [(email_id, sender, subject, date, account, depth)]
+        """
+        rows = self.conn.execute('''
+            SELECT emails.email_id, emails.sender, emails.subject, emails.date, emails.account,
+                   thread_messages.message_id, thread_messages.parent_id
+            FROM thread_messages JOIN emails ON emails.email_id = thread_messages.email_id
+            WHERE thread_messages.thread_id = ?
+            ORDER BY thread_messages.seq
+        ''', (thread_id,)).fetchall()
+        parents = dict(self.conn.execute('SELECT message_id, parent_id FROM thread_messages WHERE thread_id = ?',
+                                         (thread_id,)).fetchall())
+        result = []
+        for email_id, sender, subject, date, account, message_id, parent in rows:
+            # 层级为引用链的长度，错误的引用头可能造成环，见过的就停下
+            depth = 0
+            seen = {message_id}
+            while parent is not None and parent not in seen:
+                seen.add(parent)
+                depth += 1
+                parent = parents.get(parent)
+            result.append((email_id, sender, subject, date, account, depth))
+        return result